@@ -0,0 +1,299 @@
+"""
+Formato compacto para exportar/importar campanhas, um registro por regra ou personagem.
+
+    cabeçalho: b"YSC1"
+    registro:  b"YS" | tipo (1 byte) | tamanho (u32) | crc32 (u32) | payload = zlib(JSON compacto)
+    tipos:     R = regra global, C = personagem completo, E = fim (contagens, detecta arquivo cortado)
+
+As regras vêm antes dos personagens. O CRC32 cobre tipo, tamanho e payload: um registro corrompido é
+pulado (a leitura procura o próximo marcador b"YS") e o resto da campanha entra normalmente.
+Exportação e importação tratam um personagem por vez; no SQLite, quem não estava aberto é lido do
+banco só para ser gravado e descartado em seguida.
+
+    python yoursheet.py export campanha.ysc
+    python yoursheet.py import campanha.ysc      (também aceita um rpg_data.json)
+"""
+import json
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+
+from storage import new_id
+
+MAGIC = b"YSC1"
+SYNC = b"YS"
+MAX_RECORD = 64 << 20  # bytes; um tamanho maior que isso só pode ser corrupção
+_RECORD = struct.Struct("<2scII")
+_SCAN_CHUNK = 1 << 16
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+# --- Registros ---
+
+def write_record(f, kind: str, obj):
+    payload = zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    head = kind.encode("ascii") + struct.pack("<I", len(payload))
+    f.write(_RECORD.pack(SYNC, head[:1], len(payload), zlib.crc32(head + payload)))
+    f.write(payload)
+
+
+def _resync(f, position: int) -> bool:
+    """Posiciona o arquivo no próximo marcador SYNC a partir de `position`; False se não houver."""
+    f.seek(position)
+    carry = b""
+    while True:
+        chunk = f.read(_SCAN_CHUNK)
+        if not chunk:
+            return False
+        data = carry + chunk
+        found = data.find(SYNC)
+        if found >= 0:
+            f.seek(position - len(carry) + found)
+            return True
+        carry = data[-(len(SYNC) - 1):]
+        position += len(chunk)
+
+
+def iter_records(f):
+    """
+    Gera (tipo, objeto) para cada registro íntegro do arquivo (aberto em "rb").
+    Um trecho corrompido gera uma vez (None, mensagem) e a leitura continua no próximo registro bom.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError("não é um arquivo de campanha do YourSheet")
+    damaged = False
+    while True:
+        start = f.tell()
+        head = f.read(_RECORD.size)
+        if not head:
+            return
+        if len(head) == _RECORD.size:
+            sync, kind, length, crc = _RECORD.unpack(head)
+            if sync == SYNC and length <= MAX_RECORD:
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(head[2:7] + payload) == crc:
+                    try:
+                        obj = json.loads(zlib.decompress(payload).decode("utf-8"))
+                    except (zlib.error, ValueError):
+                        pass
+                    else:
+                        damaged = False
+                        yield kind.decode("ascii", "replace"), obj
+                        continue
+        if not damaged:
+            damaged = True
+            yield None, f"registro corrompido na posição {start}"
+        if not _resync(f, start + 1):
+            return
+
+
+# --- Exportação ---
+
+def export_campaign(app, path: str) -> dict:
+    """Grava a campanha do RPGApp em `path` (atômico: arquivo temporário + rename). Retorna as contagens."""
+    rules = app.data["global_rules"]
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for rule in rules:
+            write_record(f, "R", rule)
+        count = 0
+        for char in app.data["characters"]:
+            if char.get("segments") is None:
+                # ainda não aberto (SQLite): lê numa cópia para não deixá-lo carregado na memória
+                char = {"id": char["id"], "name": char["name"], "segments": None}
+                app.storage.load_character(char)
+            write_record(f, "C", char)
+            count += 1
+        write_record(f, "E", {"characters": count, "rules": len(rules)})
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return {"characters": count, "rules": len(rules)}
+
+
+# --- Importação ---
+
+@dataclass
+class ImportReport:
+    characters: int = 0
+    rules_added: int = 0
+    rules_merged: int = 0  # já existiam (mesmo id ou mesma definição)
+    rules_renamed: int = 0  # id já usado por outra regra: entram com id novo
+    dropped_rule_refs: int = 0  # active_rules apontando para regras que não vieram nem existiam
+    complete: bool = False  # o registro de fim foi lido
+    skipped: list = field(default_factory=list)  # mensagens dos registros pulados
+
+
+def _rule_signature(rule: dict) -> tuple:
+    return (rule.get("name"), rule.get("trigger_val"), rule.get("scope"), rule.get("effect"), rule.get("effect_param"))
+
+
+def _valid_rule(obj) -> bool:
+    if not isinstance(obj, dict) or not isinstance(obj.get("id"), str) or not isinstance(obj.get("name"), str):
+        return False
+    if type(obj.get("trigger_val")) is not int or obj.get("scope") not in ("any", "first"):
+        return False
+    if obj.get("effect") not in ("reroll", "add", "explode"):
+        return False
+    return obj.get("effect_param") is None or type(obj["effect_param"]) is int
+
+
+def _valid_character(obj) -> bool:
+    if not isinstance(obj, dict) or not isinstance(obj.get("name"), str) or not isinstance(obj.get("segments"), list):
+        return False
+    for seg in obj["segments"]:
+        if not isinstance(seg, dict) or not isinstance(seg.get("fields"), list):
+            return False
+        for f in seg["fields"]:
+            if not isinstance(f, dict) or not {"type", "name", "value"} <= f.keys():
+                return False
+    return True
+
+
+class _Importer:
+    """Estado da mesclagem: índices por id/definição montados uma vez, consultas O(1) por registro."""
+
+    def __init__(self, app):
+        self.app = app
+        self.report = ImportReport()
+        rules = app.data["global_rules"]
+        self.rule_ids = {r["id"] for r in rules}
+        self.by_signature = {_rule_signature(r): r["id"] for r in rules}
+        self.rule_map = {}  # id no arquivo -> id local
+        self.char_ids = {c["id"] for c in app.data["characters"]}
+        self.new_rules = []
+
+    def rule(self, rule: dict):
+        if not _valid_rule(rule):
+            name = rule.get("name") if isinstance(rule, dict) else None
+            self.report.skipped.append(f"regra inválida: {name or '?'}")
+            return
+        sig = _rule_signature(rule)
+        local = self.by_signature.get(sig)
+        if local is not None:
+            self.rule_map[rule["id"]] = local
+            self.report.rules_merged += 1
+            return
+        rule = dict(rule)
+        if rule["id"] in self.rule_ids:  # mesmo id, definição diferente
+            old_id, rule["id"] = rule["id"], new_id()
+            self.rule_map[old_id] = rule["id"]
+            self.report.rules_renamed += 1
+        else:
+            self.rule_map[rule["id"]] = rule["id"]
+            self.report.rules_added += 1
+        self.rule_ids.add(rule["id"])
+        self.by_signature[sig] = rule["id"]
+        self.new_rules.append(rule)
+
+    def end(self, counts: dict):
+        """Registro de fim: confere as contagens gravadas na exportação com o que entrou."""
+        self.report.complete = True
+        report = self.report
+        imported = {"characters": report.characters,
+                    "rules": report.rules_added + report.rules_merged + report.rules_renamed}
+        for key, label in (("characters", "personagens"), ("rules", "regras")):
+            expected = counts.get(key) if isinstance(counts, dict) else None
+            if type(expected) is int and expected != imported[key]:
+                report.skipped.append(f"o arquivo declara {expected} {label}, mas entraram {imported[key]}")
+
+    def commit_rules(self):
+        if self.new_rules:
+            self.app.import_rules(self.new_rules)
+            self.new_rules = []
+
+    def character(self, char: dict):
+        if not _valid_character(char):
+            name = char.get("name") if isinstance(char, dict) else None
+            self.report.skipped.append(f"personagem inválido: {name or '?'}")
+            return
+        fresh = char.get("id") in self.char_ids or "id" not in char
+        if fresh:  # cópia de um personagem que já está aqui: ids novos para não colidir
+            char["id"] = new_id()
+        for seg in char["segments"]:
+            if fresh or "id" not in seg:
+                seg["id"] = new_id()
+            seg.setdefault("name", "")
+            for f in seg["fields"]:
+                if fresh or "id" not in f:
+                    f["id"] = new_id()
+                if "active_rules" in f:
+                    f["active_rules"] = self._remap(f["active_rules"])
+        self.char_ids.add(char["id"])
+        self.app.import_character(char)
+        self.report.characters += 1
+
+    def _remap(self, rule_ids) -> list:
+        out = []
+        for rid in rule_ids if isinstance(rule_ids, list) else ():
+            local = self.rule_map.get(rid)
+            if local is None and rid in self.rule_ids:
+                local = rid  # a regra não veio no arquivo (registro perdido), mas já existe aqui
+            if local is None:
+                self.report.dropped_rule_refs += 1
+            elif local not in out:
+                out.append(local)
+        return out
+
+
+def _json_records(path: str):
+    """Campanha em JSON (rpg_data.json): não é streaming, mas passa pela mesma mesclagem."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ArchiveError("JSON sem a estrutura de campanha")
+    for rule in data.get("global_rules") or []:
+        yield "R", rule
+    for char in data.get("characters") or []:
+        yield "C", char
+    yield "E", {}
+
+
+def import_campaign(app, path: str) -> ImportReport:
+    """
+    Acrescenta as regras e os personagens de `path` (formato compacto ou JSON) à campanha do RPGApp.
+    Regras iguais às locais (mesmo id e definição, ou mesma definição) são reaproveitadas; um id já
+    usado por outra regra ganha id novo, e os active_rules dos personagens são remapeados.
+    Tudo entra num único storage.batch() (uma transação no SQLite): registros corrompidos são
+    pulados e relatados, mas um erro que interrompe a leitura não deixa meia importação gravada.
+    """
+    importer = _Importer(app)
+    with open(path, "rb") as f:
+        is_archive = f.read(len(MAGIC)) == MAGIC
+    f = open(path, "rb") if is_archive else None
+    records = iter_records(f) if is_archive else _json_records(path)
+    characters, rules = len(app.data["characters"]), len(app.data["global_rules"])
+    try:
+        with app.storage.batch():
+            _merge(importer, records)
+    except BaseException:
+        app.discard_import(characters, rules)
+        raise
+    finally:
+        if f is not None:
+            f.close()
+    return importer.report
+
+
+def _merge(importer: _Importer, records):
+    try:
+        for kind, obj in records:
+            if kind is None:
+                importer.report.skipped.append(obj)
+            elif kind == "R":
+                importer.rule(obj)
+            elif kind == "C":
+                importer.commit_rules()  # as regras vêm antes; grava todas de uma vez
+                importer.character(obj)
+            elif kind == "E":
+                importer.end(obj)
+    except UnicodeDecodeError:
+        raise ArchiveError("não é um arquivo de campanha do YourSheet")
+    except json.JSONDecodeError as e:
+        raise ArchiveError(f"JSON inválido: {e}")
+    importer.commit_rules()
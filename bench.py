@@ -0,0 +1,278 @@
+"""
+Benchmarks dos caminhos quentes: rolagem, regras, explosão, contexto, regras por id e persistência.
+
+    python bench.py --output base.json            # mede e grava a linha de base
+    python bench.py --compare base.json           # mede de novo e aponta regressões (sai com 1 se houver)
+    python bench.py --filter roll --quick
+
+Os dados vêm de campanhas sintéticas (make_campaign), geradas com seed fixo para que as medições
+sejam comparáveis entre execuções.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from dice_engine import DiceEngine, RuleTable
+from rpg_app import RPGApp
+from storage import new_id
+
+EFFECTS = ("reroll", "add", "explode")
+DEFAULT_THRESHOLD = 0.10  # 10% mais lento que a linha de base conta como regressão
+
+
+# --- Campanhas sintéticas ---
+
+def make_rules(n: int, rnd: random.Random, sides: int = 6) -> list:
+    return [{"id": new_id(), "name": f"Regra {i}", "trigger_val": rnd.randint(1, sides),
+             "scope": rnd.choice(("any", "first")), "effect": rnd.choice(EFFECTS),
+             "effect_param": rnd.randint(1, 3)} for i in range(n)]
+
+
+def make_campaign(characters: int = 20, segments: int = 5, fields: int = 10, rules: int = 20,
+                  rules_per_action: int = 3, seed: int = 0) -> dict:
+    """
+    Campanha sintética: personagens x segmentos x campos, com regras globais.
+    Os campos alternam Atributo (attr0, attr1, ...), Ação (fórmula com atributos e regras) e Texto.
+    """
+    rnd = random.Random(seed)
+    global_rules = make_rules(rules, rnd)
+    data = {"characters": [], "global_rules": global_rules}
+    for c in range(characters):
+        segs = []
+        attr_names = []
+        for s in range(segments):
+            seg_fields = []
+            for f in range(fields):
+                kind = f % 3
+                if kind == 0:
+                    name = f"attr{len(attr_names)}"
+                    attr_names.append(name)
+                    field = {"type": "Atributo", "name": name, "value": str(rnd.randint(-2, 5))}
+                elif kind == 1:
+                    formula = rnd.choice(("1d20", "2d6", "4d6dl1", "8d6dl2e6")) + f"+{rnd.choice(attr_names)}"
+                    rule_ids = [r["id"] for r in rnd.sample(global_rules, min(rules_per_action, len(global_rules)))]
+                    field = {"type": "Ação", "name": f"Ação {s}.{f}", "value": formula, "active_rules": rule_ids}
+                else:
+                    field = {"type": "Texto", "name": f"Nota {s}.{f}", "value": "lorem ipsum " * 4}
+                field["id"] = new_id()
+                seg_fields.append(field)
+            segs.append({"id": new_id(), "name": f"Segmento {s}", "fields": seg_fields})
+        data["characters"].append({"id": new_id(), "name": f"Personagem {c}", "segments": segs})
+    return data
+
+
+def write_campaign(path: str, data: dict):
+    """Grava a campanha no backend indicado pela extensão (.json ou .db)."""
+    app = RPGApp(path)
+    app.data = data
+    app.save_data()
+    app.storage.close()
+
+
+# --- Medição ---
+
+def measure(func, min_time: float = 0.2, repeat: int = 5) -> dict:
+    """Calibra o número de chamadas por amostra e devolve tempos por chamada em microssegundos."""
+    timer = time.perf_counter
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            func()
+        elapsed = timer() - start
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / repeat / elapsed) + 1))
+    samples = []
+    for _ in range(repeat):
+        start = timer()
+        for _ in range(number):
+            func()
+        samples.append((timer() - start) / number * 1e6)
+    return {"median_us": statistics.median(samples), "min_us": min(samples), "number": number, "repeat": repeat}
+
+
+# --- Conferência ---
+
+EDGE_FORMULAS = ("4d6dh0", "4d6dl0", "4d6dl4", "3d6dl1dh1", "2d6dh5", "4d6dh0e6")
+
+
+def check_distributions(engine: DiceEngine, n: int = 20_000):
+    """
+    A média exata (distribution) tem de bater com a do roll_many nos modificadores de borda (dh0, dl0,
+    descartar tudo): os dois caminhos interpretam a fórmula separadamente, e medir um deles errado não serve.
+    """
+    for formula in EDGE_FORMULAS:
+        dist = engine.distribution(formula, {})
+        totals = engine.roll_many(formula, {}, n=n, seed=0)
+        mean = sum(totals) / n
+        tolerance = 5 * (dist.variance() / n) ** 0.5 + 1e-9
+        if abs(mean - dist.mean()) > tolerance:
+            raise ValueError(f"{formula}: média exata {dist.mean():.3f}, roll_many {mean:.3f}")
+
+
+# --- Casos ---
+
+def bench_roll(engine: DiceEngine):
+    rnd = random.Random(1)
+    context = {"str": 3, "dex": 2, "prof": 2}
+    many_rules = RuleTable(make_rules(40, rnd))
+    few_rules = RuleTable(make_rules(3, rnd))
+    cases = {
+        "roll/1d20+str": ("1d20+str", []),
+        "roll/40d6": ("40d6", []),
+        "roll/8d6dl2e6": ("8d6dl2e6", []),
+        "roll/4d6dl1+3_rules": ("4d6dl1+dex", few_rules),
+        "roll/10d6+40_rules": ("10d6+str", many_rules),
+        "roll/profd6+str": ("profd6+str", []),
+    }
+    for name, (formula, rules) in cases.items():
+        error = engine.parse_and_roll(formula, context, rules).error
+        if error is not None:  # um caso que não rola mediria só o caminho de erro
+            raise ValueError(f"{name}: {error}")
+        yield name, lambda f=formula, r=rules: engine.parse_and_roll(f, context, r)
+
+
+def bench_rules(engine: DiceEngine):
+    rnd = random.Random(2)
+    table = RuleTable(make_rules(40, rnd))
+    rules = table.rules
+    dice = [rnd.randint(1, 6) for _ in range(10)]
+    yield "apply_custom_rules/10d6x40_table", lambda: engine.apply_custom_rules(list(dice), 6, table)
+    yield "apply_custom_rules/10d6x40_list", lambda: engine.apply_custom_rules(list(dice), 6, rules)
+    yield "explode/d6_on_6", lambda: engine._explode(6, 6, 6)
+    yield "explode/d6_on_2", lambda: engine._explode(6, 6, 2)
+
+
+def bench_app(tmpdir: str, size: dict):
+    app = RPGApp(os.path.join(tmpdir, "ctx.json"))
+    app.data = make_campaign(seed=3, **size)
+    app.reindex_rules()
+    char = app.character(0)
+    attr = next(f for seg in char["segments"] for f in seg["fields"] if f["type"] == "Atributo")
+    action = next(f for seg in char["segments"] for f in seg["fields"] if f["type"] == "Ação")
+    counter = [0]
+
+    def context_after_edit():
+        counter[0] += 1
+        app.update_field(attr["id"], value=str(counter[0] % 7))
+        return app.get_context(0)
+
+    def delete_and_undo():
+        app.delete_field(action["id"])
+        app.undo()
+
+    yield "get_context/cached", lambda: app.get_context(0)
+    yield "get_context/after_edit", context_after_edit
+    yield "delete_field+undo", delete_and_undo
+    many_ids = [r["id"] for r in app.data["global_rules"][::-1]]
+    yield "get_rules_by_ids/action", lambda: app.get_rules_by_ids(action["active_rules"])
+    yield "get_rules_by_ids/all_rules", lambda: app.get_rules_by_ids(many_ids)
+    app.storage.close()
+
+
+def bench_storage(tmpdir: str, size: dict):
+    data = make_campaign(seed=4, **size)
+    for ext in ("json", "db"):
+        path = os.path.join(tmpdir, f"campaign.{ext}")
+        write_campaign(path, json.loads(json.dumps(data)))
+        app = RPGApp(path)
+
+        def save(app=app):
+            app.save_data()
+            app.storage.flush()
+
+        def load_first(path=path):
+            other = RPGApp(path)
+            other.character(0)
+            other.storage.close()
+
+        yield f"load_data/{ext}", app.load_data
+        yield f"load_data+open_character/{ext}", load_first
+        yield f"save_data/{ext}", save
+        field = next(f for seg in app.character(0)["segments"] for f in seg["fields"] if f["type"] == "Atributo")
+
+        def edit(app=app, field=field):
+            app.update_field(field["id"], value="4")
+            app.storage.flush()
+
+        yield f"update_field+flush/{ext}", edit
+        # a lista de casos é consumida antes do próximo backend, então fechar aqui é seguro
+        yield None, app.storage.close
+
+
+def run(filter_text: str = None, quick: bool = False) -> dict:
+    size = dict(characters=10, segments=4, fields=9, rules=20) if quick else \
+        dict(characters=100, segments=6, fields=15, rules=60)
+    min_time = 0.05 if quick else 0.3
+    engine = DiceEngine()
+    check_distributions(engine)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cases in (bench_roll(engine), bench_rules(engine), bench_app(tmpdir, size), bench_storage(tmpdir, size)):
+            for name, func in cases:
+                if name is None:
+                    func()
+                    continue
+                if filter_text and filter_text not in name:
+                    continue
+                results[name] = measure(func, min_time=min_time)
+                print(f"{name:<36} {results[name]['median_us']:12.2f} us", file=sys.stderr)
+    return {"python": platform.python_version(), "platform": platform.platform(), "quick": quick,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "campaign": size, "results": results}
+
+
+def compare(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """Compara as medianas; retorna [(caso, base_us, atual_us, razão, situação)]."""
+    rows = []
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            rows.append((name, None, cur["median_us"], None, "novo"))
+            continue
+        ratio = cur["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+        status = "REGRESSÃO" if ratio > 1 + threshold else "melhor" if ratio < 1 - threshold else "ok"
+        rows.append((name, base["median_us"], cur["median_us"], ratio, status))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks do YourSheet.")
+    parser.add_argument("--output", help="grava o resultado em JSON neste arquivo")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="fração de lentidão tolerada antes de acusar regressão (padrão 0.10)")
+    parser.add_argument("--filter", help="só casos cujo nome contém este texto")
+    parser.add_argument("--quick", action="store_true", help="campanha menor e medições curtas")
+    args = parser.parse_args(argv)
+
+    result = run(args.filter, args.quick)
+    text = json.dumps(result, indent=4, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    elif not args.compare:
+        print(text)
+
+    if not args.compare:
+        return 0
+    with open(args.compare, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("quick") != result["quick"]:
+        print("aviso: a linha de base foi medida com outro modo (--quick)", file=sys.stderr)
+    rows = compare(result, baseline, args.threshold)
+    for name, base, cur, ratio, status in rows:
+        base_text = f"{base:12.2f}" if base is not None else " " * 12
+        ratio_text = f"{ratio:6.2f}x" if ratio is not None else " " * 7
+        print(f"{name:<36} {base_text} -> {cur:12.2f} us {ratio_text}  {status}")
+    return 1 if any(row[4] == "REGRESSÃO" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+from derived import Expression, ExpressionError, definition
+
+
+def _remove(owners: list, field: dict):
+    for i, owner in enumerate(owners):
+        if owner is field:
+            del owners[i]
+            return
+
+
+def attribute_value(field: dict):
+    """Valor inteiro literal de um campo Atributo, ou None se não for um número (expressões ficam de fora)."""
+    try:
+        return int(field["value"])
+    except (TypeError, ValueError):
+        return None
+
+
+CYCLE_ERROR = "referência circular"
+
+
+class CharacterContext:
+    """
+    Contexto de atributos de um personagem ({nome: int}) mantido incrementalmente.
+    `version` aumenta a cada mudança real em `values`, então quem guarda algo calculado a partir
+    do contexto (planos vinculados, distribuições, estatísticas da ficha) sabe quando está velho.
+
+    Um Atributo pode valer uma expressão sobre outros (derived.Expression, ex: "(str-10)/2").
+    As referências formam um grafo de dependências; ao mudar um atributo só ele e quem depende
+    dele (em ordem topológica, parando onde o valor não muda) são recalculados. Ciclos e
+    referências a atributos sem valor deixam o atributo fora de `values`, com o motivo em `errors`.
+    """
+
+    def __init__(self, char: dict):
+        self.char = char
+        self.values = {}
+        self.errors = {}  # nome -> por que o atributo está sem valor
+        self.version = 0
+        self._owners = {}  # nome -> campos Atributo com esse nome
+        self._by_lower = {}  # nome em minúsculas -> nomes reais (as expressões não diferenciam maiúsculas)
+        self._deps = {}  # nome -> nomes (minúsculos) usados pelas expressões dele
+        self._dependents = {}  # nome minúsculo -> nomes cujas expressões o usam
+        self._cyclic = set()  # atributos presos num ciclo (valem só o valor fixo, se houver)
+        self.rebuild()
+
+    def rebuild(self):
+        self._owners.clear()
+        self._by_lower.clear()
+        for name in list(self._deps):
+            self._set_deps(name, frozenset())
+        for seg in self.char["segments"]:
+            for field in seg["fields"]:
+                if field["type"] == "Atributo":
+                    self._add_owner(field)
+        stale = set(self.values) | set(self.errors)
+        self._update(set(self._owners) | stale)
+
+    # --- Estrutura do grafo ---
+
+    def _add_owner(self, field: dict):
+        name = field["name"]
+        owners = self._owners.get(name)
+        if owners is None:
+            owners = self._owners[name] = []
+            self._by_lower.setdefault(name.lower(), set()).add(name)
+        owners.append(field)
+
+    def _remove_owner(self, field: dict, name: str):
+        owners = self._owners.get(name)
+        if owners is None:
+            return
+        _remove(owners, field)
+        if not owners:
+            del self._owners[name]
+            names = self._by_lower.get(name.lower())
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._by_lower[name.lower()]
+
+    def _ordered_owners(self, name: str) -> list:
+        """Campos com esse nome na ordem da ficha (em nomes repetidos vale o último com valor)."""
+        owners = self._owners.get(name, [])
+        if len(owners) > 1:
+            order = {id(f): i for i, f in enumerate(f for seg in self.char["segments"] for f in seg["fields"])}
+            owners.sort(key=lambda f: order.get(id(f), -1))
+        return owners
+
+    def _set_deps(self, name: str, deps: frozenset):
+        old = self._deps.get(name, frozenset())
+        if old == deps:
+            return
+        for dep in old - deps:
+            users = self._dependents.get(dep)
+            if users is not None:
+                users.discard(name)
+                if not users:
+                    del self._dependents[dep]
+        for dep in deps - old:
+            self._dependents.setdefault(dep, set()).add(name)
+        if deps:
+            self._deps[name] = deps
+        else:
+            self._deps.pop(name, None)
+
+    def _refresh_deps(self, name: str):
+        deps = set()
+        for field in self._owners.get(name, ()):
+            d = definition(field["value"])
+            if isinstance(d, Expression):
+                deps.update(n.lower() for n in d.names)
+        self._set_deps(name, frozenset(deps))
+
+    def _dep_names(self, name: str):
+        """Nomes reais dos atributos dos quais `name` depende."""
+        for dep in self._deps.get(name, ()):
+            yield from self._by_lower.get(dep, ())
+
+    # --- Cálculo ---
+
+    def _lookup(self, ref: str):
+        if ref in self.values:
+            return self.values[ref]
+        for name in sorted(self._by_lower.get(ref.lower(), ())):
+            if name in self.values:
+                return self.values[name]
+        return None
+
+    def _evaluate(self, expr: Expression):
+        """(valor, erro) de uma expressão com os valores atuais."""
+        bound = {ref: self._lookup(ref) for ref in expr.names}
+        missing = sorted(ref for ref, val in bound.items() if val is None)
+        if missing:
+            return None, f"'{missing[0]}' sem valor"
+        try:
+            return expr.evaluate(bound), None
+        except ExpressionError as e:
+            return None, str(e)
+
+    def _compute(self, name: str):
+        """(valor, erro) do atributo: o último campo com esse nome que tiver valor."""
+        error = None
+        for field in reversed(self._ordered_owners(name)):
+            d = definition(field["value"])
+            if isinstance(d, int):
+                return d, None
+            if isinstance(d, Expression):
+                val, err = self._evaluate(d)
+                if val is not None:
+                    return val, None
+                error = error or err
+            elif isinstance(d, ExpressionError):
+                error = error or str(d)
+        return None, error
+
+    def _literal(self, name: str):
+        """Último valor fixo (int) entre os campos com esse nome, ignorando as expressões."""
+        for field in reversed(self._ordered_owners(name)):
+            d = definition(field["value"])
+            if isinstance(d, int):
+                return d
+        return None
+
+    def _store(self, name: str, val, error) -> bool:
+        """Grava o resultado; True se o valor ou o erro mudou."""
+        if error is None:
+            changed = self.errors.pop(name, None) is not None
+        else:
+            changed = self.errors.get(name) != error
+            self.errors[name] = error
+        if val is None:
+            if name in self.values:
+                del self.values[name]
+                return True
+            return changed
+        if self.values.get(name) != val:
+            self.values[name] = val
+            return True
+        return changed
+
+    def _users(self, name: str, within: set):
+        """Atributos (dentro de `within`) cujas expressões usam `name`."""
+        if name not in self._owners:
+            return ()  # nome que sumiu não é aresta de ninguém (ver _dep_names)
+        return [user for user in self._dependents.get(name.lower(), ()) if user in within]
+
+    def _topological(self, nodes: set):
+        """(ordem topológica de `nodes`, nós que ficaram de fora por estarem num ciclo ou depois de um)."""
+        pending = {name: sum(1 for dep in self._dep_names(name) if dep in nodes) for name in nodes}
+        ready = [name for name, count in pending.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            del pending[name]
+            for user in self._users(name, pending):
+                pending[user] -= 1
+                if pending[user] == 0:
+                    ready.append(user)
+        return order, set(pending)
+
+    def _in_cycle(self, name: str, nodes: set) -> bool:
+        seen = set()
+        stack = list(self._users(name, nodes))
+        while stack:
+            user = stack.pop()
+            if user == name:
+                return True
+            if user not in seen:
+                seen.add(user)
+                stack.extend(self._users(user, nodes))
+        return False
+
+    def _update(self, seeds: set):
+        """Recalcula `seeds` (definição mudou) e, em ordem topológica, quem depende deles."""
+        for name in seeds:
+            self._refresh_deps(name)
+
+        affected = set()
+        stack = list(seeds)
+        while stack:
+            name = stack.pop()
+            if name in affected:
+                continue
+            affected.add(name)
+            stack.extend(self._dependents.get(name.lower(), ()))
+
+        order, stuck = self._topological(affected)
+        # nomes que sumiram não aparecem em _dep_names: saem primeiro, antes de quem os usava
+        order.sort(key=lambda name: name in self._owners)
+        cyclic = {name for name in stuck if self._in_cycle(name, stuck)}
+        # quem só depende de um ciclo não está nele: calcula normalmente, depois dos ciclos
+        after, _ = self._topological(stuck - cyclic)
+
+        was_cyclic = self._cyclic & affected
+        self._cyclic -= affected
+        self._cyclic |= cyclic
+        changed = set()  # em minúsculas, como as referências em _deps
+        for name in cyclic:
+            # no ciclo só um valor fixo (o último) ainda vale
+            literal = self._literal(name)
+            if self._store(name, literal, CYCLE_ERROR if literal is None else None):
+                changed.add(name.lower())
+        for name in order + after:
+            if name in seeds or name in was_cyclic or not changed.isdisjoint(self._deps.get(name, ())):
+                if self._store(name, *self._compute(name)):
+                    changed.add(name.lower())
+        if changed:
+            self.version += 1
+
+    # --- Avisos de edição ---
+
+    def field_added(self, field: dict):
+        if field["type"] != "Atributo": return
+        self._add_owner(field)
+        self._update({field["name"]})
+
+    def field_removed(self, field: dict):
+        if field["type"] != "Atributo": return
+        self._remove_owner(field, field["name"])
+        self._update({field["name"]})
+
+    def value_changed(self, field: dict):
+        if field["type"] != "Atributo": return
+        self._update({field["name"]})
+
+    def name_changed(self, field: dict, old_name: str):
+        if field["type"] != "Atributo": return
+        self._remove_owner(field, old_name)
+        self._add_owner(field)
+        self._update({old_name, field["name"]})
+
+    def describe(self, field: dict):
+        """(valor, erro) do próprio campo, para a ficha mostrar o resultado de um atributo derivado."""
+        d = definition(field["value"])
+        if isinstance(d, int) or d is None:
+            return d, None
+        if isinstance(d, ExpressionError):
+            return None, str(d)
+        if field["name"] in self._cyclic:
+            return None, CYCLE_ERROR
+        return self._evaluate(d)
+
+
+class ContextCache:
+    """Um CharacterContext por personagem (chave = id), criado na primeira rolagem."""
+
+    def __init__(self):
+        self._by_char = {}
+
+    def get(self, char: dict) -> CharacterContext:
+        ctx = self._by_char.get(char["id"])
+        if ctx is None or ctx.char is not char:
+            ctx = CharacterContext(char)
+            self._by_char[char["id"]] = ctx
+        return ctx
+
+    def peek(self, char_id: str):
+        """Contexto já criado, ou None (usado pelos ganchos de edição para não construir à toa)."""
+        return self._by_char.get(char_id)
+
+    def drop(self, char_id: str):
+        self._by_char.pop(char_id, None)
@@ -0,0 +1,98 @@
+import ast
+from functools import lru_cache
+
+FUNCTIONS = {"min": min, "max": max, "abs": abs}
+MAX_EXPRESSION_LENGTH = 200
+
+_ALLOWED = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load,
+            ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.UAdd, ast.USub)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class _FloorDivision(ast.NodeTransformer):
+    """'/' nas fichas arredonda para baixo (ex: (str-10)/2 dá o modificador de D&D)."""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Div):
+            node.op = ast.FloorDiv()
+        return node
+
+
+class Expression:
+    """
+    Valor de um Atributo derivado, ex: "(str-10)/2" ou "prof + str_mod".
+    Só aceita inteiros, nomes de atributos, + - * / // %, parênteses e min/max/abs.
+    `names` são os atributos referenciados (as arestas do grafo de dependências).
+    """
+
+    __slots__ = ("source", "names", "_code")
+
+    def __init__(self, source: str, names: frozenset, code):
+        self.source = source
+        self.names = names
+        self._code = code
+
+    def evaluate(self, values: dict) -> int:
+        """values deve ter um inteiro para cada nome em `names`."""
+        try:
+            return int(eval(self._code, {"__builtins__": {}, **FUNCTIONS}, values))
+        except ZeroDivisionError:
+            raise ExpressionError("divisão por zero")
+
+
+@lru_cache(maxsize=1024)
+def _parse(text: str):
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        return ExpressionError("expressão longa demais")
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError:
+        return ExpressionError(f"expressão inválida '{text}'")
+
+    calls = set()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS) or node.keywords:
+                return ExpressionError("só min, max e abs podem ser chamadas")
+            calls.add(id(node.func))
+        elif isinstance(node, ast.Name):
+            if id(node) in calls:
+                continue
+            if node.id in FUNCTIONS:
+                return ExpressionError(f"'{node.id}' só pode ser usada como função")
+            names.add(node.id)
+        elif isinstance(node, ast.Constant):
+            if type(node.value) is not int:
+                return ExpressionError("só números inteiros")
+        elif not isinstance(node, _ALLOWED):
+            return ExpressionError(f"não permitido em atributo: {type(node).__name__}")
+
+    tree = ast.fix_missing_locations(_FloorDivision().visit(tree))
+    return Expression(text, frozenset(names), compile(tree, "<atributo>", "eval"))
+
+
+def parse_expression(text: str) -> Expression:
+    """Compila (com cache) a expressão de um atributo. Levanta ExpressionError se não for válida."""
+    result = _parse(text)
+    if isinstance(result, ExpressionError):
+        raise result
+    return result
+
+
+def definition(value):
+    """
+    Interpreta o valor de um campo Atributo: int (valor fixo), Expression (derivado),
+    ExpressionError (texto que não é uma expressão válida) ou None (vazio).
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    if not isinstance(value, str) or not value.strip():
+        return None
+    return _parse(value)
@@ -1,149 +1,823 @@
 import re
-from random import randint
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from math import log
+
+import instrument
+from rng import BufferedRandomSource, RandomSource, SeededRandomSource, make_source
+
+PLAN_CACHE_SIZE = 512
+DISTRIBUTION_CACHE_SIZE = 256
+DISTRIBUTION_BUDGET = 2_000_000  # custo estimado (probability.distribution_cost) acima do qual estimate_distribution amostra
+ESTIMATE_SAMPLES = 20_000
+TRUNCATION_TOLERANCE = 1e-9  # chance de corte nas explosões acima da qual a distribuição exata não vale
+EXPLODE_MAX_DEPTH = 100  # máximo de dados extras numa cadeia de explosão
+EXPLODE_DICE_BUDGET = 1000  # máximo de dados extras (explosões nativas + regras) numa rolagem
+
+_SPLIT_RE = re.compile(r'([+-])')
+_DICE_RE = re.compile(r'(\d+)d(\d+)(.*)')
+_NAME_RE = re.compile(r'[^\W\d]\w*')
+_SLOT_DICE_RE = re.compile(r'(\d+|[^\W\d]\w*?)d(\d+|[^\W\d]\w*?)((?:dl\d+|dh\d+|e\d+)*)')
+_DL_RE = re.compile(r'dl(\d+)')
+_DH_RE = re.compile(r'dh(\d+)')
+_EXPLODE_RE = re.compile(r'e(\d+)')
+
+
+class LRUCache:
+    """Cache LRU simples e limitado (usado para planos de fórmula e afins)."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+@dataclass(frozen=True, slots=True)
+class DiceTerm:
+    sign: str
+    qtd: int | str  # str = nome da variável que dá a quantidade (ex: profd6)
+    lados: int | str
+    mods: str
+    drop_low: int = 0
+    drop_high: int = 0
+    explode: int | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class ConstTerm:
+    sign: str
+    value: int
+
+
+@dataclass(frozen=True, slots=True)
+class VarTerm:
+    sign: str
+    name: str
+
+
+@dataclass(frozen=True, slots=True)
+class FormulaPlan:
+    """
+    Fórmula já interpretada: lista de termos pronta para rolar.
+    Variáveis ficam como slots nomeados (VarTerm) e são resolvidas no contexto na hora da rolagem;
+    a quantidade e as faces de um dado também podem ser slots (profd6, 2dn), e aí `dynamic` é True.
+    """
+    source: str
+    terms: tuple
+    var_names: tuple
+    dynamic: bool = False
+
+    def bind(self, context: dict) -> dict:
+        """Resolve os slots de variável no contexto (nomes sem diferenciar maiúsculas)."""
+        if not self.var_names:
+            return {}
+        bound = {}
+        lowered = None
+        for name in self.var_names:
+            if name in context:
+                bound[name] = int(context[name])
+                continue
+            if lowered is None:
+                lowered = {str(k).lower(): v for k, v in context.items()}
+            if name not in lowered:
+                raise ValueError(f"variável desconhecida '{name}'")
+            bound[name] = int(lowered[name])
+        return bound
+
+    def resolve(self, bound: dict) -> tuple:
+        """Os termos com os slots de dado trocados pelos valores de bind() (os próprios termos se não há slots)."""
+        if not self.dynamic:
+            return self.terms
+        terms = []
+        for term in self.terms:
+            if isinstance(term, DiceTerm) and (isinstance(term.qtd, str) or isinstance(term.lados, str)):
+                qtd = bound[term.qtd] if isinstance(term.qtd, str) else term.qtd
+                lados = bound[term.lados] if isinstance(term.lados, str) else term.lados
+                if qtd < 0:
+                    raise ValueError(f"quantidade de dados inválida em '{term.qtd}d{term.lados}' ({qtd})")
+                if lados < 1:
+                    raise ValueError(f"dado sem faces em '{term.qtd}d{term.lados}' ({lados})")
+                term = replace(term, qtd=qtd, lados=lados)
+            terms.append(term)
+        return tuple(terms)
+
+
+def compile_formula(formula: str) -> FormulaPlan:
+    """
+    Transforma o texto da fórmula em um FormulaPlan reutilizável.
+    Levanta ValueError se algum termo não for reconhecido.
+    """
+    normalized = formula.lower().replace(" ", "")
+    parts = _SPLIT_RE.split(normalized)
+    if parts[0] != '-' and parts[0] != '+':
+        parts.insert(0, '+')
+
+    terms = []
+    var_names = []
+    dynamic = False
+    for i in range(0, len(parts), 2):
+        operator = parts[i]
+        chunk = parts[i + 1]
+        if not chunk: continue
+
+        if chunk.isdigit():
+            terms.append(ConstTerm(operator, int(chunk)))
+            continue
+
+        match = _SLOT_DICE_RE.fullmatch(chunk)
+        if match and not (match.group(1).isdigit() or match.group(2).isdigit()):
+            match = None  # "strdex" é uma variável, não str d ex: só um dos lados pode ser nome
+        if match is None and _NAME_RE.fullmatch(chunk):
+            terms.append(VarTerm(operator, chunk))
+            if chunk not in var_names:
+                var_names.append(chunk)
+        else:
+            match = match or _DICE_RE.search(chunk)
+            if not match:
+                raise ValueError(f"termo inválido '{chunk}'")
+            mods = match.group(3)
+            drop_low = drop_high = 0
+            explode = None
+            if 'dl' in mods:
+                drop_low = int(_DL_RE.search(mods).group(1))
+            if 'dh' in mods:
+                drop_high = int(_DH_RE.search(mods).group(1))
+            if 'e' in mods:
+                explode = int(_EXPLODE_RE.search(mods).group(1))
+            qtd, lados = (int(slot) if slot.isdigit() else slot for slot in match.group(1, 2))
+            if isinstance(lados, int) and lados < 1:
+                raise ValueError(f"dado sem faces '{chunk}'")
+            for slot in (qtd, lados):
+                if isinstance(slot, str):
+                    dynamic = True
+                    if slot not in var_names:
+                        var_names.append(slot)
+            terms.append(DiceTerm(operator, qtd, lados, mods, drop_low, drop_high, explode))
+
+    return FormulaPlan(normalized, tuple(terms), tuple(var_names), dynamic)
+
+
+class RuleTable:
+    """
+    Conjunto de regras de uma ação compilado em tabela: (escopo, face) -> efeitos em ordem.
+    O escopo "first" (primeiro dado) já inclui as regras "any"; os outros dados usam "any".
+    Cada entrada guarda (ordens, efeitos) para achar com bisect a próxima regra depois de um reroll.
+    """
+
+    __slots__ = ("rules", "table")
+
+    def __init__(self, active_rules: list):
+        self.rules = list(active_rules)
+        table = {}
+        for order, rule in enumerate(self.rules):
+            if rule["scope"] == "any":
+                scopes = ("first", "any")
+            elif rule["scope"] == "first":
+                scopes = ("first",)
+            else:
+                continue
+            effect = (order, rule["effect"], int(rule.get("effect_param") or 0), rule["name"])
+            face = int(rule["trigger_val"])
+            for scope in scopes:
+                orders, effects = table.setdefault((scope, face), ([], []))
+                orders.append(order)
+                effects.append(effect)
+        self.table = table
+
+    def __bool__(self):
+        return bool(self.table)
+
+
+def render_rule_events(events: list) -> str:
+    """Texto do log das regras (mesmo formato de sempre) a partir dos eventos registrados."""
+    parts = []
+    for _, effect, name, before, amount in events:
+        if effect == "reroll":
+            parts.append(f"[Regra '{name}': {before}->{amount}] ")
+        elif effect == "add":
+            parts.append(f"[Regra '{name}': +{amount}] ")
+        elif amount is None:
+            parts.append(f"[Regra '{name}': Explosão ignorada (limite de dados)] ")
+        else:
+            parts.append(f"[Regra '{name}': Explodiu +{amount}] ")
+    return "".join(parts)
+
+
+class TermRecord:
+    """
+    Um termo já rolado. Nos dados guarda o pool depois das regras (`rolls`), os eventos das regras
+    ((dado, efeito, regra, valor antes, valor/extra)), o extra da explosão nativa e se ela foi truncada;
+    o que dl/dh descartou é recalculado de `rolls` quando alguém pergunta (kept/render).
+    Em constantes e variáveis, só sign e value (value já positivo, sign já invertido se preciso).
+    """
+
+    __slots__ = ("sign", "term", "value", "rolls", "events", "explosion", "truncated")
+
+    def __init__(self, sign: str, term, value: int, rolls: tuple = None, events: list = None,
+                 explosion: int = 0, truncated: bool = False):
+        self.sign = sign
+        self.term = term
+        self.value = value
+        self.rolls = rolls
+        self.events = events
+        self.explosion = explosion
+        self.truncated = truncated
+
+    @property
+    def kept(self) -> list:
+        """Dados que entram na soma depois de dl/dh (sem a explosão)."""
+        kept = sorted(self.rolls)
+        if 'dl' in self.term.mods:
+            kept = kept[self.term.drop_low:]
+        if 'dh' in self.term.mods:
+            kept = kept[:max(len(kept) - self.term.drop_high, 0)]  # dh0 não descarta nada
+        return kept
+
+    def render(self) -> str:
+        if self.rolls is None:
+            return f"{self.sign} {self.value}"
+        term = self.term
+        text = f"[{','.join(map(str, self.rolls))}]"
+        rules_log = render_rule_events(self.events)
+        if rules_log:
+            text += f" {rules_log}"
+        kept = sorted(self.rolls)
+        if 'dl' in term.mods:
+            kept = kept[term.drop_low:]
+            text += f"->dl{term.drop_low}->[{','.join(map(str, kept))}]"
+        if 'dh' in term.mods:
+            kept = kept[:max(len(kept) - term.drop_high, 0)]
+            text += f"->dh{term.drop_high}->[{','.join(map(str, kept))}]"
+        if self.explosion > 0:
+            text += f"+Exp({self.explosion})"
+        if self.truncated:
+            text += " [explosão truncada no limite]"
+        return f"{self.sign} {term.qtd}d{term.lados}{term.mods}: {text}"
+
+    def to_dict(self) -> dict:
+        if self.rolls is None:
+            item = {"sign": self.sign, "value": self.value}
+            if isinstance(self.term, VarTerm):
+                item["name"] = self.term.name
+            return item
+        term = self.term
+        return {"sign": self.sign, "dice": f"{term.qtd}d{term.lados}{term.mods}", "value": self.value,
+                "rolls": list(self.rolls), "kept": self.kept,
+                "rules": [{"die": i, "effect": effect, "rule": name, "before": before, "amount": amount}
+                          for i, effect, name, before, amount in self.events],
+                "explosion": self.explosion, "truncated": self.truncated}
+
+
+class RollResult:
+    """
+    Resultado de parse_and_roll. Desempacota como a tupla (total, log) de sempre, mas o texto só é
+    montado quando pedido (.text ou result[1]) e fica guardado. `terms` traz um TermRecord por termo
+    (None com detail=False, que não registra nada). rng_name/seed/offset dizem de onde vieram os
+    números, para refazer a rolagem com DiceEngine.replay.
+    """
+
+    __slots__ = ("total", "terms", "error", "rng_name", "seed", "offset", "_text")
+
+    def __init__(self, total: int, terms: list = None, rng_name: str = None, seed=None, offset=None,
+                 error: str = None):
+        self.total = total
+        self.terms = terms
+        self.error = error
+        self.rng_name = rng_name
+        self.seed = seed
+        self.offset = offset
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self.error is not None:
+                self._text = f"Erro na fórmula: {self.error}"
+            elif self.terms is None:
+                self._text = ""
+            else:
+                self._text = " ".join(record.render() for record in self.terms)
+        return self._text
+
+    log = text
+
+    def to_dict(self) -> dict:
+        """Versão estruturada (JSON) para bots e outros consumidores."""
+        result = {"total": self.total}
+        if self.error is not None:
+            result["error"] = self.error
+        if self.terms is not None:
+            result["terms"] = [record.to_dict() for record in self.terms]
+        return result
+
+    def __iter__(self):
+        yield self.total
+        yield self.text
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        if index in (0, -2):
+            return self.total
+        if index in (1, -1):
+            return self.text
+        return (self.total, self.text)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (RollResult, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"RollResult({self.total!r}, {self.text!r})"
+
+
+def _rule_list(active_rules) -> list:
+    return active_rules.rules if isinstance(active_rules, RuleTable) else active_rules
+
+
+def _rules_key(active_rules: list) -> tuple:
+    return tuple((r["id"], int(r["trigger_val"]), r["scope"], r["effect"], r.get("effect_param"))
+                 for r in active_rules)
 
 
 class DiceEngine:
-    def __init__(self):
-        pass
+    def __init__(self, plan_cache_size: int = PLAN_CACHE_SIZE, explode_max_depth: int = EXPLODE_MAX_DEPTH,
+                 explode_budget: int = EXPLODE_DICE_BUDGET, rng: RandomSource = None):
+        self._plans = LRUCache(plan_cache_size)
+        self._distributions = LRUCache(DISTRIBUTION_CACHE_SIZE)
+        self.rng = rng if rng is not None else BufferedRandomSource()
+        self.explode_max_depth = explode_max_depth
+        self.explode_budget = explode_budget
+
+    def compile(self, formula: str) -> FormulaPlan:
+        """Retorna o plano da fórmula, reaproveitando o cache LRU (chave = texto da fórmula)."""
+        plan = self._plans.get(formula)
+        if plan is None:
+            plan = compile_formula(formula)
+            self._plans.put(formula, plan)
+        return plan
+
+    def distribution(self, formula: str, context: dict, active_rules: list = [], explode_depth: int = None):
+        """
+        Distribuição exata do total da fórmula (probability.Distribution), sem amostragem.
+        Memoizada por (fórmula, regras, valores das variáveis usadas), então redesenhar a ficha é barato.
+        Levanta ValueError se a fórmula for inválida.
+        """
+        from probability import formula_distribution
+
+        active_rules = _rule_list(active_rules)
+        plan = self.compile(formula)
+        bound = plan.bind(context)
+        depth = self.explode_max_depth if explode_depth is None else explode_depth  # o mesmo corte das rolagens
+        key = (formula, _rules_key(active_rules), tuple(sorted(bound.items())), depth)
+
+        dist = self._distributions.get(key)
+        if dist is None:
+            dist = formula_distribution(plan, bound, active_rules, depth)
+            self._distributions.put(key, dist)
+        return dist
+
+    def estimate_distribution(self, formula: str, context: dict, active_rules: list = [],
+                              budget: int = DISTRIBUTION_BUDGET, samples: int = ESTIMATE_SAMPLES):
+        """
+        A distribution() exata quando o custo estimado cabe em `budget`; acima dele (ex: 10d10dl3e1,
+        60d20dl1), uma estimativa com `samples` rolagens do roll_many (Distribution.samples > 0).
+        Também amostra quando a exata chega ao corte de profundidade das explosões (ex: 4d6e1): lá o
+        orçamento de dados extras por rolagem, que a PMF não modela, pode mudar o resultado.
+        A amostra usa seed fixa e fica no mesmo cache, então redesenhar a ficha não muda os números.
+        Levanta ValueError se a fórmula for inválida.
+        """
+        from probability import distribution_cost, sampled_distribution
+
+        active_rules = _rule_list(active_rules)
+        plan = self.compile(formula)
+        bound = plan.bind(context)
+        if distribution_cost(plan, bound, self.explode_max_depth) <= budget:
+            dist = self.distribution(formula, context, active_rules)
+            if dist.truncated <= TRUNCATION_TOLERANCE:
+                return dist
+
+        key = ("amostra", formula, _rules_key(active_rules), tuple(sorted(bound.items())), samples)
+        dist = self._distributions.get(key)
+        if dist is None:
+            dist = sampled_distribution(self.roll_many(formula, bound, active_rules, n=samples, seed=0))
+            self._distributions.put(key, dist)
+        return dist
 
     def _roll_single_die(self, faces):
-        return randint(1, faces)
+        return self.rng.roll(faces)
 
     def _explode(self, current_value, faces, threshold):
-        extra_val = 0
-        if current_value >= threshold:
-            new_roll = self._roll_single_die(faces)
-            extra_val = new_roll + self._explode(new_roll, faces, threshold)
-        return extra_val
+        """Extra somado pela cadeia de explosão de um dado (0 se não bateu o alvo)."""
+        if current_value < threshold:
+            return 0
+        return self._explode_chain(faces, threshold, [self.explode_budget])[0]
+
+    def _explode_chain(self, faces, threshold, budget: list) -> tuple[int, bool]:
+        """
+        Cadeia de explosão nativa, sem recursão. O dado inicial já bateu o alvo, então o primeiro
+        extra sempre sai; o número de extras seguintes que também batem o alvo é sorteado direto
+        da distribuição geométrica, e só depois os valores (>= alvo nos sucessos, < alvo no último).
+        A cadeia para em explode_max_depth dados ou quando budget[0] (dados restantes na rolagem) acaba.
+        Retorna (extra total, truncada?).
+        """
+        hit = min(max(faces - max(threshold, 1) + 1, 0) / faces, 1.0)
+        if hit >= 1.0:
+            chained = None  # sempre explode: só o limite para a cadeia
+        elif hit <= 0.0:
+            chained = 0
+        else:
+            chained = int(log(1.0 - self.rng.random()) / log(hit))
 
-    def apply_custom_rules(self, rolagens: list, sides: int, active_rules: list) -> tuple[list, int, str]:
+        limit = min(self.explode_max_depth, budget[0])
+        wanted = None if chained is None else chained + 1
+        truncated = wanted is None or wanted > limit
+        count = limit if truncated else wanted
+        budget[0] -= count
+        if count <= 0:
+            return 0, truncated
+
+        low = max(threshold, 1)
+        randint_ = self.rng.randint
+        successes = count if truncated else count - 1
+        extra = sum(randint_(low, faces) for _ in range(successes))
+        if not truncated:
+            extra += randint_(1, min(low - 1, faces))
+        return extra, truncated
+
+    def _rule_extra_die(self, sides, budget: list):
+        """Dado extra do efeito 'explode' das regras; usa o mesmo orçamento das explosões nativas."""
+        if budget[0] <= 0:
+            return None
+        budget[0] -= 1
+        return self._roll_single_die(sides)
+
+    def apply_custom_rules(self, rolagens: list, sides: int, active_rules, budget: list = None) -> tuple[list, int, str]:
         """
         Aplica regras condicionais (ex: Rolar novamente se der 1).
+        active_rules pode ser a lista de regras ou um RuleTable já compilado (mais rápido).
+        budget é o orçamento de dados extras da rolagem ([restantes]), compartilhado com as explosões.
         Retorna: (Lista de Dados Modificada, Bonus Extra Numérico, Log de Texto)
         """
-        log_rules = ""
+        events = []
+        rolagens, bonus_total = self._apply_rules(rolagens, sides, active_rules, budget, events)
+        return rolagens, bonus_total, render_rule_events(events)
+
+    def _apply_rules(self, rolagens: list, sides: int, active_rules, budget: list = None,
+                     events: list = None) -> tuple[list, int]:
+        """
+        Núcleo do apply_custom_rules: altera `rolagens` e retorna (dados, bônus).
+        Se `events` for uma lista, registra nela (dado, efeito, regra, valor antes, valor/extra) de
+        cada regra aplicada; com None não registra nada (caminho rápido das simulações).
+        """
         bonus_total = 0
+        if budget is None:
+            budget = [self.explode_budget]
+        rules = active_rules if isinstance(active_rules, RuleTable) else RuleTable(active_rules)
+        if not rules:
+            return rolagens, bonus_total
+        table = rules.table
 
-        # Iteramos sobre uma cópia para poder modificar a original com segurança
         for i, val in enumerate(rolagens):
-            # Para cada dado, verificamos todas as regras ativas
-            for rule in active_rules:
-
-                # 1. Checa o Escopo (Primeiro Dado ou Qualquer Dado)
-                is_target = False
-                if rule["scope"] == "any":
-                    is_target = True
-                elif rule["scope"] == "first" and i == 0:
-                    is_target = True
-
-                # 2. Checa o Gatilho (Valor do dado == Valor da regra)
-                if is_target and val == int(rule["trigger_val"]):
-
-                    # 3. Aplica o Efeito
-                    if rule["effect"] == "reroll":
-                        new_val = self._roll_single_die(sides)
-                        log_rules += f"[Regra '{rule['name']}': {val}->{new_val}] "
-                        rolagens[i] = new_val  # Substitui o valor
-                        val = new_val  # Atualiza para próximas checagens
-
-                    elif rule["effect"] == "add":
-                        bonus = int(rule["effect_param"])
-                        bonus_total += bonus
-                        log_rules += f"[Regra '{rule['name']}': +{bonus}] "
-
-                    elif rule["effect"] == "explode":
-                        # Rola um novo dado e soma ao TOTAL (não substitui o atual)
-                        extra = self._roll_single_die(sides)
+            # 1. Escopo: o primeiro dado vê as regras "first" e "any"; os outros só "any"
+            scope = "first" if i == 0 else "any"
+            entry = table.get((scope, val))
+            next_order = 0
+
+            # 2. Gatilho: só olhamos as regras cuja face bate com o valor atual, na ordem original
+            while entry is not None:
+                orders, effects = entry
+                pos = bisect_left(orders, next_order)
+                if pos == len(orders):
+                    break
+                order, effect, param, name = effects[pos]
+                next_order = order + 1
+
+                # 3. Aplica o Efeito
+                if effect == "reroll":
+                    new_val = self._roll_single_die(sides)
+                    if events is not None: events.append((i, effect, name, val, new_val))
+                    rolagens[i] = new_val  # Substitui o valor
+                    val = new_val  # Atualiza para próximas checagens
+                    entry = table.get((scope, val))
+
+                elif effect == "add":
+                    bonus_total += param
+                    if events is not None: events.append((i, effect, name, val, param))
+
+                elif effect == "explode":
+                    # Rola um novo dado e soma ao TOTAL (não substitui o atual); None = sem orçamento
+                    extra = self._rule_extra_die(sides, budget)
+                    if extra is not None:
                         bonus_total += extra
-                        log_rules += f"[Regra '{rule['name']}': Explodiu +{extra}] "
+                    if events is not None: events.append((i, effect, name, val, extra))
 
-        return rolagens, bonus_total, log_rules
+        return rolagens, bonus_total
 
-    def parse_and_roll(self, formula: str, context: dict, active_rules: list = []) -> tuple[int, str]:
+    def roll_many(self, formula: str, context: dict, active_rules: list = [], n: int = 1000, seed=None):
         """
-        Agora aceita active_rules: lista de dicionários com as regras selecionadas.
+        Rola a fórmula n vezes de uma só vez e retorna todos os totais (array NumPy de int64).
+        O pool de dados de todas as tentativas é gerado numa matriz (n x qtd) e as regras
+        customizadas viram operações com máscara. Com o mesmo seed o resultado é reproduzível;
+        sem seed, ele é tirado da fonte de números do engine (então um engine semeado também reproduz).
+        Sem NumPy instalado, cai para o caminho escalar (retorna uma lista).
+        Levanta ValueError se a fórmula for inválida.
         """
-        formula = formula.lower().replace(" ", "")
+        plan = self.compile(formula)
+        bound = plan.bind(context)
+        active_rules = _rule_list(active_rules)
 
-        for attr_name, attr_val in context.items():
-            if attr_name.lower() in formula:
-                formula = formula.replace(attr_name.lower(), str(attr_val))
+        if seed is None:
+            seed = int(self.rng.random() * (1 << 53))
 
         try:
-            parts = re.split(r'([+-])', formula)
-            if parts[0] != '-' and parts[0] != '+':
-                parts.insert(0, '+')
-
-            total_geral = 0
-            log_detalhado = []
-
-            for i in range(0, len(parts), 2):
-                operator = parts[i]
-                chunk = parts[i + 1]
-                if not chunk: continue
-
-                valor_parcial = 0
-                detalhe_parcial = ""
-
-                if 'd' in chunk:
-                    match = re.search(r'(\d+)d(\d+)(.*)', chunk)
-                    if match:
-                        qtd = int(match.group(1))
-                        lados = int(match.group(2))
-                        mods = match.group(3)
-
-                        # 1. Rolagem Inicial
-                        rolagens = [self._roll_single_die(lados) for _ in range(qtd)]
-
-                        # 2. APLICAR REGRAS CUSTOMIZADAS (NOVIDADE)
-                        # Elas acontecem antes de ordenar ou dropar
-                        rolagens, rules_bonus, rules_log = self.apply_custom_rules(rolagens, lados, active_rules)
-
-                        # Preparar string de log
-                        log_dados = f"[{','.join(map(str, rolagens))}]"
-                        if rules_log:
-                            log_dados += f" {rules_log}"
-
-                        # 3. Lógica padrão (Drop/Keep/Explode Nativo)
-                        rolagens.sort()
-
-                        if 'dl' in mods:
-                            drop_n = int(re.search(r'dl(\d+)', mods).group(1))
-                            rolagens = rolagens[drop_n:]
-                            log_dados += f"->dl{drop_n}->[{','.join(map(str, rolagens))}]"
-
-                        if 'dh' in mods:
-                            drop_n = int(re.search(r'dh(\d+)', mods).group(1))
-                            rolagens = rolagens[:-drop_n] if drop_n < len(rolagens) else []
-                            log_dados += f"->dh{drop_n}->[{','.join(map(str, rolagens))}]"
-
-                        soma_dados = sum(rolagens)
-
-                        # Explode nativo (e)
-                        if 'e' in mods:
-                            explode_target = int(re.search(r'e(\d+)', mods).group(1))
-                            explosao_acumulada = 0
-                            for r in rolagens:
-                                if r >= explode_target:
-                                    explosao_acumulada += self._explode(r, lados, explode_target)
-                            if explosao_acumulada > 0:
-                                log_dados += f"+Exp({explosao_acumulada})"
-                                soma_dados += explosao_acumulada
-
-                        valor_parcial = soma_dados + rules_bonus
-                        detalhe_parcial = f"{qtd}d{lados}{mods}: {log_dados}"
-                else:
-                    valor_parcial = int(chunk)
-                    detalhe_parcial = str(valor_parcial)
+            import numpy as np
+        except ImportError:
+            return self._roll_many_scalar(plan, bound, active_rules, n, seed)
 
-                if operator == '+':
-                    total_geral += valor_parcial
-                    log_detalhado.append(f"+ {detalhe_parcial}")
-                else:
-                    total_geral -= valor_parcial
-                    log_detalhado.append(f"- {detalhe_parcial}")
+        rng = np.random.default_rng(seed)
+        totals = np.zeros(n, dtype=np.int64)
+        remaining = np.full(n, self.explode_budget, dtype=np.int64)  # dados extras de cada tentativa
+        for term in plan.resolve(bound):
+            if isinstance(term, DiceTerm):
+                partial = self._roll_term_many(np, rng, term, active_rules, n, remaining)
+            elif isinstance(term, VarTerm):
+                partial = bound[term.name]
+            else:
+                partial = term.value
+
+            if term.sign == '+':
+                totals += partial
+            else:
+                totals -= partial
+        return totals
+
+    def _roll_term_many(self, np, rng, term: DiceTerm, active_rules: list, n: int, remaining):
+        """
+        Versão vetorizada de um termo NdM: retorna o valor parcial de cada tentativa.
+        `remaining` é o orçamento de dados extras de cada tentativa (compartilhado entre os termos,
+        como no caminho escalar) e é consumido aqui pelas explosões das regras e pelas nativas.
+        """
+        lados = term.lados
+        pool = rng.integers(1, lados + 1, size=(n, term.qtd))
+        bonus = np.zeros(n, dtype=np.int64)
+        explosions = []  # dados extras (n x qtd, 0 = não explodiu) de cada regra 'explode', na ordem
+
+        # Regras na mesma ordem do caminho escalar: cada dado passa por todas as regras em
+        # sequência, e dados diferentes são independentes, então dá para vetorizar por regra.
+        for rule in active_rules:
+            if rule["scope"] == "any":
+                view = pool
+            elif rule["scope"] == "first":
+                view = pool[:, :1]
+            else:
+                continue
+
+            mask = view == int(rule["trigger_val"])
+            hits = int(mask.sum())
+            if not hits:
+                continue
+
+            if rule["effect"] == "reroll":
+                view[mask] = rng.integers(1, lados + 1, size=hits)
+            elif rule["effect"] == "add":
+                bonus += mask.sum(axis=1) * int(rule["effect_param"])
+            elif rule["effect"] == "explode":
+                extra = np.zeros(pool.shape, dtype=np.int64)
+                extra[:, :view.shape[1]][mask] = rng.integers(1, lados + 1, size=hits)
+                explosions.append(extra)
+
+        if explosions:
+            # O escalar gasta o orçamento dado a dado e, em cada dado, regra a regra: nessa ordem,
+            # só os primeiros `remaining` extras de cada tentativa saem
+            extras = np.stack(explosions, axis=2).reshape(n, -1)
+            rolled = extras > 0
+            allowed = rolled & (np.cumsum(rolled, axis=1) <= remaining[:, None])
+            bonus += np.where(allowed, extras, 0).sum(axis=1)
+            remaining -= allowed.sum(axis=1)
+
+        kept = pool
+        if 'dl' in term.mods or 'dh' in term.mods:
+            kept = np.sort(pool, axis=1)
+            if 'dl' in term.mods:
+                kept = kept[:, term.drop_low:]
+            if 'dh' in term.mods:
+                drop_n = term.drop_high
+                kept = kept[:, :max(kept.shape[1] - drop_n, 0)]
+
+        partial = kept.sum(axis=1) + bonus
+
+        # Explode nativo: cada dado mantido >= alvo abre uma cadeia; rolamos todas as cadeias
+        # ainda ativas de uma vez por rodada, respeitando a profundidade e o orçamento por tentativa.
+        if term.explode is not None:
+            target = term.explode
+            trials = np.arange(n)
+            active = (kept >= target).sum(axis=1)
+            for _ in range(self.explode_max_depth):
+                active = np.minimum(active, remaining)
+                if not active.any():
+                    break
+                remaining -= active
+                owner = np.repeat(trials, active)
+                rolls = rng.integers(1, lados + 1, size=owner.size)
+                partial += np.bincount(owner, weights=rolls, minlength=n).astype(np.int64)
+                active = np.bincount(owner[rolls >= target], minlength=n)
+
+        return partial
 
-            return total_geral, " ".join(log_detalhado)
+    def _roll_many_scalar(self, plan: FormulaPlan, bound: dict, active_rules: list, n: int, seed=None) -> list:
+        """Fallback sem NumPy: rola n vezes pelo caminho escalar com uma fonte semeada própria."""
+        engine = DiceEngine(explode_max_depth=self.explode_max_depth, explode_budget=self.explode_budget,
+                            rng=SeededRandomSource(seed))
+        engine._plans.put(plan.source, plan)
+        return [engine.parse_and_roll(plan.source, bound, active_rules, detail=False).total for _ in range(n)]
 
+    def parse_and_roll(self, formula: str, context: dict, active_rules: list = [], detail: bool = True) -> RollResult:
+        """
+        Agora aceita active_rules: lista de dicionários com as regras selecionadas (ou um RuleTable).
+        A fórmula é compilada uma vez (cache LRU) e as variáveis são resolvidas pelo nome.
+        Retorna um RollResult (desempacota como (total, log)); o log só é montado se alguém o ler.
+        detail=False não registra dados nem regras (só o total), para quem rola muitas vezes.
+        """
+        if instrument.enabled:
+            return self._measured_roll(formula, context, active_rules, detail)
+        rng_name, seed, offset = self.rng.name, self.rng.seed, self.rng.tell()
+        try:
+            plan = self.compile(formula)
+            bound = plan.bind(context)
+            if not isinstance(active_rules, RuleTable):
+                active_rules = RuleTable(active_rules)
+            total, records = self._roll_plan(plan, bound, active_rules, detail)
+            return RollResult(total, records, rng_name, seed, offset)
+
+        except Exception as e:
+            return RollResult(0, None, rng_name, seed, offset, error=str(e))
+
+    def _measured_roll(self, formula: str, context: dict, active_rules, detail: bool) -> RollResult:
+        """parse_and_roll com um span por etapa; só roda com a instrumentação ligada (ver instrument.py)."""
+        span = instrument.span
+        rng_name, seed, offset = self.rng.name, self.rng.seed, self.rng.tell()
+        instrument.count("roll.plan_cache_hit" if formula in self._plans else "roll.plan_cache_miss")
+        try:
+            with span("roll"):
+                with span("roll.compile"):
+                    plan = self.compile(formula)
+                with span("roll.bind"):
+                    bound = plan.bind(context)
+                    if not isinstance(active_rules, RuleTable):
+                        active_rules = RuleTable(active_rules)
+                with span("roll.dice"):
+                    total, records = self._roll_plan(plan, bound, active_rules, detail, self._measured_rules)
+        except Exception as e:
+            instrument.count("roll.errors")
+            return RollResult(0, None, rng_name, seed, offset, error=str(e))
+        return RollResult(total, records, rng_name, seed, offset)
+
+    def _measured_rules(self, rolagens: list, sides: int, active_rules, budget: list = None, events: list = None):
+        if not active_rules:
+            return self._apply_rules(rolagens, sides, active_rules, budget, events)
+        instrument.count("roll.rule_passes")
+        with instrument.span("roll.rules"):
+            return self._apply_rules(rolagens, sides, active_rules, budget, events)
+
+    def roll_batch(self, formula: str, contexts: list, active_rules: list = [], detail: bool = True) -> list:
+        """
+        Rola a mesma fórmula uma vez para cada contexto (grupo inteiro, ou N cópias de um monstro),
+        compilando a fórmula e as regras uma vez só. Retorna um RollResult por contexto, na mesma ordem;
+        um contexto sem as variáveis da fórmula vira um RollResult de erro só para ele.
+        """
+        rng = self.rng
+        try:
+            plan = self.compile(formula)
         except Exception as e:
-            return 0, f"Erro na fórmula: {str(e)}"
\ No newline at end of file
+            return [RollResult(0, None, rng.name, rng.seed, rng.tell(), error=str(e)) for _ in contexts]
+        table = active_rules if isinstance(active_rules, RuleTable) else RuleTable(active_rules)
+        apply_rules = self._measured_rules if instrument.enabled else None
+
+        results = []
+        with instrument.span("roll.batch"):
+            for context in contexts:
+                offset = rng.tell()
+                try:
+                    total, records = self._roll_plan(plan, plan.bind(context), table, detail, apply_rules)
+                    results.append(RollResult(total, records, rng.name, rng.seed, offset))
+                except Exception as e:
+                    results.append(RollResult(0, None, rng.name, rng.seed, offset, error=str(e)))
+        instrument.count("roll.batch_rolls", len(contexts))
+        return results
+
+    def _roll_plan(self, plan: FormulaPlan, bound: dict, active_rules: RuleTable, detail: bool,
+                   apply_rules=None) -> tuple[int, list]:
+        """
+        Rola um plano já compilado com as variáveis já resolvidas. Retorna (total, TermRecords ou None).
+        apply_rules troca o _apply_rules (a versão medida, com a instrumentação ligada).
+        """
+        budget = [self.explode_budget]  # dados extras disponíveis nesta rolagem
+        roll = self._roll_single_die
+        apply_rules = apply_rules or self._apply_rules
+
+        total_geral = 0
+        records = [] if detail else None
+
+        terms = plan.resolve(bound) if plan.dynamic else plan.terms
+        for term in terms:
+            operator = term.sign
+
+            if isinstance(term, DiceTerm):
+                lados = term.lados
+                mods = term.mods
+
+                # 1. Rolagem Inicial
+                rolagens = [roll(lados) for _ in range(term.qtd)]
+
+                # 2. APLICAR REGRAS CUSTOMIZADAS (NOVIDADE)
+                # Elas acontecem antes de ordenar ou dropar
+                events = [] if detail else None
+                rolagens, rules_bonus = apply_rules(rolagens, lados, active_rules, budget, events)
+                rolls = tuple(rolagens) if detail else None
+
+                # 3. Lógica padrão (Drop/Keep/Explode Nativo)
+                rolagens.sort()
+
+                if 'dl' in mods:
+                    rolagens = rolagens[term.drop_low:]
+
+                if 'dh' in mods:
+                    drop_n = term.drop_high
+                    rolagens = rolagens[:max(len(rolagens) - drop_n, 0)]  # dh0 não descarta nada
+
+                soma_dados = sum(rolagens)
+
+                # Explode nativo (e)
+                explosao_acumulada = 0
+                truncada = False
+                if term.explode is not None:
+                    explode_target = term.explode
+                    for r in rolagens:
+                        if r >= explode_target:
+                            extra, cortada = self._explode_chain(lados, explode_target, budget)
+                            explosao_acumulada += extra
+                            truncada = truncada or cortada
+                    soma_dados += explosao_acumulada
+
+                valor_parcial = soma_dados + rules_bonus
+                if detail:
+                    records.append(TermRecord(operator, term, valor_parcial, rolls, events,
+                                              explosao_acumulada, truncada))
+            else:
+                if isinstance(term, VarTerm):
+                    valor_parcial = bound[term.name]
+                    # Valor negativo inverte o operador, como se o número estivesse escrito na fórmula
+                    if valor_parcial < 0:
+                        operator = '-' if operator == '+' else '+'
+                        valor_parcial = -valor_parcial
+                else:
+                    valor_parcial = term.value
+                if detail:
+                    records.append(TermRecord(operator, term, valor_parcial))
+
+            if operator == '+':
+                total_geral += valor_parcial
+            else:
+                total_geral -= valor_parcial
+
+        return total_geral, records
+
+    def replay(self, formula: str, context: dict, active_rules: list, rng_name: str, seed, offset) -> RollResult:
+        """Refaz exatamente uma rolagem registrada (ex: para resolver disputas), sem mexer na fonte atual."""
+        source = make_source(rng_name, seed)
+        source.seek(offset)
+        engine = DiceEngine(explode_max_depth=self.explode_max_depth, explode_budget=self.explode_budget, rng=source)
+        engine._plans = self._plans
+        return engine.parse_and_roll(formula, context, active_rules)
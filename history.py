@@ -0,0 +1,440 @@
+"""
+Histórico de rolagens: append-only e em colunas (um arquivo por coluna, gravado com array), para
+guardar milhões de rolagens e auditar a honestidade dos dados sem carregar nada disso na memória.
+
+    rpg_data.history/
+        names.jsonl                 nomes de personagens, ações e fórmulas (uma string JSON por linha; id = linha)
+        time.u32 character.u32 action.u32 formula.u32 total.i32
+                                    uma entrada por rolagem
+        dice.u32                    fim (exclusivo) dos dados da rolagem em sides/face
+        sides.u16 face.u16          os dados da rolagem inicial, inclusive os descartados por dl/dh e os
+                                    rerrolados pelas regras (cada sorteio é um dado honesto); os dados
+                                    das explosões (nativas e de regras) não entram
+        .lock                       trava entre processos (UI, servidor e CLI gravam na mesma pasta)
+
+As consultas (HistoryStats) leem as colunas em blocos e guardam só agregados (histograma dos totais,
+contagem por face), então a memória não cresce com o número de rolagens; update() lê só o que
+foi gravado desde a última consulta.
+"""
+import atexit
+import contextlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+from itertools import chain
+
+import instrument
+
+ROW_COLUMNS = {"time": "I", "character": "I", "action": "I", "formula": "I", "total": "i", "dice": "I"}
+DICE_COLUMNS = {"sides": "H", "face": "H"}
+FLUSH_ROWS = 64  # rolagens em memória antes de gravar
+FLUSH_INTERVAL = 2.0  # segundos: grava na próxima rolagem se a última gravação for mais antiga que isso
+READ_CHUNK = 65536  # rolagens lidas por vez nas consultas
+MIN_EXPECTED = 5  # contagem esperada mínima por classe no qui-quadrado
+
+_INT32 = (-2 ** 31, 2 ** 31 - 1)
+_SWAP = sys.byteorder == "big"  # os arquivos são sempre little-endian
+
+
+def history_path(data_path: str) -> str:
+    """Pasta do histórico ao lado da campanha (rpg_data.json -> rpg_data.history)."""
+    return os.path.splitext(data_path)[0] + ".history"
+
+
+def _column_file(path: str, name: str, typecode: str) -> str:
+    kind = {"I": "u32", "i": "i32", "H": "u16"}[typecode]
+    return os.path.join(path, f"{name}.{kind}")
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    """Trava exclusiva em `path` entre processos (flock no POSIX, msvcrt.locking no Windows)."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _draws(result) -> tuple:
+    """
+    (lados, faces) dos dados da rolagem: o pool final mais as faces trocadas por reroll. Os dados das
+    explosões ficam de fora (a cadeia nativa só guarda a soma, e eles não são uma amostra uniforme).
+    """
+    sides, faces = [], []
+    for record in result.terms or ():
+        if record.rolls is None or record.term.lados > 0xFFFF:
+            continue
+        drawn = list(record.rolls)
+        drawn.extend(before for _, effect, _, before, _ in record.events or () if effect == "reroll")
+        sides.extend([record.term.lados] * len(drawn))
+        faces.extend(drawn)
+    return sides, faces
+
+
+def _chi_square_p(chi2: float, dof: int) -> float:
+    """P(X >= chi2) para X ~ qui-quadrado(dof), pela aproximação de Wilson–Hilferty."""
+    if dof <= 0:
+        return 1.0
+    k = 2 / (9 * dof)
+    z = ((chi2 / dof) ** (1 / 3) - (1 - k)) / math.sqrt(k)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def chi_square(observed: list, expected: list) -> tuple:
+    """
+    (qui², graus de liberdade, p) juntando classes vizinhas até cada uma esperar MIN_EXPECTED.
+    p pequeno (< 0.01) com muitas rolagens indica que os dados não seguem a distribuição esperada.
+    """
+    pooled = []
+    obs = exp = 0.0
+    for o, e in zip(observed, expected):
+        obs += o
+        exp += e
+        if exp >= MIN_EXPECTED:
+            pooled.append((obs, exp))
+            obs = exp = 0.0
+    if exp and pooled:
+        last_obs, last_exp = pooled.pop()
+        pooled.append((last_obs + obs, last_exp + exp))
+    if len(pooled) < 2:
+        return 0.0, 0, 1.0
+    chi2 = sum((o - e) ** 2 / e for o, e in pooled)
+    dof = len(pooled) - 1
+    return chi2, dof, _chi_square_p(chi2, dof)
+
+
+class RollHistory:
+    """
+    Grava as rolagens em buffer e as acrescenta às colunas a cada FLUSH_ROWS (ou FLUSH_INTERVAL);
+    close() é chamado no exit e grava o resto. Seguro entre threads (UI, servidor) e entre processos:
+    nomes novos e gravações acontecem sob a trava da pasta, relendo o que os outros gravaram.
+    Se o programa cair no meio de uma gravação, a abertura seguinte corta as colunas no último
+    registro completo.
+    """
+
+    def __init__(self, path: str, flush_rows: int = FLUSH_ROWS, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._names = None  # id -> string (carregado na primeira rolagem ou consulta)
+        self._ids = {}  # string -> id
+        self._names_end = 0  # bytes de names.jsonl já lidos
+        self._pending = None  # coluna -> array ainda não gravado
+        self._rows = 0  # rolagens já gravadas
+        self._dice = 0  # dados já gravados
+        self._last_flush = 0.0
+
+    # --- Abertura ---
+
+    def _open(self):
+        if self._names is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self._names = []
+        with self._locked():
+            self._sync()
+        self._pending = {name: array(code) for name, code in chain(ROW_COLUMNS.items(), DICE_COLUMNS.items())}
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def _locked(self):
+        return _file_lock(os.path.join(self.path, ".lock"))
+
+    def _sync(self):
+        """Relê o que outros processos gravaram (nomes novos e tamanho das colunas). Só sob a trava."""
+        self._read_names()
+        self._repair()
+
+    def _read_names(self):
+        names_file = os.path.join(self.path, "names.jsonl")
+        if not os.path.exists(names_file):
+            return
+        with open(names_file, "rb+") as f:
+            f.seek(self._names_end)
+            raw = f.read()
+            end = raw.rfind(b"\n") + 1
+            if end != len(raw):  # linha incompleta = queda no meio da gravação
+                f.truncate(self._names_end + end)
+        for line in raw[:end].decode("utf-8").splitlines():
+            name = json.loads(line)
+            self._ids.setdefault(name, len(self._names))
+            self._names.append(name)
+        self._names_end += end
+
+    def _size(self, name: str, typecode: str) -> int:
+        file = _column_file(self.path, name, typecode)
+        return os.path.getsize(file) // array(typecode).itemsize if os.path.exists(file) else 0
+
+    def _repair(self):
+        """Deixa todas as colunas com o mesmo número de rolagens completas."""
+        rows = min(self._size(name, code) for name, code in ROW_COLUMNS.items())
+        dice_available = min(self._size(name, code) for name, code in DICE_COLUMNS.items())
+        dice = 0
+        while rows:
+            dice = self._read("dice", rows - 1, rows)[0]
+            if dice <= dice_available:
+                break
+            rows -= 1
+        else:
+            dice = 0
+        for columns, count in ((ROW_COLUMNS, rows), (DICE_COLUMNS, dice)):
+            for name, code in columns.items():
+                file = _column_file(self.path, name, code)
+                if self._size(name, code) != count or (os.path.exists(file) and
+                                                       os.path.getsize(file) % array(code).itemsize):
+                    with open(file, "ab") as f:
+                        f.truncate(count * array(code).itemsize)
+        self._rows, self._dice = rows, dice
+
+    # --- Gravação ---
+
+    def _intern(self, text: str) -> int:
+        """
+        Id do nome; nomes novos vão para names.jsonl na hora (antes de qualquer rolagem que os use),
+        sob a trava e depois de reler os nomes gravados por outros processos (o id é a linha).
+        """
+        idx = self._ids.get(text)
+        if idx is None:
+            with self._locked():
+                self._read_names()
+                idx = self._ids.get(text)
+                if idx is None:
+                    line = (json.dumps(text, ensure_ascii=False) + "\n").encode("utf-8")
+                    with open(os.path.join(self.path, "names.jsonl"), "ab") as f:
+                        f.write(line)
+                    idx = len(self._names)
+                    self._names.append(text)
+                    self._ids[text] = idx
+                    self._names_end += len(line)
+        return idx
+
+    def append(self, character: str, action: str, formula: str, result, when: float = None):
+        """
+        Registra um RollResult. Rolagens com erro, total que não é inteiro de 32 bits ou dado que não cabe
+        em u16 não entram. A linha inteira é montada e validada antes de tocar nas colunas: uma coluna
+        mais longa que as outras atribuiria as rolagens seguintes ao personagem/ação errados.
+        """
+        total = result.total
+        if result.error is not None or type(total) is not int or not _INT32[0] <= total <= _INT32[1]:
+            return
+        try:
+            sides, faces = (array("H", values) for values in _draws(result))
+        except (TypeError, OverflowError):
+            return
+        with self._lock:
+            self._open()
+            row = (int(time.time() if when is None else when), self._intern(character),
+                   self._intern(action), self._intern(formula))
+            pending = self._pending
+            for name, value in zip(("time", "character", "action", "formula"), row):
+                pending[name].append(value)
+            pending["total"].append(total)
+            pending["sides"].extend(sides)
+            pending["face"].extend(faces)
+            pending["dice"].append(len(pending["face"]))  # relativo ao lote: flush soma o total gravado
+            if (len(pending["total"]) >= self.flush_rows
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self.flush()
+
+    @property
+    def pending(self) -> int:
+        """Rolagens ainda em memória."""
+        return len(self._pending["total"]) if self._pending else 0
+
+    def flush(self):
+        with self._lock, instrument.span("history.flush"):
+            if not self.pending:
+                return
+            with self._locked():
+                self._repair()  # outros processos podem ter gravado desde a última vez
+                pending = self._pending
+                pending["dice"] = array(ROW_COLUMNS["dice"], (self._dice + end for end in pending["dice"]))
+                # dados primeiro e `dice` por último: uma queda no meio deixa no máximo uma cauda que _repair corta
+                order = list(DICE_COLUMNS.items()) + [item for item in ROW_COLUMNS.items() if item[0] != "dice"]
+                order.append(("dice", ROW_COLUMNS["dice"]))
+                for name, code in order:
+                    values = pending[name]
+                    if _SWAP:
+                        values.byteswap()
+                    with open(_column_file(self.path, name, code), "ab") as f:
+                        values.tofile(f)
+                self._rows += len(pending["total"])
+                self._dice += len(pending["face"])
+            self._pending = {name: array(code) for name, code in chain(ROW_COLUMNS.items(), DICE_COLUMNS.items())}
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    # --- Leitura ---
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._open()
+            return self._rows + self.pending
+
+    def names(self) -> list:
+        with self._lock:
+            self._open()
+            with self._locked():
+                self._read_names()
+            return list(self._names)
+
+    def ids_for(self, name: str) -> set:
+        """Ids dos nomes iguais a `name` sem diferenciar maiúsculas (como find_character)."""
+        wanted = name.strip().lower()
+        return {i for i, text in enumerate(self.names()) if text.strip().lower() == wanted}
+
+    def _read(self, name: str, start: int, stop: int) -> array:
+        code = ROW_COLUMNS.get(name) or DICE_COLUMNS[name]
+        values = array(code)
+        if stop > start:
+            with open(_column_file(self.path, name, code), "rb") as f:
+                f.seek(start * values.itemsize)
+                values.fromfile(f, stop - start)
+            if _SWAP:
+                values.byteswap()
+        return values
+
+    def chunks(self, start: int = 0, chunk: int = READ_CHUNK):
+        """
+        Lê as rolagens gravadas a partir de `start`, em blocos: gera (início, colunas), onde colunas
+        tem um array por coluna de ROW_COLUMNS e DICE_COLUMNS (os dados do bloco, em ordem).
+        """
+        with self._lock:
+            self._open()
+            self.flush()
+            with self._locked():
+                self._sync()
+            rows = self._rows
+        while start < rows:
+            stop = min(start + chunk, rows)
+            columns = {name: self._read(name, start, stop) for name in ROW_COLUMNS}
+            first_die = self._read("dice", start - 1, start)[0] if start else 0
+            for name in DICE_COLUMNS:
+                columns[name] = self._read(name, first_die, columns["dice"][-1])
+            columns["first_die"] = first_die
+            yield start, columns
+            start = stop
+
+    def stats(self, character: str = None, action: str = None, formula: str = None) -> "HistoryStats":
+        return HistoryStats(self, character, action, formula).update()
+
+
+class HistoryStats:
+    """
+    Agregados de uma seleção do histórico (personagem, ação e/ou fórmula; None = todos):
+    histograma dos totais e contagem de cada face por tipo de dado. update() lê só as rolagens
+    gravadas desde a chamada anterior, então a mesma instância pode acompanhar a campanha.
+    """
+
+    def __init__(self, history: RollHistory, character: str = None, action: str = None, formula: str = None):
+        from simulation import Histogram  # só nas consultas (simulation importa multiprocessing)
+        self._histogram = Histogram
+        self.history = history
+        self.character, self.action, self.formula = character, action, formula
+        self.totals = Histogram()
+        self.faces = {}  # lados -> contagem de cada face (índice = face)
+        self.first_time = self.last_time = None
+        self._next_row = 0
+
+    def _filters(self) -> list:
+        filters = []
+        for column, name in (("character", self.character), ("action", self.action), ("formula", self.formula)):
+            if name is not None:
+                ids = self.history.ids_for(name) if column != "formula" else \
+                    {i for i, text in enumerate(self.history.names()) if text == name}
+                filters.append((column, ids))
+        return filters
+
+    def update(self) -> "HistoryStats":
+        filters = self._filters()
+        for start, columns in self.history.chunks(self._next_row):
+            dice_end = columns["dice"]
+            base = columns["first_die"]
+            if filters:
+                selected = [i for i in range(len(columns["total"]))
+                            if all(columns[column][i] in ids for column, ids in filters)]
+                totals = [columns["total"][i] for i in selected]
+                times = [columns["time"][i] for i in selected]
+                spans = [((dice_end[i - 1] if i else base) - base, dice_end[i] - base) for i in selected]
+                sides = chain.from_iterable(columns["sides"][a:b] for a, b in spans)
+                faces = chain.from_iterable(columns["face"][a:b] for a, b in spans)
+            else:
+                totals, times = columns["total"], columns["time"]
+                sides, faces = columns["sides"], columns["face"]
+            self._next_row = start + len(columns["total"])
+            if not totals:
+                continue
+            self.totals.merge(self._histogram.from_totals(totals))
+            for (s, face), count in Counter(zip(sides, faces)).items():
+                counts = self.faces.get(s)
+                if counts is None:
+                    counts = self.faces[s] = [0] * (s + 1)
+                if face <= s:
+                    counts[face] += count
+            low, high = min(times), max(times)
+            self.first_time = low if self.first_time is None else min(self.first_time, low)
+            self.last_time = high if self.last_time is None else max(self.last_time, high)
+        return self
+
+    @property
+    def rolls(self) -> int:
+        return self.totals.total
+
+    def natural_rate(self, sides: int = 20, face: int = None) -> float:
+        """Fração dos dX sorteados que deram `face` (padrão: o máximo, ex: o 20 natural)."""
+        counts = self.faces.get(sides)
+        if not counts or not sum(counts):
+            return None
+        return counts[sides if face is None else face] / sum(counts)
+
+    def die_fairness(self, sides: int) -> dict:
+        """Qui-quadrado das faces de dX contra a distribuição uniforme."""
+        counts = self.faces.get(sides, [0] * (sides + 1))[1:]
+        n = sum(counts)
+        chi2, dof, p = chi_square(counts, [n / sides] * sides)
+        return {"sides": sides, "dice": n, "chi2": chi2, "dof": dof, "p_value": p,
+                "max_face_rate": counts[-1] / n if n else None}
+
+    def compare(self, dist) -> dict:
+        """
+        Compara os totais com a distribuição exata (probability.Distribution) da fórmula:
+        diferença de média em erros-padrão (z), qui-quadrado e distância de variação total.
+        """
+        n = self.rolls
+        if not n:
+            return {"rolls": 0}
+        low, high = min(self.totals.offset, dist.min), max(self.totals.max, dist.max)
+        observed = [0] * (high - low + 1)
+        for i, c in enumerate(self.totals.counts):
+            observed[self.totals.offset - low + i] += c
+        expected = [0.0] * (high - low + 1)
+        for i, p in enumerate(dist.probs):
+            expected[dist.offset - low + i] += p * n
+        chi2, dof, p_value = chi_square(observed, expected)
+        mean, expected_mean = self.totals.mean(), dist.mean()
+        std_error = math.sqrt(dist.variance() / n) if dist.variance() else 0.0
+        return {"rolls": n, "mean": mean, "expected_mean": expected_mean,
+                "z": (mean - expected_mean) / std_error if std_error else 0.0,
+                "chi2": chi2, "dof": dof, "p_value": p_value,
+                "tv_distance": 0.5 * sum(abs(o / n - e / n) for o, e in zip(observed, expected))}
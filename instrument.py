@@ -0,0 +1,286 @@
+"""
+Instrumentação leve dos caminhos quentes: rolagem (etapas do parse_and_roll, regras), contexto,
+gravação (JSON, SQLite) e reconstrução da tela.
+
+    span(nome)        mede um bloco (with); as medidas de um nome viram percentis móveis
+    count(nome, n)    soma n num contador
+    action(nome)      span que marca uma ação do usuário (rolar, editar, abrir ficha); é a unidade
+                      de profile_next(N), que liga o cProfile durante as próximas N ações
+    timed(nome)       decorador com o mesmo efeito de span (ou de action, com is_action=True)
+    snapshot()        contadores e percentis (p50/p90/p99) das últimas WINDOW medidas de cada span
+    trace()           os spans no formato Trace Event do Chrome; export_trace(p) grava em arquivo
+
+Desligada (o padrão), span() e action() devolvem um objeto vazio compartilhado e count() sai na
+primeira linha; no caminho mais quente (DiceEngine.parse_and_roll) quem chama testa `enabled` uma
+vez e só então entra na versão medida. Ligada, cada medida custa da ordem de 1–2µs.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW = 1000  # últimas durações guardadas por span, para os percentis
+TRACE_EVENTS = 200_000  # eventos guardados para o trace (os mais antigos saem)
+PROFILE_LINES = 25  # funções no resumo do cProfile
+
+enabled = False
+
+_now = time.perf_counter_ns
+_lock = threading.Lock()
+_spans = {}  # nome -> _SpanStats
+_counters = {}
+_trace = deque(maxlen=TRACE_EVENTS)  # (nome, início ns, duração ns, thread)
+_origin = _now()
+_local = threading.local()  # profundidade das ações na thread: só a de fora é perfilada
+_capture = {"remaining": 0, "profiler": None, "owner": None, "path": None, "summary": None}
+
+
+class _SpanStats:
+    __slots__ = ("count", "total", "max", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.recent = deque(maxlen=WINDOW)
+
+
+def _record(name: str, start: int, end: int):
+    duration = end - start
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = _SpanStats()
+        stats.count += 1
+        stats.total += duration
+        if duration > stats.max:
+            stats.max = duration
+        stats.recent.append(duration)
+        _trace.append((name, start, duration, threading.get_ident()))
+
+
+class _Null:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _Null()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.start, _now())
+        return False
+
+
+class _Action(_Span):
+    """Span de uma ação do usuário; a ação de fora (sem outra em volta na thread) pode ser perfilada."""
+    __slots__ = ("profiler",)
+
+    def __enter__(self):
+        depth = getattr(_local, "depth", 0)
+        _local.depth = depth + 1
+        self.profiler = _start_profile() if depth == 0 else None
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            _record(self.name, self.start, _now())
+        _local.depth -= 1
+        if self.profiler is not None:
+            _stop_profile(self.profiler)
+        return False
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Esquece medidas, contadores e eventos (o estado ligado/desligado e a captura continuam)."""
+    global _origin
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _trace.clear()
+        _origin = _now()
+
+
+def span(name: str):
+    return _Span(name) if enabled else _NULL
+
+
+def action(name: str):
+    return _Action(name) if enabled or _capture["remaining"] else _NULL
+
+
+def count(name: str, n: int = 1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def timed(name: str, is_action: bool = False):
+    """Decorador: mede cada chamada da função como span (ou como ação, ver action())."""
+    make = action if is_action else span
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with make(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# --- Leitura ---
+
+def snapshot() -> dict:
+    """
+    {"enabled", "spans": {nome: {count, total_ms, p50_ms, p90_ms, p99_ms, max_ms}}, "counters"}.
+    Os percentis são das últimas WINDOW medidas de cada span; count, total e max são desde o reset().
+    """
+    with _lock:
+        items = [(name, s.count, s.total, s.max, sorted(s.recent)) for name, s in _spans.items()]
+        counters = dict(_counters)
+
+    spans = {}
+    for name, n, total, peak, recent in sorted(items):
+        def pct(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] / 1e6
+
+        spans[name] = {"count": n, "total_ms": total / 1e6, "p50_ms": pct(0.5), "p90_ms": pct(0.9),
+                       "p99_ms": pct(0.99), "max_ms": peak / 1e6}
+    return {"enabled": enabled, "spans": spans, "counters": counters}
+
+
+def trace() -> dict:
+    """Os eventos guardados no formato Trace Event do Chrome (um evento "X" por span)."""
+    with _lock:
+        events = list(_trace)
+        counters = dict(_counters)
+        origin = _origin
+    pid = os.getpid()
+    out = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "YourSheet"}}]
+    for name, start, duration, tid in events:
+        out.append({"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                    "ts": (start - origin) / 1000, "dur": duration / 1000})
+    if counters:
+        end = max((start + duration for _, start, duration, _ in events), default=origin)
+        out.append({"name": "counters", "ph": "C", "pid": pid, "ts": (end - origin) / 1000, "args": counters})
+    return {"traceEvents": out, "displayTimeUnit": "ms"}
+
+
+def export_trace(path: str) -> int:
+    """Grava trace() em `path` (abre em chrome://tracing ou no Perfetto); retorna quantos spans."""
+    data = trace()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return sum(1 for event in data["traceEvents"] if event["ph"] == "X")
+
+
+# --- cProfile das próximas N ações ---
+
+def profile_next(n: int, path: str = None):
+    """
+    Liga o cProfile durante as próximas n ações (action()/timed(is_action=True)), mesmo com a
+    instrumentação desligada. No fim grava as estatísticas em `path` (se dado, formato pstats)
+    e deixa um resumo em texto em profile_summary(). n=0 cancela uma captura em andamento.
+    """
+    import cProfile  # só aqui e em _summarize: a CLI não paga o import sem perfilar
+
+    with _lock:
+        _capture.update(remaining=max(0, n), path=path, summary=None)
+        if _capture["profiler"] is None or n <= 0:
+            _capture["profiler"] = cProfile.Profile() if n > 0 else None
+
+
+def profiling() -> int:
+    """Quantas ações ainda serão perfiladas (0 = nenhuma captura em andamento)."""
+    return _capture["remaining"]
+
+
+def profile_summary():
+    """Resumo (top PROFILE_LINES por tempo acumulado) da última captura terminada, ou None."""
+    return _capture["summary"]
+
+
+def _start_profile():
+    """Liga o profiler da captura nesta thread; retorna-o, ou None se não há o que perfilar agora."""
+    with _lock:
+        profiler = _capture["profiler"]
+        if not _capture["remaining"] or profiler is None or _capture["owner"] is not None:
+            return None  # sem captura, ou outra thread já está no meio de uma ação perfilada
+        _capture["owner"] = threading.get_ident()
+    try:
+        profiler.enable()
+    except ValueError:  # outro profiler (ex: o programa rodando sob python -m cProfile) já está ativo
+        with _lock:
+            _capture["owner"] = None
+        return None
+    return profiler
+
+
+def _stop_profile(profiler):
+    profiler.disable()
+    with _lock:
+        if profiler is not _capture["profiler"]:
+            return  # a captura foi cancelada ou trocada durante a ação
+        _capture["owner"] = None
+        _capture["remaining"] -= 1
+        if _capture["remaining"] > 0:
+            return
+        _capture["profiler"] = None
+        path = _capture["path"]
+    _summarize(profiler, path)
+
+
+def finish_profile():
+    """Encerra a captura antes das N ações (ex: fim do programa) e resume o que foi perfilado até aqui."""
+    with _lock:
+        profiler = _capture["profiler"]
+        if profiler is None or _capture["owner"] is not None:
+            return _capture["summary"]
+        _capture.update(profiler=None, remaining=0)
+        path = _capture["path"]
+    _summarize(profiler, path)
+    return _capture["summary"]
+
+
+def _summarize(profiler, path: str):
+    import io
+    import pstats
+
+    profiler.create_stats()
+    if not profiler.stats:
+        _capture["summary"] = "nenhuma ação perfilada"
+        return
+    if path:
+        profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    _capture["summary"] = text.getvalue()
@@ -0,0 +1,124 @@
+"""
+Teste de carga do server.py: clientes HTTP concorrentes (keep-alive) rolando uma ação numa mesa,
+com ouvintes WebSocket opcionais recebendo os resultados. Mostra vazão e latência p50/p99.
+
+    python server.py --data rpg_data.json
+    python loadtest.py --character Thorin --action Ataque --clients 200 --rolls 50 --listeners 50
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import struct
+import time
+
+from server import DEFAULT_HOST, DEFAULT_PORT
+
+IDLE_TIMEOUT = 2.0  # segundos sem mensagens até um ouvinte desistir
+
+
+async def _read_response(reader: asyncio.StreamReader):
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def roller(host, port, body: bytes, rolls: int, latencies: list, errors: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = (f"POST /roll HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+    try:
+        for _ in range(rolls):
+            start = time.perf_counter()
+            writer.write(request)
+            status, payload = await _read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(payload.decode("utf-8", "replace"))
+    finally:
+        writer.close()
+
+
+async def listener(host, port, table: str, expected: int, received: list, ready: asyncio.Event):
+    """Conta as mensagens da mesa até receber `expected` ou ficar IDLE_TIMEOUT sem nada chegar."""
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((f"GET /tables/{table} HTTP/1.1\r\nHost: {host}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode("latin-1"))
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    ready.set()
+    count = 0
+    try:
+        while count < expected:
+            b1, b2 = await asyncio.wait_for(reader.readexactly(2), IDLE_TIMEOUT)
+            n = b2 & 0x7F
+            if n == 126:
+                n, = struct.unpack("!H", await reader.readexactly(2))
+            elif n == 127:
+                n, = struct.unpack("!Q", await reader.readexactly(8))
+            await reader.readexactly(n)
+            count += 1
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        received.append(count)
+        writer.close()
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    table = f"loadtest-{os.getpid()}"
+    body = json.dumps({"character": args.character, "action": args.action, "table": table}).encode("utf-8")
+    latencies, errors, received = [], [], []
+
+    listeners = []
+    for _ in range(args.listeners):
+        ready = asyncio.Event()
+        listeners.append(asyncio.create_task(
+            listener(args.host, args.port, table, args.clients * args.rolls, received, ready)))
+        await ready.wait()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(roller(args.host, args.port, body, args.rolls, latencies, errors)
+                           for _ in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*listeners)
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"{args.clients} clientes x {args.rolls} rolagens = {total} em {elapsed:.2f}s ({total / elapsed:.0f} rolagens/s)")
+    print(f"latência p50 {percentile(latencies, 0.50) * 1000:.2f} ms | p99 {percentile(latencies, 0.99) * 1000:.2f} ms"
+          f" | max {latencies[-1] * 1000:.2f} ms")
+    if args.listeners:
+        print(f"{args.listeners} ouvintes na mesa: {min(received)}–{max(received)} mensagens recebidas (esperado {total})")
+    if errors:
+        print(f"{len(errors)} erros, ex: {errors[0]}")
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga do servidor de rolagens.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--character", required=True)
+    parser.add_argument("--action", required=True)
+    parser.add_argument("--clients", type=int, default=200, help="clientes HTTP simultâneos")
+    parser.add_argument("--rolls", type=int, default=50, help="rolagens por cliente")
+    parser.add_argument("--listeners", type=int, default=0, help="ouvintes WebSocket na mesa")
+    return asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
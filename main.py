@@ -1,58 +1,13 @@
 import flet as ft
-import json
-import os
+import threading
+import time
 import uuid
-from dice_engine import DiceEngine
+import instrument
+from context_cache import attribute_value
+from roll_log import RollLog
+from rpg_app import RPGApp
 
-FILE_NAME = "rpg_data.json"
-
-
-class RPGApp:
-    def __init__(self):
-        self.data = self.load_data()
-        self.engine = DiceEngine()
-        self.current_char_index = None
-
-    def load_data(self):
-        default = {"characters": [], "global_rules": []}
-        if not os.path.exists(FILE_NAME):
-            return default
-        try:
-            with open(FILE_NAME, "r", encoding="utf-8") as f:
-                loaded = json.load(f)
-                # Garante que chaves novas existam em arquivos antigos
-                if "global_rules" not in loaded: loaded["global_rules"] = []
-                return loaded
-        except:
-            return default
-
-    def save_data(self):
-        with open(FILE_NAME, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, indent=4, ensure_ascii=False)
-
-    def get_context(self, char_idx):
-        if char_idx is None or char_idx >= len(self.data["characters"]):
-            return {}
-        char = self.data["characters"][char_idx]
-        context = {}
-        for seg in char["segments"]:
-            for field in seg["fields"]:
-                if field["type"] == "Atributo":
-                    try:
-                        val = int(field["value"])
-                        context[field["name"]] = val
-                    except:
-                        pass
-        return context
-
-    def get_rules_by_ids(self, rule_ids):
-        """Retorna os objetos de regra completos baseados na lista de IDs salvos na ação"""
-        if not rule_ids: return []
-        active = []
-        for r in self.data["global_rules"]:
-            if r["id"] in rule_ids:
-                active.append(r)
-        return active
+STATS_DEBOUNCE = 0.3  # segundos sem digitar antes de recalcular as estatísticas das ações
 
 
 def main(page: ft.Page):
@@ -63,11 +18,7 @@ def main(page: ft.Page):
     app = RPGApp()
 
     # --- Elementos de UI Globais ---
-    log_view = ft.Column(scroll=ft.ScrollMode.ALWAYS, height=150)
-
-    def add_log(text, color="white"):
-        log_view.controls.insert(0, ft.Text(text, color=color, selectable=True))
-        page.update()
+    roll_log = RollLog()
 
     # ==============================================================================
     #                      GERENCIADOR DE CONDICIONAIS (NOVO)
@@ -118,15 +69,13 @@ def main(page: ft.Page):
                 "effect": dd_effect.value,
                 "effect_param": int(txt_param.value)
             }
-            app.data["global_rules"].append(new_rule)
-            app.save_data()
+            app.add_rule(new_rule)
             refresh_rules_list()
             txt_name.value = ""
             rules_dialog.update()
 
         def delete_rule_click(e, rule_id):
-            app.data["global_rules"] = [r for r in app.data["global_rules"] if r["id"] != rule_id]
-            app.save_data()
+            app.delete_rule(rule_id)
             refresh_rules_list()
             rules_dialog.update()
 
@@ -177,12 +126,9 @@ def main(page: ft.Page):
     #                      VINCULAR REGRAS NA AÇÃO
     # ==============================================================================
 
-    def open_action_settings(e, char_idx, seg_idx, field_idx):
-        field = app.data["characters"][char_idx]["segments"][seg_idx]["fields"][field_idx]
-        if "active_rules" not in field:
-            field["active_rules"] = []
-
-        selected_rules = field["active_rules"]
+    def open_action_settings(e, char_idx, field_id):
+        field = app.get_field(field_id)
+        selected_rules = list(field.get("active_rules") or [])  # cópia: o desfazer guarda a lista antiga
 
         def on_checkbox_change(e, rule_id):
             if e.control.value:  # Checked
@@ -190,8 +136,8 @@ def main(page: ft.Page):
             else:  # Unchecked
                 if rule_id in selected_rules: selected_rules.remove(rule_id)
 
-            app.data["characters"][char_idx]["segments"][seg_idx]["fields"][field_idx]["active_rules"] = selected_rules
-            app.save_data()
+            app.update_field(field_id, active_rules=list(selected_rules))
+            refresh_action_stats(char_idx)
 
         checks_col = ft.Column()
         if not app.data["global_rules"]:
@@ -215,20 +161,253 @@ def main(page: ft.Page):
         )
         page.open(dlg)
 
-    # --- Motor de Rolagem ---
-    def run_action(e, formula, char_idx, active_rules_ids=None):
-        if not formula: return
-        context = app.get_context(char_idx)
-
-        # Recupera os objetos de regra completos baseados nos IDs salvos no campo
-        rules_objects = app.get_rules_by_ids(active_rules_ids)
+    # --- Estatísticas ao lado das ações ---
+    action_stats = {}  # id do campo -> ft.Text das ações visíveis na ficha aberta
+    # Calculadas numa thread só (fora da UI); pedidos feitos enquanto ela trabalha entram na fila
+    stats_lock = threading.Lock()
+    stats_job = {"char_idx": None, "fields": set(), "due": 0.0, "running": False}
 
-        total, detalhes = app.engine.parse_and_roll(formula, context, rules_objects)
+    def describe_action(formula, char_idx, active_rules_ids):
+        """Média, faixa e chance de passar algumas CDs (exatas; "≈" quando a fórmula é cara e foi amostrada)."""
+        if not formula: return "", None
+        try:
+            dist = app.engine.estimate_distribution(formula, app.get_context(char_idx),
+                                                    app.get_rule_table(active_rules_ids))
+        except Exception:
+            return "", None
+        approx = "≈" if dist.samples else ""
+        text = f"{approx}μ {dist.mean():.1f} ({dist.min}–{dist.max})"
+        tooltip = " | ".join(f"CD {dc}: {approx}{dist.prob_at_least(dc):.0%}" for dc in (10, 15, 20))
+        if dist.samples:
+            tooltip += f" | estimado com {dist.samples} rolagens"
+        return text, tooltip
+
+    # --- Resultado dos atributos derivados ---
+    attr_results = {}  # id do campo -> ft.Text ao lado dos Atributos visíveis
+
+    def describe_attribute(char_idx, field):
+        """'= 3' para um atributo derivado, ou o aviso (com o motivo no tooltip) se ele não tiver valor."""
+        if attribute_value(field) is not None or not str(field["value"]).strip():
+            return "", None, "grey"
+        value, error = app.attribute_result(char_idx, field["id"])
+        if error:
+            return "⚠", error, "red"
+        return f"= {value}", None, "grey"
+
+    def refresh_attributes(char_idx, field_ids=None):
+        changed = []
+        for field_id in (field_ids or list(attr_results)):
+            result_text = attr_results.get(field_id)
+            if result_text is None: continue
+            value, tooltip, color = describe_attribute(char_idx, app.get_field(field_id))
+            if (value, tooltip, color) != (result_text.value, result_text.tooltip, result_text.color):
+                result_text.value, result_text.tooltip, result_text.color = value, tooltip, color
+                changed.append(result_text)
+        if changed:
+            page.update(*changed)
+
+    def context_changed(char_idx, delay=0.0):
+        """Algum atributo mudou de valor: atualiza os derivados e as estatísticas das ações."""
+        refresh_attributes(char_idx)
+        refresh_action_stats(char_idx, delay=delay)
+
+    def refresh_action_stats(char_idx, field_ids=None, delay=0.0):
+        """
+        Agenda o recálculo das estatísticas (todas as ações visíveis, ou só field_ids) na thread de
+        estatísticas. delay (digitação) adia o cálculo até o usuário parar por esse tempo.
+        """
+        with stats_lock:
+            if stats_job["char_idx"] != char_idx:
+                stats_job["fields"].clear()
+            stats_job["char_idx"] = char_idx
+            stats_job["fields"].update(field_ids or action_stats)
+            stats_job["due"] = time.monotonic() + delay
+            if stats_job["running"]:
+                return
+            stats_job["running"] = True
+        page.run_thread(compute_action_stats)
+
+    def compute_action_stats():
+        while True:
+            with stats_lock:
+                wait = stats_job["due"] - time.monotonic()
+                if wait <= 0:
+                    char_idx, field_ids = stats_job["char_idx"], stats_job["fields"]
+                    stats_job["fields"] = set()
+                    if not field_ids:
+                        stats_job["running"] = False
+                        return
+            if wait > 0:
+                time.sleep(wait)
+                continue
+
+            changed = []
+            for field_id in field_ids:
+                stats_text = action_stats.get(field_id)
+                if stats_text is None: continue  # campo apagado ou ficha trocada no meio do caminho
+                try:
+                    field = app.get_field(field_id)
+                except KeyError:
+                    continue
+                value, tooltip = describe_action(field["value"], char_idx, field.get("active_rules", []))
+                if value != stats_text.value or tooltip != stats_text.tooltip:
+                    stats_text.value, stats_text.tooltip = value, tooltip
+                    if stats_text.page is not None:  # ainda não montado: entra na tela já com o valor novo
+                        changed.append(stats_text)
+            if changed:
+                page.update(*changed)
 
-        add_log(f"🎲 Rolou: {formula}", color="cyan")
-        add_log(f"➤ Detalhes: {detalhes}", color="grey")
-        add_log(f"★ RESULTADO: {total}", color="green" if total > 0 else "red")
-        add_log("-" * 30)
+    # --- Motor de Rolagem ---
+    @instrument.timed("ui.roll", is_action=True)
+    def run_action(e, field_id, char_idx):
+        formula = app.get_field(field_id)["value"]
+        outcome = app.roll_action(char_idx, field_id)
+        if outcome is None: return
+        total, detalhes = outcome
+
+        roll_log.add([
+            ("-" * 30, "white"),
+            (f"★ RESULTADO: {total}", "green" if total > 0 else "red"),
+            (f"➤ Detalhes: {detalhes}", "grey"),
+            (f"🎲 Rolou: {formula}", "cyan"),
+        ])
+
+    # --- Rolagem em grupo (iniciativa, testes do grupo, hordas) ---
+    def open_party_roll(e):
+        txt_action = ft.TextField(label="Ação", value="Iniciativa", expand=True)
+        txt_copies = ft.TextField(label="Cópias", value="1", width=90, keyboard_type=ft.KeyboardType.NUMBER,
+                                  tooltip="Rola N cópias de cada personagem marcado (ex: uma horda de goblins)")
+        checks = [ft.Checkbox(label=char["name"], value=True, data=idx)
+                  for idx, char in enumerate(app.data["characters"])]
+        status = ft.Text("", color="grey")
+        results_table = ft.DataTable(
+            columns=[ft.DataColumn(ft.Text("#"), numeric=True), ft.DataColumn(ft.Text("Nome")),
+                     ft.DataColumn(ft.Text("Total"), numeric=True), ft.DataColumn(ft.Text("Detalhes"))],
+            rows=[])
+        btn_roll = ft.ElevatedButton("Rolar")
+
+        @instrument.timed("ui.roll_party", is_action=True)
+        def roll_party():
+            # Roda fora do loop da interface: grupos grandes não travam a janela
+            try:
+                copies = max(1, int(txt_copies.value or 1))
+            except ValueError:
+                copies = 1
+            action = txt_action.value.strip()
+            chosen = [c.data for c in checks if c.value]
+            rows, missing = app.roll_party(action, chosen, copies)
+
+            results_table.rows = [
+                ft.DataRow(cells=[ft.DataCell(ft.Text(str(pos))), ft.DataCell(ft.Text(label)),
+                                  ft.DataCell(ft.Text(str(result.total), weight="bold",
+                                                      color="red" if result.error else None)),
+                                  ft.DataCell(ft.Text(result.text, size=12, color="grey", selectable=True))])
+                for pos, (label, _, result) in enumerate(rows, 1)]
+            status.value = f"{len(rows)} rolagens" + (f" | sem '{action}': {', '.join(missing)}" if missing else "")
+            btn_roll.disabled = False
+            party_dialog.update()
+
+            if rows:
+                lines = [("-" * 30, "white"), (f"★ GRUPO: {action} ({len(rows)} rolagens)", "green")]
+                lines += [(f"{pos}. {label}: {result.total}", "cyan") for pos, (label, _, result) in enumerate(rows[:5], 1)]
+                if len(rows) > 5: lines.append((f"... mais {len(rows) - 5}", "grey"))
+                roll_log.add(lines)
+
+        def roll_click(e):
+            btn_roll.disabled = True
+            status.value = "Rolando..."
+            party_dialog.update()
+            page.run_thread(roll_party)
+
+        btn_roll.on_click = roll_click
+
+        party_dialog = ft.AlertDialog(
+            title=ft.Text("Rolagem em Grupo"),
+            content=ft.Container(
+                width=700,
+                content=ft.Column([
+                    ft.Row([txt_action, txt_copies, btn_roll]),
+                    ft.Container(ft.Column(checks, scroll=ft.ScrollMode.AUTO), height=120,
+                                 border=ft.border.all(1, "grey"), border_radius=5, padding=5),
+                    status,
+                    ft.Container(ft.Column([results_table], scroll=ft.ScrollMode.AUTO), height=350),
+                ], tight=True)
+            ),
+        )
+        page.open(party_dialog)
+
+    # --- Diagnóstico: tempos das etapas (instrument.py), trace e cProfile ---
+    def open_diagnostics(e):
+        switch = ft.Switch(label="Medir tempos", value=instrument.enabled)
+        status = ft.Text("", color="grey")
+        counters_text = ft.Text("", size=12, color="grey", selectable=True)
+        txt_actions = ft.TextField(label="Ações", value="20", width=90, keyboard_type=ft.KeyboardType.NUMBER)
+        profile_text = ft.Text("", size=11, font_family="monospace", selectable=True)
+        spans_table = ft.DataTable(
+            columns=[ft.DataColumn(ft.Text("Etapa"))] +
+                    [ft.DataColumn(ft.Text(t), numeric=True) for t in ("n", "p50 ms", "p90 ms", "p99 ms", "máx ms")],
+            rows=[])
+
+        def refresh(e=None):
+            snap = instrument.snapshot()
+            spans_table.rows = [
+                ft.DataRow(cells=[ft.DataCell(ft.Text(name, size=12))] +
+                                 [ft.DataCell(ft.Text(f"{s[k]:.3f}" if k != "count" else str(s[k]), size=12))
+                                  for k in ("count", "p50_ms", "p90_ms", "p99_ms", "max_ms")])
+                for name, s in snap["spans"].items()]
+            counters_text.value = "   ".join(f"{k}: {v}" for k, v in sorted(snap["counters"].items()))
+            remaining = instrument.profiling()
+            if remaining:
+                profile_text.value = f"cProfile ligado: faltam {remaining} ações"
+            else:
+                profile_text.value = instrument.profile_summary() or ""
+            if e is not None: diag_dialog.update()
+
+        def toggle(e):
+            if switch.value: instrument.enable()
+            else: instrument.disable()
+            refresh(e)
+
+        def reset(e):
+            instrument.reset()
+            status.value = ""
+            refresh(e)
+
+        def export(e):
+            path = f"yoursheet-trace-{time.strftime('%Y%m%d-%H%M%S')}.json"
+            n = instrument.export_trace(path)
+            status.value = f"{n} eventos em {path} (abrir em chrome://tracing ou no Perfetto)"
+            refresh(e)
+
+        def profile(e):
+            try:
+                n = max(1, int(txt_actions.value or 20))
+            except ValueError:
+                n = 20
+            path = f"yoursheet-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+            instrument.profile_next(n, path)
+            status.value = f"cProfile das próximas {n} ações; estatísticas em {path}"
+            refresh(e)
+
+        switch.on_change = toggle
+        refresh()
+        diag_dialog = ft.AlertDialog(
+            title=ft.Text("Diagnóstico"),
+            content=ft.Container(
+                width=760,
+                content=ft.Column([
+                    ft.Row([switch, ft.ElevatedButton("Atualizar", on_click=refresh),
+                            ft.ElevatedButton("Zerar", on_click=reset),
+                            ft.ElevatedButton("Exportar trace", on_click=export)]),
+                    ft.Row([txt_actions, ft.ElevatedButton("Perfilar próximas ações", on_click=profile)]),
+                    status,
+                    ft.Container(ft.Column([spans_table], scroll=ft.ScrollMode.AUTO), height=300),
+                    counters_text,
+                    ft.Container(ft.Column([profile_text], scroll=ft.ScrollMode.AUTO), height=150),
+                ], tight=True)
+            ),
+        )
+        page.open(diag_dialog)
 
     # --- UI Principal ---
 
@@ -241,12 +420,7 @@ def main(page: ft.Page):
         if delete_input.value == "DELETAR":
             idx = pending_delete_idx[0]
             if 0 <= idx < len(app.data["characters"]):
-                app.data["characters"].pop(idx)
-                app.save_data()
-                if app.current_char_index == idx:
-                    app.current_char_index = None
-                elif app.current_char_index is not None and app.current_char_index > idx:
-                    app.current_char_index -= 1
+                app.delete_character(idx)  # o app ajusta current_char_index
                 update_view()
             page.close(delete_dialog)
 
@@ -263,143 +437,242 @@ def main(page: ft.Page):
         page.open(delete_dialog)
 
     # --- Construção da Ficha ---
+    # A ficha aberta guarda o mapeamento dado -> controle, para que adicionar/remover um campo ou
+    # segmento mexa só naquele controle em vez de reconstruir a ficha inteira.
+    sheet = {"char_idx": None, "segments_col": None}
+    segment_views = {}  # id do segmento -> (ExpansionTile, coluna de campos)
+    field_rows = {}  # id do campo -> ft.Row
+    char_tiles = []  # ListTile de cada personagem na barra lateral
+
+    def build_field_row(char_idx, field):
+        fid = field["id"]
+        row = ft.Row(alignment=ft.MainAxisAlignment.SPACE_BETWEEN)
+
+        if field["type"] == "Texto":
+            row.controls.append(
+                ft.TextField(label=field["name"], value=field["value"], expand=True, multiline=True,
+                             on_change=lambda e: update_field_val(e, char_idx, fid)))
+
+        elif field["type"] == "Atributo":
+            # Val aceita número ou expressão sobre outros atributos, ex: (str-10)/2
+            result_value, result_tooltip, result_color = describe_attribute(char_idx, field)
+            result_text = ft.Text(result_value, tooltip=result_tooltip, color=result_color, size=12)
+            attr_results[fid] = result_text
+            row.controls.extend([
+                ft.TextField(value=field["name"], label="Var", width=100,
+                             on_change=lambda e: update_field_name(e, char_idx, fid)),
+                ft.TextField(value=str(field["value"]), label="Val", width=140,
+                             on_change=lambda e: update_field_val(e, char_idx, fid)),
+                result_text
+            ])
 
-    def build_character_view(char_idx):
-        char = app.data["characters"][char_idx]
-        name_field = ft.TextField(label="Nome", value=char["name"], on_change=lambda e: update_char_name(e, char_idx))
-        segments_col = ft.Column()
-
-        for seg_idx, seg in enumerate(char["segments"]):
-            fields_col = ft.Column()
-            for field_idx, field in enumerate(seg["fields"]):
-
-                # Container da Linha
-                row = ft.Row(alignment=ft.MainAxisAlignment.SPACE_BETWEEN)
-
-                if field["type"] == "Texto":
-                    row.controls.append(
-                        ft.TextField(label=field["name"], value=field["value"], expand=True, multiline=True,
-                                     on_change=lambda e, s=seg_idx, f=field_idx: update_field_val(e, char_idx, s, f)))
-
-                elif field["type"] == "Atributo":
-                    row.controls.extend([
-                        ft.TextField(value=field["name"], label="Var", width=100,
-                                     on_change=lambda e, s=seg_idx, f=field_idx: update_field_name(e, char_idx, s, f)),
-                        ft.TextField(value=str(field["value"]), label="Val", width=80,
-                                     keyboard_type=ft.KeyboardType.NUMBER,
-                                     on_change=lambda e, s=seg_idx, f=field_idx: update_field_val(e, char_idx, s, f))
-                    ])
-
-                elif field["type"] == "Ação":
-                    # Recupera regras salvas no JSON, se houver
-                    active_rules = field.get("active_rules", [])
-
-                    row.controls.extend([
-                        ft.TextField(value=field["name"], label="Ação", expand=True,
-                                     on_change=lambda e, s=seg_idx, f=field_idx: update_field_name(e, char_idx, s, f)),
-                        ft.TextField(value=field["value"], label="Fórmula", expand=True,
-                                     on_change=lambda e, s=seg_idx, f=field_idx: update_field_val(e, char_idx, s, f)),
-
-                        # Botão Configurar Regras (Engrenagem)
-                        ft.IconButton(ft.Icons.SETTINGS, icon_color="blue", tooltip="Condicionais",
-                                      on_click=lambda e, s=seg_idx, f=field_idx: open_action_settings(e, char_idx, s,
-                                                                                                      f)),
-
-                        # Botão Rolar (Passa active_rules)
-                        ft.IconButton(ft.Icons.CASINO, icon_color="pink",
-                                      on_click=lambda e, f=field["value"], r=active_rules: run_action(e, f, char_idx,
-                                                                                                      r))
-                    ])
-
-                # Botão Deletar Campo
-                row.controls.append(ft.IconButton(ft.Icons.DELETE_OUTLINE, icon_size=16,
-                                                  on_click=lambda e, s=seg_idx, f=field_idx: delete_field(e, char_idx,
-                                                                                                          s, f)))
-                fields_col.controls.append(row)
-
-            # Botões do Segmento
-            add_btns = ft.Row([
-                ft.ElevatedButton("+ Txt", on_click=lambda e, s=seg_idx: add_field(char_idx, s, "Texto")),
-                ft.ElevatedButton("+ Att", on_click=lambda e, s=seg_idx: add_field(char_idx, s, "Atributo")),
-                ft.ElevatedButton("+ Act", on_click=lambda e, s=seg_idx: add_field(char_idx, s, "Ação")),
-                ft.IconButton(ft.Icons.DELETE_FOREVER, icon_color="red",
-                              on_click=lambda e, s=seg_idx: delete_segment(char_idx, s))
+        elif field["type"] == "Ação":
+            # As estatísticas chegam da thread de estatísticas (refresh_action_stats)
+            stats_text = ft.Text("", color="grey", size=12)
+            action_stats[fid] = stats_text
+            refresh_action_stats(char_idx, [fid])
+
+            row.controls.extend([
+                ft.TextField(value=field["name"], label="Ação", expand=True,
+                             on_change=lambda e: update_field_name(e, char_idx, fid)),
+                ft.TextField(value=field["value"], label="Fórmula", expand=True,
+                             on_change=lambda e: update_field_val(e, char_idx, fid)),
+                stats_text,
+
+                # Botão Configurar Regras (Engrenagem)
+                ft.IconButton(ft.Icons.SETTINGS, icon_color="blue", tooltip="Condicionais",
+                              on_click=lambda e: open_action_settings(e, char_idx, fid)),
+
+                # Botão Rolar (lê fórmula e regras atuais do campo na hora do clique)
+                ft.IconButton(ft.Icons.CASINO, icon_color="pink",
+                              on_click=lambda e: run_action(e, fid, char_idx))
             ])
 
-            # Título Editável
-            seg_title = ft.TextField(value=seg["name"], text_style=ft.TextStyle(weight="bold"),
-                                     border=ft.InputBorder.UNDERLINE,
-                                     on_change=lambda e, s=seg_idx: update_segment_name(e, char_idx, s), expand=True)
+        # Botão Deletar Campo
+        row.controls.append(ft.IconButton(ft.Icons.DELETE_OUTLINE, icon_size=16,
+                                          on_click=lambda e: delete_field(e, char_idx, fid)))
+        field_rows[fid] = row
+        return row
+
+    def build_segment_tile(char_idx, seg):
+        sid = seg["id"]
+        fields_col = ft.Column([build_field_row(char_idx, field) for field in seg["fields"]])
+
+        # Botões do Segmento
+        add_btns = ft.Row([
+            ft.ElevatedButton("+ Txt", on_click=lambda e: add_field(char_idx, sid, "Texto")),
+            ft.ElevatedButton("+ Att", on_click=lambda e: add_field(char_idx, sid, "Atributo")),
+            ft.ElevatedButton("+ Act", on_click=lambda e: add_field(char_idx, sid, "Ação")),
+            ft.IconButton(ft.Icons.DELETE_FOREVER, icon_color="red",
+                          on_click=lambda e: delete_segment(char_idx, sid))
+        ])
+
+        # Título Editável
+        seg_title = ft.TextField(value=seg["name"], text_style=ft.TextStyle(weight="bold"),
+                                 border=ft.InputBorder.UNDERLINE,
+                                 on_change=lambda e: update_segment_name(e, sid), expand=True)
+
+        tile = ft.ExpansionTile(title=seg_title, controls=[fields_col, add_btns, ft.Divider()],
+                                initially_expanded=True)
+        segment_views[sid] = (tile, fields_col)
+        return tile
+
+    @instrument.timed("ui.build_sheet")
+    def build_character_view(char_idx):
+        char = app.character(char_idx)
+        segment_views.clear()
+        field_rows.clear()
+        action_stats.clear()
+        attr_results.clear()
 
-            segments_col.controls.append(
-                ft.ExpansionTile(title=seg_title, controls=[fields_col, add_btns, ft.Divider()],
-                                 initially_expanded=True))
+        name_field = ft.TextField(label="Nome", value=char["name"], on_change=lambda e: update_char_name(e, char_idx))
+        segments_col = ft.Column([build_segment_tile(char_idx, seg) for seg in char["segments"]])
+        sheet["char_idx"], sheet["segments_col"] = char_idx, segments_col
 
         return ft.Column(
             [name_field, segments_col, ft.ElevatedButton("Novo Segmento", on_click=lambda e: add_segment(char_idx))])
 
+    def show_current_character():
+        if app.current_char_index is not None and app.current_char_index < len(app.data["characters"]):
+            main_area.content = build_character_view(app.current_char_index)
+        else:
+            main_area.content = ft.Text("Select a Character")
+            sheet["char_idx"], sheet["segments_col"] = None, None
+
     # --- CRUD Básico (Simplificado para caber) ---
+    @instrument.timed("ui.update_view", is_action=True)
     def update_view():
+        """Reconstrói barra lateral e ficha; só usado quando a lista de personagens muda."""
         char_list.controls.clear()
+        char_tiles.clear()
 
         # Botão Global de Regras
         char_list.controls.append(ft.ElevatedButton("⚙ Condicionais", on_click=open_rules_manager, width=200))
+        char_list.controls.append(ft.ElevatedButton("🎲 Rolagem em Grupo", on_click=open_party_roll, width=200))
+        char_list.controls.append(ft.ElevatedButton("📈 Diagnóstico", on_click=open_diagnostics, width=200))
+        char_list.controls.append(ft.Row([
+            ft.ElevatedButton("↶ Desfazer", on_click=lambda e: undo_redo(app.undo, "Desfeito"), expand=True),
+            ft.ElevatedButton("↷ Refazer", on_click=lambda e: undo_redo(app.redo, "Refeito"), expand=True),
+        ], width=200))
         char_list.controls.append(ft.Divider())
 
         for idx, char in enumerate(app.data["characters"]):
-            char_list.controls.append(ft.ListTile(
+            tile = ft.ListTile(
                 title=ft.Text(char["name"]), leading=ft.Icon(ft.Icons.PERSON),
                 trailing=ft.IconButton(ft.Icons.DELETE_FOREVER, icon_color="red",
                                        on_click=lambda e, i=idx: request_delete(e, i)),
                 on_click=lambda e, i=idx: select_char(i), selected=(idx == app.current_char_index)
-            ))
+            )
+            char_tiles.append(tile)
+            char_list.controls.append(tile)
         char_list.controls.append(ft.ListTile(title=ft.Text("New Character +"), on_click=create_char))
 
-        if app.current_char_index is not None and app.current_char_index < len(app.data["characters"]):
-            main_area.content = build_character_view(app.current_char_index)
-        else:
-            main_area.content = ft.Text("Select a Character")
-        page.update()
-
+        show_current_character()
+        with instrument.span("ui.page_update"):
+            page.update()
+
+    @instrument.timed("ui.undo_redo", is_action=True)
+    def undo_redo(step, verb):
+        """Desfaz/refaz uma edição, abre o personagem que ela mexeu e reconstrói a tela."""
+        result = step()
+        if result is None: return
+        label, char = result
+        if char is not None:
+            app.current_char_index = next(
+                (i for i, c in enumerate(app.data["characters"]) if c is char), app.current_char_index)
+        update_view()
+        page.open(ft.SnackBar(ft.Text(f"{verb}: {label}")))
+
+    @instrument.timed("ui.open_character", is_action=True)
     def select_char(idx):
-        app.current_char_index = idx; update_view()
-
+        changed = [main_area]
+        for i in (app.current_char_index, idx):
+            if i is not None and i < len(char_tiles):
+                char_tiles[i].selected = (i == idx)
+                changed.append(char_tiles[i])
+        app.current_char_index = idx
+        show_current_character()
+        with instrument.span("ui.page_update"):
+            page.update(*changed)
+
+    @instrument.timed("ui.create_character", is_action=True)
     def create_char(e):
-        app.data["characters"].append({"name": "Novo", "segments": []}); app.save_data(); select_char(
-            len(app.data["characters"]) - 1)
+        app.current_char_index = app.create_character(); update_view()
 
     def update_char_name(e, idx):
-        app.data["characters"][idx]["name"] = e.control.value; app.save_data()
+        app.rename_character(idx, e.control.value)
 
+    @instrument.timed("ui.add_segment", is_action=True)
     def add_segment(idx):
-        app.data["characters"][idx]["segments"].append(
-            {"name": "Novo Seg", "fields": []}); app.save_data(); update_view()
-
-    def update_segment_name(e, c_idx, s_idx):
-        app.data["characters"][c_idx]["segments"][s_idx]["name"] = e.control.value; app.save_data()
-
-    def delete_segment(c, s):
-        app.data["characters"][c]["segments"].pop(s); app.save_data(); update_view()
-
-    def add_field(c, s, t):
-        app.data["characters"][c]["segments"][s]["fields"].append(
-            {"type": t, "name": "Novo", "value": ""}); app.save_data(); update_view()
-
-    def update_field_val(e, c, s, f):
-        app.data["characters"][c]["segments"][s]["fields"][f]["value"] = e.control.value; app.save_data()
-
-    def update_field_name(e, c, s, f):
-        app.data["characters"][c]["segments"][s]["fields"][f]["name"] = e.control.value; app.save_data()
-
-    def delete_field(e, c, s, f):
-        app.data["characters"][c]["segments"][s]["fields"].pop(f); app.save_data(); update_view()
+        seg = app.add_segment(idx)
+        segments_col = sheet["segments_col"]
+        segments_col.controls.append(build_segment_tile(idx, seg))
+        segments_col.update()
+
+    def update_segment_name(e, seg_id):
+        app.rename_segment(seg_id, e.control.value)
+
+    @instrument.timed("ui.delete_segment", is_action=True)
+    def delete_segment(c, seg_id):
+        version = app.context_version(c)
+        seg = app.delete_segment(seg_id)
+        for field in seg["fields"]:
+            field_rows.pop(field["id"], None)
+            action_stats.pop(field["id"], None)
+            attr_results.pop(field["id"], None)
+        tile, _ = segment_views.pop(seg_id)
+        segments_col = sheet["segments_col"]
+        segments_col.controls.remove(tile)
+        segments_col.update()
+        if app.context_version(c) != version: context_changed(c)
+
+    @instrument.timed("ui.add_field", is_action=True)
+    def add_field(c, seg_id, t):
+        field = app.add_field(seg_id, t)
+        _, fields_col = segment_views[seg_id]
+        fields_col.controls.append(build_field_row(c, field))
+        fields_col.update()
+
+    @instrument.timed("ui.edit_field", is_action=True)
+    def update_field_val(e, c, field_id):
+        version = app.context_version(c)
+        field = app.update_field(field_id, value=e.control.value)
+        if app.context_version(c) != version:
+            context_changed(c, delay=STATS_DEBOUNCE)
+        elif field["type"] == "Ação":
+            refresh_action_stats(c, [field_id], delay=STATS_DEBOUNCE)
+        elif field["type"] == "Atributo":
+            refresh_attributes(c, [field_id])
+
+    @instrument.timed("ui.edit_field", is_action=True)
+    def update_field_name(e, c, field_id):
+        version = app.context_version(c)
+        app.update_field(field_id, name=e.control.value)
+        if app.context_version(c) != version: context_changed(c, delay=STATS_DEBOUNCE)
+
+    @instrument.timed("ui.delete_field", is_action=True)
+    def delete_field(e, c, field_id):
+        version = app.context_version(c)
+        seg_id = app.segment_of(field_id)["id"]
+        app.delete_field(field_id)
+        row = field_rows.pop(field_id)
+        action_stats.pop(field_id, None)
+        attr_results.pop(field_id, None)
+        _, fields_col = segment_views[seg_id]
+        fields_col.controls.remove(row)
+        fields_col.update()
+        if app.context_version(c) != version: context_changed(c)
 
     char_list = ft.ListView(width=260, spacing=10)
     main_area = ft.Container(expand=True, padding=20)
     page.add(ft.Row(
-        [ft.Column([ft.Text("RPG Maker", size=20, weight="bold"), char_list, ft.Divider(), log_view], width=320),
+        [ft.Column([ft.Text("RPG Maker", size=20, weight="bold"), char_list, ft.Divider(), roll_log.view], width=320),
          ft.VerticalDivider(), main_area], expand=True))
     update_view()
 
+    if app.load_error:  # campanha ilegível: começou vazia, mas o arquivo original foi guardado
+        page.open(ft.AlertDialog(title=ft.Text("Campanha não carregada"), content=ft.Text(app.load_error)))
+
 
-ft.app(target=main)
\ No newline at end of file
+if __name__ == "__main__":
+    ft.app(target=main)
\ No newline at end of file
@@ -0,0 +1,153 @@
+import atexit
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+import instrument
+
+SAVE_DELAY = 0.5  # segundos de silêncio antes de gravar
+SAVE_MAX_DELAY = 5.0  # nunca segura uma alteração por mais que isso, mesmo digitando sem parar
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindStore:
+    """
+    Persistência em JSON com escrita atrasada (write-behind).
+    save() só marca os dados como sujos; uma thread em segundo plano espera o usuário parar de
+    editar (debounce), junta todas as alterações pendentes em uma única gravação e escreve de forma
+    atômica (arquivo temporário + rename). close() é chamado no exit e garante o flush final.
+    """
+
+    def __init__(self, path: str, delay: float = SAVE_DELAY, max_delay: float = SAVE_MAX_DELAY,
+                 compact: bool = False):
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.compact = compact
+
+        self._data = None
+        self._dirty = False
+        self._first_dirty = 0.0
+        self._last_dirty = 0.0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.writes = 0
+
+        atexit.register(self.close)
+
+    def load(self, default: dict) -> dict:
+        if not os.path.exists(self.path):
+            return default
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(self, data: dict):
+        """Agenda a gravação de `data` (não bloqueia). Depois de close(), grava na hora."""
+        with self._cond:
+            if not self._closing:
+                now = time.monotonic()
+                if not self._dirty:
+                    self._first_dirty = now
+                self._data = data
+                self._dirty = True
+                self._last_dirty = now
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+                return
+            # Fechado: não há thread para agendar, e a alteração se perderia em silêncio
+            self._dirty = False
+        self._write(data)
+
+    def flush(self):
+        """Grava agora, se houver algo pendente."""
+        with self._cond:
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = self._data
+        self._write(data)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    return  # close() faz o flush final
+
+                # Debounce: espera um intervalo sem edições, limitado por max_delay
+                while not self._closing:
+                    deadline = min(self._last_dirty + self.delay, self._first_dirty + self.max_delay)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closing:
+                    return
+                self._dirty = False
+                data = self._data
+
+            try:
+                self._write(data)
+            except RuntimeError:
+                # Dados alterados durante a serialização: tenta de novo na próxima rodada
+                self.save(data)
+            except Exception:
+                # Qualquer erro (disco, dados não serializáveis...) fica no log; a thread segue viva
+                log.exception("Erro ao salvar %s", self.path)
+
+    def _write(self, data: dict):
+        with self._write_lock, instrument.span("persist.json_write"):
+            if self.compact:
+                text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+            else:
+                text = json.dumps(data, indent=4, ensure_ascii=False)
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                mode = stat.S_IMODE(os.stat(self.path).st_mode)
+            except FileNotFoundError:
+                mode = None
+            fd, tmp_path = _create_temp(directory)
+            try:
+                # O replace não pode mudar as permissões do arquivo do usuário; arquivo novo fica
+                # com o 0666 menos a umask, como o open() faria
+                if mode is not None:
+                    os.chmod(tmp_path, mode)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self.writes += 1
+            instrument.count("persist.json_chars", len(text))
+
+
+def _create_temp(directory: str):
+    """Cria um arquivo temporário exclusivo em `directory` com 0666 (a umask do processo se aplica)."""
+    while True:
+        path = os.path.join(directory, ".tmp-%s.json" % os.urandom(8).hex())
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+        except FileExistsError:
+            continue
@@ -0,0 +1,341 @@
+from math import comb
+
+from dice_engine import DiceTerm, FormulaPlan, VarTerm
+
+DEFAULT_EXPLODE_DEPTH = 20
+
+
+class Distribution:
+    """
+    Distribuição exata (PMF) do total de uma fórmula.
+    probs[i] é a probabilidade do total valer offset + i.
+    truncated é um limite superior da chance de alguma cadeia de explosão ter sido cortada
+    pela profundidade máxima (a massa continua na PMF, somada no ponto do corte).
+    samples > 0 marca uma estimativa por amostragem (ver sampled_distribution), não a exata.
+    """
+
+    __slots__ = ("offset", "probs", "truncated", "samples")
+
+    def __init__(self, offset: int, probs: list, truncated: float = 0.0, samples: int = 0):
+        self.offset = offset
+        self.probs = probs
+        self.truncated = truncated
+        self.samples = samples
+
+    @property
+    def min(self) -> int:
+        return self.offset
+
+    @property
+    def max(self) -> int:
+        return self.offset + len(self.probs) - 1
+
+    def pmf(self) -> dict:
+        return {self.offset + i: p for i, p in enumerate(self.probs) if p}
+
+    def mean(self) -> float:
+        return sum((self.offset + i) * p for i, p in enumerate(self.probs))
+
+    def variance(self) -> float:
+        mu = self.mean()
+        return sum((self.offset + i - mu) ** 2 * p for i, p in enumerate(self.probs))
+
+    def prob_at_least(self, value: int) -> float:
+        """Chance de o total ser >= value (ex: acertar uma CD)."""
+        start = max(value - self.offset, 0)
+        return sum(self.probs[start:])
+
+    def prob_at_most(self, value: int) -> float:
+        end = value - self.offset + 1
+        if end <= 0:
+            return 0.0
+        return sum(self.probs[:end])
+
+
+# --- Operações sobre PMFs representadas como (offset, lista de probabilidades) ---
+
+def _convolve(a: tuple, b: tuple) -> tuple:
+    a_off, a_probs = a
+    b_off, b_probs = b
+    out = [0.0] * (len(a_probs) + len(b_probs) - 1)
+    for i, pa in enumerate(a_probs):
+        if not pa: continue
+        for j, pb in enumerate(b_probs):
+            out[i + j] += pa * pb
+    return a_off + b_off, out
+
+
+def _power(pmf: tuple, n: int) -> tuple:
+    """Convolução de n cópias independentes (exponenciação por quadrados)."""
+    result = (0, [1.0])
+    base = pmf
+    while n:
+        if n & 1:
+            result = _convolve(result, base)
+        n >>= 1
+        if n:
+            base = _convolve(base, base)
+    return result
+
+
+def _add(acc: dict, key: int, p: float):
+    acc[key] = acc.get(key, 0.0) + p
+
+
+def _from_dict(values: dict) -> tuple:
+    if not values:
+        return 0, [0.0]
+    low = min(values)
+    probs = [0.0] * (max(values) - low + 1)
+    for k, p in values.items():
+        probs[k - low] += p
+    return low, probs
+
+
+def _scale(pmf: tuple, factor: float) -> tuple:
+    return pmf[0], [p * factor for p in pmf[1]]
+
+
+def _accumulate(acc: list, pmf: tuple):
+    """Soma (mistura) pmf em acc, que é [offset, probs] mutável."""
+    off, probs = pmf
+    if acc[1] is None:
+        acc[0], acc[1] = off, list(probs)
+        return
+    low = min(acc[0], off)
+    high = max(acc[0] + len(acc[1]), off + len(probs))
+    merged = [0.0] * (high - low)
+    for i, p in enumerate(acc[1]):
+        merged[acc[0] - low + i] += p
+    for i, p in enumerate(probs):
+        merged[off - low + i] += p
+    acc[0], acc[1] = low, merged
+
+
+# --- Peças por dado ---
+
+def die_outcomes(sides: int, active_rules: list, is_first: bool) -> dict:
+    """
+    Distribuição conjunta de um dado depois de apply_custom_rules:
+    {face final: {bônus: probabilidade}}. O bônus vem dos efeitos 'add' e 'explode' das regras.
+    """
+    states = {(v, 0): 1.0 / sides for v in range(1, sides + 1)}
+    for rule in active_rules:
+        if rule["scope"] == "first":
+            if not is_first: continue
+        elif rule["scope"] != "any":
+            continue
+
+        trigger = int(rule["trigger_val"])
+        effect = rule["effect"]
+        if effect not in ("reroll", "add", "explode"):
+            continue
+
+        new_states = {}
+        for (face, bonus), p in states.items():
+            if face != trigger:
+                new_states[(face, bonus)] = new_states.get((face, bonus), 0.0) + p
+            elif effect == "reroll":
+                for w in range(1, sides + 1):
+                    new_states[(w, bonus)] = new_states.get((w, bonus), 0.0) + p / sides
+            elif effect == "add":
+                key = (face, bonus + int(rule["effect_param"]))
+                new_states[key] = new_states.get(key, 0.0) + p
+            else:
+                for w in range(1, sides + 1):
+                    key = (face, bonus + w)
+                    new_states[key] = new_states.get(key, 0.0) + p / sides
+        states = new_states
+
+    outcomes = {}
+    for (face, bonus), p in states.items():
+        outcomes.setdefault(face, {})
+        _add(outcomes[face], bonus, p)
+    return outcomes
+
+
+def explosion_chain(sides: int, target: int, depth: int) -> tuple:
+    """
+    Distribuição do extra somado por uma cadeia de explosão nativa (o dado inicial já bateu o alvo),
+    limitada a `depth` dados extras. Retorna (pmf, massa truncada).
+    """
+    hit = max(sides - max(target, 1) + 1, 0) / sides
+    chain = (0, [1.0])
+    for _ in range(depth):
+        acc = [0, None]
+        stop = {}
+        for y in range(1, sides + 1):
+            if y >= target:
+                _accumulate(acc, (chain[0] + y, [p / sides for p in chain[1]]))
+            else:
+                _add(stop, y, 1.0 / sides)
+        if stop:
+            _accumulate(acc, _from_dict(stop))
+        chain = (acc[0], acc[1])
+    return chain, hit ** depth
+
+
+# --- Termos ---
+
+def _term_distribution(term: DiceTerm, active_rules: list, explode_depth: int) -> tuple:
+    """Retorna (pmf, massa truncada) do valor parcial de um termo NdM (antes do sinal)."""
+    sides = term.lados
+    n = term.qtd
+    if n == 0:
+        return (0, [1.0]), 0.0
+
+    others = die_outcomes(sides, active_rules, is_first=False)
+    first = die_outcomes(sides, active_rules, is_first=True)
+    special = first if first != others else None
+
+    chain, truncated = None, 0.0
+    if term.explode is not None and term.explode <= sides:
+        chain, truncated = explosion_chain(sides, term.explode, explode_depth)
+
+    def kept_pmf(face: int, kept: int) -> tuple:
+        """Contribuição de `kept` dados mantidos com a mesma face (face + cadeias de explosão)."""
+        base = (face * kept, [1.0])
+        if chain is not None and kept and face >= term.explode:
+            base = _convolve(base, _power(chain, kept))
+        return base
+
+    # Sem drop: cada dado soma face + bônus + explosão; basta convoluir os dados.
+    if 'dl' not in term.mods and 'dh' not in term.mods:
+        def single(outcomes):
+            acc = [0, None]
+            for face, bonus in outcomes.items():
+                _accumulate(acc, _convolve(kept_pmf(face, 1), _from_dict(bonus)))
+            return acc[0], acc[1]
+
+        if special is None:
+            total = _power(single(others), n)
+        else:
+            total = _convolve(single(special), _power(single(others), n - 1))
+        truncated_mass = 1 - (1 - truncated) ** n if chain is not None else 0.0
+        return total, truncated_mass
+
+    # Com drop: contagem por estatística de ordem. Percorremos as faces em ordem crescente,
+    # decidindo quantos dados caem em cada face; as posições ordenadas [lo, hi) são as mantidas.
+    lo = min(term.drop_low, n) if 'dl' in term.mods else 0
+    hi = n
+    if 'dh' in term.mods:
+        hi = n - term.drop_high if term.drop_high < n - lo else lo
+
+    m = n - 1 if special is not None else n
+    faces = range(1, sides + 1)
+    bonus_others = {v: _from_dict(others.get(v, {})) if v in others else None for v in faces}
+    bonus_special = {}
+    if special is not None:
+        bonus_special = {v: _from_dict(special[v]) if v in special else None for v in faces}
+
+    # powers[v][c] = bônus somado (e massa) de c dados comuns com face v
+    powers = {}
+    for v in faces:
+        row = [(0, [1.0])]
+        if bonus_others[v] is not None:
+            for _ in range(m):
+                row.append(_convolve(row[-1], bonus_others[v]))
+        powers[v] = row
+
+    # estado: (dados comuns posicionados, dado especial posicionado) -> pmf parcial
+    states = {(0, 0): (0, [1.0])}
+    for v in faces:
+        new_states = {}
+        for (j, s), pmf in states.items():
+            placed = j + s
+            special_options = (0, 1) if special is not None and not s else (0,)
+            for d in special_options:
+                if d and bonus_special[v] is None: continue
+                max_c = m - j if bonus_others[v] is not None else 0
+                for c in range(max_c + 1):
+                    count = c + d
+                    kept = max(0, min(placed + count, hi) - max(placed, lo))
+                    piece = _scale(powers[v][c], comb(m - j, c))
+                    if d:
+                        piece = _convolve(piece, bonus_special[v])
+                    piece = _convolve(piece, kept_pmf(v, kept))
+                    key = (j + c, s + d)
+                    acc = new_states.get(key)
+                    result = _convolve(pmf, piece)
+                    if acc is None:
+                        new_states[key] = result
+                    else:
+                        merged = [acc[0], acc[1]]
+                        _accumulate(merged, result)
+                        new_states[key] = (merged[0], merged[1])
+        states = new_states
+
+    final = states.get((m, 1 if special is not None else 0), (0, [0.0]))
+    kept_count = max(hi - lo, 0)
+    truncated_mass = 1 - (1 - truncated) ** kept_count if chain is not None else 0.0
+    return final, truncated_mass
+
+
+def formula_distribution(plan: FormulaPlan, bound: dict, active_rules: list,
+                         explode_depth: int = DEFAULT_EXPLODE_DEPTH) -> Distribution:
+    """
+    Distribuição exata do total do plano, convoluindo os termos.
+    `bound` vem de FormulaPlan.bind(context).
+    """
+    total = (0, [1.0])
+    survive = 1.0
+    for term in plan.resolve(bound):
+        if isinstance(term, DiceTerm):
+            pmf, truncated = _term_distribution(term, active_rules, explode_depth)
+            survive *= 1 - truncated
+        elif isinstance(term, VarTerm):
+            pmf = (bound[term.name], [1.0])
+        else:
+            pmf = (term.value, [1.0])
+
+        if term.sign == '-':
+            off, probs = pmf
+            pmf = (-(off + len(probs) - 1), probs[::-1])
+        total = _convolve(total, pmf)
+
+    # Remove zeros nas pontas (faces impossíveis) para min/max refletirem o suporte real
+    off, probs = total
+    start = 0
+    while start < len(probs) - 1 and not probs[start]:
+        start += 1
+    end = len(probs)
+    while end > start + 1 and not probs[end - 1]:
+        end -= 1
+    return Distribution(off + start, probs[start:end], 1 - survive)
+
+
+def sampled_distribution(totals) -> Distribution:
+    """Distribuição empírica de uma amostra de totais (ex: DiceEngine.roll_many), para fórmulas caras demais."""
+    totals = [int(t) for t in totals]
+    low = min(totals)
+    counts = [0] * (max(totals) - low + 1)
+    for t in totals:
+        counts[t - low] += 1
+    n = len(totals)
+    return Distribution(low, [c / n for c in counts], samples=n)
+
+
+def distribution_cost(plan: FormulaPlan, bound: dict, explode_depth: int = DEFAULT_EXPLODE_DEPTH) -> int:
+    """
+    Estimativa do trabalho de formula_distribution (até ~50ns por unidade), sem calcular nada.
+    A PMF de um termo tem ~qtd x faces x profundidade da explosão pontos; sem drop o custo vem das
+    convoluções (pontos²), com dl/dh da contagem por estatística de ordem (faces x qtd² x pontos),
+    vezes as cadeias de explosão dos dados mantidos nas faces que explodem.
+    """
+    cost = 0
+    support = 1
+    for term in plan.resolve(bound):
+        if not isinstance(term, DiceTerm):
+            continue
+        depth, exploding = 1, 0.0
+        if term.explode is not None and term.explode <= term.lados:
+            depth = explode_depth + 1
+            exploding = (term.lados - max(term.explode, 1) + 1) / term.lados
+        points = term.qtd * term.lados * depth
+        if 'dl' in term.mods or 'dh' in term.mods:
+            cost += int(term.lados * term.qtd ** 2 * points * (1 + term.qtd * exploding * depth))
+        else:
+            cost += points ** 2
+        cost += support * points  # convolução com os termos anteriores
+        support += points
+    return cost
@@ -0,0 +1,154 @@
+import secrets
+from random import Random, SystemRandom
+
+BLOCK_SIZE = 4096
+_MASK64 = (1 << 64) - 1
+
+
+class RandomSource:
+    """
+    Fonte de números do DiceEngine.
+    roll(faces) devolve um inteiro uniforme em [1, faces]; random() um float em [0, 1).
+    tell()/seek() expõem a posição no fluxo: com (nome, seed, posição) a rolagem é reproduzida exatamente.
+    """
+
+    name = "base"
+    seed = None
+
+    def roll(self, faces: int) -> int:
+        raise NotImplementedError
+
+    def random(self) -> float:
+        raise NotImplementedError
+
+    def randint(self, low: int, high: int) -> int:
+        return low - 1 + self.roll(high - low + 1)
+
+    def tell(self):
+        return None
+
+    def seek(self, offset):
+        raise ValueError(f"a fonte '{self.name}' não é reproduzível")
+
+
+class BufferedRandomSource(RandomSource):
+    """
+    Fonte padrão (rápida): gera blocos de inteiros uniformes por quantidade de faces de uma vez
+    e depois só consome da lista. Cada bloco vem de um Random semeado por (seed, faces, nº do bloco),
+    então a posição de cada fluxo basta para reproduzir tudo, sem regerar o histórico.
+    """
+
+    name = "buffered"
+    FLOATS = -1  # chave do fluxo de random(): fora das faces válidas, então roll(0) nunca o lê
+
+    def __init__(self, seed: int = None, block_size: int = BLOCK_SIZE):
+        self.seed = secrets.randbits(64) if seed is None else seed
+        self.block_size = block_size
+        self._state = {}  # faces (FLOATS = floats) -> [valores do bloco, índice no bloco, nº do bloco]
+
+    def _load(self, faces: int, block_no: int) -> list:
+        label = "f" if faces == self.FLOATS else faces  # rótulo próprio: nenhum dado semeia o fluxo dos floats
+        rnd = Random(f"{self.seed}:{label}:{block_no}")
+        if faces == self.FLOATS:
+            values = [rnd.random() for _ in range(self.block_size)]
+        else:
+            values = rnd.choices(range(1, faces + 1), k=self.block_size)
+        state = [values, 0, block_no]
+        self._state[faces] = state
+        return state
+
+    def roll(self, faces: int) -> int:
+        state = self._state.get(faces)
+        if state is None:
+            if faces < 1:
+                raise ValueError(f"dado sem faces (d{faces})")
+            state = self._load(faces, 0)
+        elif state[1] == self.block_size:
+            state = self._load(faces, state[2] + 1)
+        value = state[0][state[1]]
+        state[1] += 1
+        return value
+
+    def random(self) -> float:
+        state = self._state.get(self.FLOATS)
+        if state is None or state[1] == self.block_size:
+            state = self._load(self.FLOATS, 0 if state is None else state[2] + 1)
+        value = state[0][state[1]]
+        state[1] += 1
+        return value
+
+    def tell(self):
+        return tuple(sorted((faces, st[2] * self.block_size + st[1]) for faces, st in self._state.items()))
+
+    def seek(self, offset):
+        self._state.clear()
+        for faces, pos in offset or ():
+            if faces < 1 and faces != self.FLOATS:
+                raise ValueError(f"posição inválida para a fonte '{self.name}': d{faces}")
+            block_no, index = divmod(pos, self.block_size)
+            self._load(faces, block_no)[1] = index
+
+
+class SeededRandomSource(RandomSource):
+    """
+    Fonte determinística para replays e testes: fluxo único baseado em contador (splitmix64).
+    O valor n depende só de (seed, n), então seek() é O(1) e a posição é um inteiro simples.
+    """
+
+    name = "seeded"
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self.counter = 0
+
+    def _next(self) -> int:
+        self.counter += 1
+        z = (self.seed + self.counter * 0x9E3779B97F4A7C15) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+
+    def roll(self, faces: int) -> int:
+        if faces < 1:
+            raise ValueError(f"dado sem faces (d{faces})")
+        return ((self._next() * faces) >> 64) + 1
+
+    def random(self) -> float:
+        return (self._next() >> 11) * (1.0 / (1 << 53))
+
+    def tell(self):
+        return self.counter
+
+    def seek(self, offset):
+        self.counter = offset or 0
+
+
+class SecureRandomSource(RandomSource):
+    """Fonte criptográfica (secrets) para torneios: imprevisível e, por isso, não reproduzível."""
+
+    name = "secure"
+
+    def __init__(self):
+        self._system = SystemRandom()
+
+    def roll(self, faces: int) -> int:
+        return secrets.randbelow(faces) + 1
+
+    def random(self) -> float:
+        return self._system.random()
+
+
+SOURCES = {
+    BufferedRandomSource.name: BufferedRandomSource,
+    SeededRandomSource.name: SeededRandomSource,
+    SecureRandomSource.name: SecureRandomSource,
+}
+
+
+def make_source(name: str, seed: int = None) -> RandomSource:
+    """Cria a fonte pelo nome ("buffered", "seeded", "secure")."""
+    if name not in SOURCES:
+        raise ValueError(f"fonte de números desconhecida '{name}'")
+    if name == SecureRandomSource.name:
+        return SecureRandomSource()
+    return SOURCES[name](seed) if seed is not None else SOURCES[name]()
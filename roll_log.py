@@ -0,0 +1,31 @@
+import flet as ft
+
+LOG_CAPACITY = 200  # rolagens mantidas no painel
+
+
+class RollLog:
+    """
+    Painel de log das rolagens.
+    Cada rolagem vira um único ft.Text (uma linha por span) inserido no topo de um ListView
+    (renderização virtualizada), com um único update por rolagem. A própria lista de controles é o
+    buffer limitado: passando de `capacity`, a rolagem mais antiga sai, então memória e custo de
+    atualização não crescem com a duração da sessão.
+    """
+
+    def __init__(self, capacity: int = LOG_CAPACITY, height: int = 150):
+        self.capacity = capacity
+        self.view = ft.ListView(height=height, spacing=4)
+
+    def add(self, lines: list):
+        """Adiciona uma rolagem (lista de (texto, cor)) como um único controle."""
+        spans = [ft.TextSpan(text + ("\n" if i < len(lines) - 1 else ""), ft.TextStyle(color=color))
+                 for i, (text, color) in enumerate(lines)]
+        controls = self.view.controls
+        controls.insert(0, ft.Text(spans=spans, selectable=True))
+        if len(controls) > self.capacity:
+            del controls[self.capacity:]
+        self.view.update()
+
+    def clear(self):
+        self.view.controls.clear()
+        self.view.update()
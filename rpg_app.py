@@ -0,0 +1,520 @@
+"""
+Modelo de dados e lógica de rolagem da ficha, sem interface.
+Não importa flet (nem NumPy): é usado pela UI (main.py), pela CLI (yoursheet.py) e por scripts/bots.
+"""
+import os
+import instrument
+from context_cache import ContextCache
+from dice_engine import DiceEngine, RuleTable
+from history import RollHistory, history_path
+from storage import CampaignLoadError, new_id, open_storage
+from undo import UndoHistory
+
+FILE_NAME = "rpg_data.json"
+DB_NAME = "rpg_data.db"  # se existir (ver storage.py para migrar), usa o backend SQLite
+COMPACT_JSON = False  # True grava sem indentação (arquivo menor, gravação mais rápida)
+
+
+def summarize_totals(totals) -> dict:
+    """Resumo de uma amostra de totais (lista ou array do roll_many): média, desvio e percentis."""
+    values = sorted(totals.tolist() if hasattr(totals, "tolist") else totals)
+    n = len(values)
+    mean = sum(values) / n
+    variance = sum((v - mean) ** 2 for v in values) / n
+
+    def pct(p):
+        return values[min(n - 1, int(p * n))]
+
+    return {"trials": n, "mean": mean, "stdev": variance ** 0.5, "min": values[0], "p5": pct(0.05),
+            "median": pct(0.5), "p95": pct(0.95), "max": values[-1]}
+
+
+def summarize_histogram(hist) -> dict:
+    """O mesmo resumo de summarize_totals, a partir de um simulation.Histogram (sem a amostra inteira)."""
+    n = hist.total
+    mean = hist.mean()
+
+    def pct(p):
+        k = min(n - 1, int(p * n))  # mesma posição que summarize_totals pega na lista ordenada
+        acc = 0
+        for i, c in enumerate(hist.counts):
+            acc += c
+            if acc > k:
+                return hist.offset + i
+
+    return {"trials": n, "mean": mean, "stdev": hist.variance() ** 0.5, "min": hist.min, "p5": pct(0.05),
+            "median": pct(0.5), "p95": pct(0.95), "max": hist.max}
+
+
+def _remove_by_identity(items, item):
+    for i, current in enumerate(items):
+        if current is item:
+            del items[i]
+            return i
+    return None
+
+
+class RPGApp:
+    def __init__(self, path=None):
+        if path is None:
+            path = DB_NAME if os.path.exists(DB_NAME) else FILE_NAME
+        self.storage = open_storage(path, compact_json=COMPACT_JSON)
+        self.history = RollHistory(history_path(path))  # só cria a pasta na primeira rolagem
+        self.data = self.load_data()
+        self.engine = DiceEngine()
+        self.contexts = ContextCache()
+        self.undo_history = UndoHistory()  # deltas das edições do CRUD abaixo (ver undo.py)
+        self.current_char_index = None
+        self._rule_index = {}  # id -> (posição em global_rules, regra)
+        self._rule_tables = {}  # ids da ação -> RuleTable compilado
+        self._segments = {}  # id -> (personagem, segmento)
+        self._fields = {}  # id -> (personagem, segmento, campo)
+        self._indexed = set()  # ids dos personagens já indexados
+        self.reindex_rules()
+
+    def load_data(self):
+        """
+        Carrega a campanha. Arquivo inexistente = campanha vazia. Arquivo ilegível também começa vazio,
+        mas não some: o storage o guarda ao lado e load_error traz a mensagem (a UI e a CLI mostram).
+        Outros erros (permissão, disco) sobem em vez de virar uma campanha vazia.
+        """
+        self.load_error = None
+        try:
+            with instrument.span("app.load_data"):
+                return self.storage.load()
+        except CampaignLoadError as e:
+            self.load_error = str(e)
+            return e.data
+
+    def save_data(self):
+        """Regrava a campanha inteira (as edições do dia a dia usam os métodos granulares abaixo)."""
+        with instrument.span("app.save_data"):
+            self.storage.save_all(self.data)
+
+    # --- Acesso e CRUD (mantêm o storage sincronizado campo a campo) ---
+    # Segmentos e campos são endereçados pelo id estável, não pela posição na lista.
+
+    def character(self, idx):
+        """Retorna o personagem, carregando segmentos/campos do storage na primeira vez."""
+        char = self.data["characters"][idx]
+        if char.get("segments") is None:
+            with instrument.span("app.load_character"):
+                self.storage.load_character(char)
+        if char["id"] not in self._indexed:
+            self._index_character(char)
+        return char
+
+    def _index_character(self, char):
+        self._indexed.add(char["id"])
+        for seg in char["segments"]:
+            self._segments[seg["id"]] = (char, seg)
+            for field in seg["fields"]:
+                self._fields[field["id"]] = (char, seg, field)
+
+    def _unindex_segment(self, seg):
+        self._segments.pop(seg["id"], None)
+        for field in seg["fields"]:
+            self._fields.pop(field["id"], None)
+
+    def get_field(self, field_id):
+        return self._fields[field_id][2]
+
+    def locate_field(self, field_id):
+        """
+        Como get_field, mas carrega e indexa o personagem dono se preciso: quem chega só com o id
+        (ex: o servidor) pode citar o campo de uma ficha que ninguém abriu. KeyError se não existe.
+        """
+        if field_id in self._fields:
+            return self._fields[field_id][2]
+        chars = self.data["characters"]
+        owner = self.storage.field_owner(field_id)
+        if owner is not None:
+            candidates = [i for i, char in enumerate(chars) if char["id"] == owner]
+        elif self.storage.lazy:
+            raise KeyError(field_id)  # o backend conhece todos os campos gravados
+        else:  # JSON (ou gravações ainda na fila do BatchedStorage): procura nos personagens não indexados
+            candidates = [i for i, char in enumerate(chars) if char["id"] not in self._indexed]
+        for idx in candidates:
+            self.character(idx)
+            if field_id in self._fields:
+                return self._fields[field_id][2]
+        raise KeyError(field_id)
+
+    def get_segment(self, seg_id):
+        return self._segments[seg_id][1]
+
+    def segment_of(self, field_id):
+        """Segmento que contém o campo."""
+        return self._fields[field_id][1]
+
+    def create_character(self, name="Novo"):
+        char = {"id": new_id(), "name": name, "segments": []}
+        pos = len(self.data["characters"])
+        self._insert("character", None, pos, char)
+        self.undo_history.record(f"criar personagem '{name}'", ("insert", "character", None, pos, char))
+        return pos
+
+    def rename_character(self, idx, name):
+        char = self.data["characters"][idx]
+        self._edit("character", char, {"name": name}, f"renomear '{char['name']}'")
+
+    def delete_character(self, idx):
+        char = self.character(idx)  # no SQLite carrega os segmentos: o desfazer precisa deles
+        self._remove("character", None, idx, char)
+        self.undo_history.record(f"apagar personagem '{char['name']}'", ("remove", "character", None, idx, char))
+
+    def add_segment(self, c, name="Novo Seg"):
+        char = self.character(c)
+        seg = {"id": new_id(), "name": name, "fields": []}
+        pos = len(char["segments"])
+        self._insert("segment", char, pos, seg)
+        self.undo_history.record(f"criar segmento '{name}'", ("insert", "segment", char, pos, seg))
+        return seg
+
+    def rename_segment(self, seg_id, name):
+        seg = self.get_segment(seg_id)
+        self._edit("segment", seg, {"name": name}, f"renomear '{seg['name']}'")
+
+    def delete_segment(self, seg_id):
+        char, seg = self._segments[seg_id]
+        pos = self._remove("segment", char, None, seg)
+        self.undo_history.record(f"apagar segmento '{seg['name']}'", ("remove", "segment", char, pos, seg))
+        return seg
+
+    def add_field(self, seg_id, field_type):
+        seg = self.get_segment(seg_id)
+        field = {"id": new_id(), "type": field_type, "name": "Novo", "value": ""}
+        pos = len(seg["fields"])
+        self._insert("field", seg, pos, field)
+        self.undo_history.record(f"criar campo {field_type}", ("insert", "field", seg, pos, field))
+        return field
+
+    def update_field(self, field_id, **changes):
+        """
+        Altera chaves do campo (value, name, active_rules) e grava só aquela linha.
+        Listas (active_rules) devem vir novas, não alteradas no lugar: o desfazer guarda a antiga.
+        """
+        field = self.get_field(field_id)
+        self._edit("field", field, changes, f"editar '{field['name']}'")
+        return field
+
+    def delete_field(self, field_id):
+        _, seg, field = self._fields[field_id]
+        pos = self._remove("field", seg, None, field)
+        self.undo_history.record(f"apagar campo '{field['name']}'", ("remove", "field", seg, pos, field))
+        return field
+
+    def add_rule(self, rule):
+        pos = len(self.data["global_rules"])
+        self._insert("rule", None, pos, rule)
+        self.undo_history.record(f"criar regra '{rule['name']}'", ("insert", "rule", None, pos, rule))
+
+    def delete_rule(self, rule_id):
+        if rule_id not in self._rule_index: return
+        pos, rule = self._rule_index[rule_id]
+        self._remove("rule", None, pos, rule)
+        self.undo_history.record(f"apagar regra '{rule['name']}'", ("remove", "rule", None, pos, rule))
+
+    def import_rules(self, rules):
+        """Acrescenta várias regras de uma vez (um reindex só, em vez de um por regra como em add_rule)."""
+        start = len(self.data["global_rules"])
+        self.data["global_rules"].extend(rules)
+        self.reindex_rules()
+        with self.storage.batch():
+            for pos, rule in enumerate(rules, start):
+                self.storage.rule_added(rule, pos)
+
+    def import_character(self, char):
+        """
+        Acrescenta um personagem completo, já com ids e active_rules válidos aqui (ver archive.py).
+        Num backend lazy ele sai da memória depois de gravado e só volta quando for aberto.
+        """
+        self.data["characters"].append(char)
+        self.storage.character_imported(char, len(self.data["characters"]) - 1)
+        if self.storage.lazy:
+            char["segments"] = None
+        return len(self.data["characters"]) - 1
+
+    def discard_import(self, characters, rules):
+        """
+        Desfaz na memória uma importação interrompida: tira os personagens e regras acima dessas
+        contagens. O SQLite já reverteu a transação do batch(); o JSON é regravado sem eles.
+        """
+        for char in self.data["characters"][characters:]:
+            if char["id"] in self._indexed:
+                self._indexed.discard(char["id"])
+                for seg in char["segments"]:
+                    self._unindex_segment(seg)
+        del self.data["characters"][characters:]
+        del self.data["global_rules"][rules:]
+        self.reindex_rules()
+        if not self.storage.lazy:
+            self.storage.save_all(self.data)
+
+    # --- Primitivas de edição (o CRUD acima e o desfazer/refazer passam por aqui) ---
+    # tipo = "character" | "segment" | "field" | "rule"; pai = dict que contém a lista (None no topo).
+
+    def _children(self, kind, parent):
+        if kind == "character": return self.data["characters"]
+        if kind == "rule": return self.data["global_rules"]
+        return parent["segments"] if kind == "segment" else parent["fields"]
+
+    def _insert(self, kind, parent, pos, item):
+        self._children(kind, parent).insert(pos, item)
+        if kind == "character":
+            self._index_character(item)
+            if self.current_char_index is not None and self.current_char_index >= pos:
+                self.current_char_index += 1
+            self.storage.character_imported(item, pos)
+        elif kind == "segment":
+            for field in item["fields"]: self._fields[field["id"]] = (parent, item, field)
+            self._segments[item["id"]] = (parent, item)
+            ctx = self.contexts.peek(parent["id"])
+            if ctx:
+                for field in item["fields"]: ctx.field_added(field)
+            with self.storage.batch():
+                self.storage.segment_added(parent["id"], item, pos)
+                for f_pos, field in enumerate(item["fields"]):
+                    self.storage.field_added(item["id"], field, f_pos)
+        elif kind == "field":
+            char = self._segments[parent["id"]][0]
+            self._fields[item["id"]] = (char, parent, item)
+            ctx = self.contexts.peek(char["id"])
+            if ctx: ctx.field_added(item)
+            self.storage.field_added(parent["id"], item, pos)
+        else:
+            self.reindex_rules()
+            self.storage.rule_added(item, pos)
+
+    def _remove(self, kind, parent, pos, item):
+        """Tira `item` da lista (em `pos`, ou procurando por identidade se pos for None); retorna a posição."""
+        items = self._children(kind, parent)
+        if pos is None or pos >= len(items) or items[pos] is not item:
+            pos = _remove_by_identity(items, item)
+        else:
+            del items[pos]
+        if kind == "character":
+            if item["id"] in self._indexed:
+                self._indexed.discard(item["id"])
+                for seg in item["segments"]: self._unindex_segment(seg)
+            self.contexts.drop(item["id"])
+            if self.current_char_index == pos:
+                self.current_char_index = None
+            elif self.current_char_index is not None and self.current_char_index > pos:
+                self.current_char_index -= 1
+            self.storage.character_deleted(item["id"])
+        elif kind == "segment":
+            self._unindex_segment(item)
+            ctx = self.contexts.peek(parent["id"])
+            if ctx:
+                for field in item["fields"]: ctx.field_removed(field)
+            self.storage.segment_deleted(item["id"])
+        elif kind == "field":
+            char = self._fields.pop(item["id"])[0]
+            ctx = self.contexts.peek(char["id"])
+            if ctx: ctx.field_removed(item)
+            self.storage.field_deleted(item["id"])
+        else:
+            self.reindex_rules()
+            self.storage.rule_deleted(item["id"])
+        return pos
+
+    def _set(self, kind, item, values, removed=()):
+        """Grava `values` no item e tira as chaves `removed` (que não existiam antes de uma edição desfeita)."""
+        old_name = item["name"]
+        for key in removed: item.pop(key, None)
+        item.update(values)
+        if kind == "field":
+            char = self._fields[item["id"]][0]
+            ctx = self.contexts.peek(char["id"])
+            if ctx:
+                if item["name"] != old_name: ctx.name_changed(item, old_name)
+                if "value" in values or "value" in removed: ctx.value_changed(item)
+            self.storage.field_updated(item)
+        elif kind == "segment":
+            self.storage.segment_updated(item)
+        else:
+            self.storage.character_updated(item)
+
+    def _edit(self, kind, item, values, label):
+        before = {key: item[key] for key in values if key in item}
+        self._set(kind, item, values)
+        self.undo_history.record(label, ("set", kind, item, before, dict(values)))
+
+    def _apply(self, delta):
+        op, kind = delta[0], delta[1]
+        if op == "set":
+            _, _, item, before, after = delta
+            self._set(kind, item, after, [key for key in before if key not in after])
+        elif op == "insert":
+            self._insert(kind, *delta[2:])
+        else:
+            self._remove(kind, *delta[2:])
+
+    def _touched_character(self, delta):
+        """Personagem que a edição mexeu (para a UI abri-lo), ou None (regras, personagem apagado)."""
+        op, kind, target = delta[:3]
+        if kind == "field":
+            entry = self._fields.get(target["id"]) if op == "set" else self._segments.get(target["id"])
+            return entry[0] if entry else None
+        if kind == "segment":
+            return self._segments[target["id"]][0] if op == "set" else target
+        if kind == "character":
+            return target if op == "set" else (delta[4] if op == "insert" else None)
+        return None
+
+    def undo(self):
+        """Desfaz a última edição: (rótulo, personagem afetado ou None), ou None se não há o que desfazer."""
+        step = self.undo_history.undo()
+        if step is None: return None
+        label, delta = step
+        self._apply(delta)
+        return label, self._touched_character(delta)
+
+    def redo(self):
+        """Refaz a última edição desfeita; mesmo retorno de undo()."""
+        step = self.undo_history.redo()
+        if step is None: return None
+        label, delta = step
+        self._apply(delta)
+        return label, self._touched_character(delta)
+
+    def reindex_rules(self):
+        """Reconstrói o índice por id e descarta as tabelas compiladas (chamar ao mudar global_rules)."""
+        self._rule_index = {r["id"]: (pos, r) for pos, r in enumerate(self.data["global_rules"])}
+        self._rule_tables.clear()
+
+    def get_context(self, char_idx):
+        """Atributos numéricos do personagem ({nome: valor}); vem do cache incremental, não modifique."""
+        if char_idx is None or char_idx >= len(self.data["characters"]):
+            return {}
+        if instrument.enabled:  # chamado a cada rolagem: o span só é criado com a instrumentação ligada
+            with instrument.span("app.get_context"):
+                return self.contexts.get(self.character(char_idx)).values
+        return self.contexts.get(self.character(char_idx)).values
+
+    def context_version(self, char_idx):
+        """Versão do contexto do personagem: muda sempre que algum atributo muda de valor."""
+        if char_idx is None or char_idx >= len(self.data["characters"]):
+            return 0
+        return self.contexts.get(self.character(char_idx)).version
+
+    def attribute_result(self, char_idx, field_id):
+        """(valor, erro) de um campo Atributo; para um derivado ("(str-10)/2") é o resultado da expressão."""
+        return self.contexts.get(self.character(char_idx)).describe(self.get_field(field_id))
+
+    # --- Consulta e rolagem (uso sem interface) ---
+
+    def find_character(self, name):
+        """Índice do personagem pelo nome (sem diferenciar maiúsculas), ou None."""
+        wanted = name.strip().lower()
+        for idx, char in enumerate(self.data["characters"]):
+            if char["name"].strip().lower() == wanted:
+                return idx
+        return None
+
+    def find_action(self, char_idx, name):
+        """Campo Ação do personagem pelo nome (sem diferenciar maiúsculas), ou None."""
+        wanted = name.strip().lower()
+        for seg in self.character(char_idx)["segments"]:
+            for field in seg["fields"]:
+                if field["type"] == "Ação" and field["name"].strip().lower() == wanted:
+                    return field
+        return None
+
+    def lookup_action(self, char_name, action_name):
+        """(índice do personagem, campo Ação) pelos nomes; LookupError com a mensagem se não achar."""
+        idx = self.find_character(char_name)
+        if idx is None:
+            raise LookupError(f"personagem '{char_name}' não encontrado")
+        field = self.find_action(idx, action_name)
+        if field is None:
+            raise LookupError(f"ação '{action_name}' não encontrada em '{self.data['characters'][idx]['name']}'")
+        return idx, field
+
+    def roll_action(self, char_idx, field_id):
+        """
+        Rola a fórmula da ação com os atributos e as regras dela e registra no histórico.
+        Retorna o RollResult (ou None se vazia).
+        """
+        with instrument.action("app.roll"):
+            field = self.get_field(field_id)
+            if not field["value"]: return None
+            result = self.engine.parse_and_roll(field["value"], self.get_context(char_idx),
+                                                self.get_rule_table(field.get("active_rules")))
+            self.history.append(self.data["characters"][char_idx]["name"], field["name"], field["value"], result)
+            return result
+
+    def roll_named(self, char_name, action_name) -> dict:
+        """Rola a ação pelos nomes e devolve o resultado como dicionário (para CLI, servidor e scripts)."""
+        idx, field = self.lookup_action(char_name, action_name)
+        outcome = self.roll_action(idx, field["id"])
+        if outcome is None:
+            raise LookupError(f"ação '{field['name']}' sem fórmula")
+        total, detalhes = outcome
+        return {"character": self.data["characters"][idx]["name"], "action": field["name"],
+                "formula": field["value"], "total": total, "detail": detalhes,
+                "rng": outcome.rng_name, "seed": outcome.seed, "offset": outcome.offset}
+
+    def roll_party(self, action_name, char_indices=None, copies=1, detail=True):
+        """
+        Rola a ação `action_name` para vários personagens de uma vez (iniciativa, teste em grupo).
+        char_indices=None usa todos; copies > 1 rola N cópias de cada um (hordas de monstros).
+        Personagens com a mesma fórmula e as mesmas regras são rolados juntos (DiceEngine.roll_batch:
+        uma fórmula compilada e um RuleTable por grupo).
+        Retorna (linhas, faltando): linhas = [(rótulo, índice do personagem, RollResult)] do maior total
+        para o menor (erros no fim); faltando = nomes de quem não tem a ação (ou a tem vazia).
+        Como roll_action, registra cada rolagem no histórico (self.history).
+        """
+        with instrument.action("app.roll_party"):
+            return self._roll_party(action_name, char_indices, copies, detail)
+
+    def _roll_party(self, action_name, char_indices, copies, detail):
+        if char_indices is None:
+            char_indices = range(len(self.data["characters"]))
+        groups = {}  # (fórmula, ids das regras) -> [(rótulo, índice, contexto, nome da ação)]
+        missing = []
+        for idx in char_indices:
+            name = self.data["characters"][idx]["name"]
+            field = self.find_action(idx, action_name)
+            if field is None or not field["value"]:
+                missing.append(name)
+                continue
+            context = self.get_context(idx)
+            entries = groups.setdefault((field["value"], tuple(field.get("active_rules") or ())), [])
+            if copies == 1:
+                entries.append((name, idx, context, field["name"]))
+            else:
+                entries.extend((f"{name} #{n}", idx, context, field["name"]) for n in range(1, copies + 1))
+
+        rows = []
+        for (formula, rule_ids), entries in groups.items():
+            results = self.engine.roll_batch(formula, [ctx for _, _, ctx, _ in entries],
+                                             self.get_rule_table(rule_ids), detail=detail)
+            for (label, idx, _, action), result in zip(entries, results):
+                self.history.append(self.data["characters"][idx]["name"], action, formula, result)
+                rows.append((label, idx, result))
+        rows.sort(key=lambda row: (row[2].error is None, row[2].total), reverse=True)
+        return rows, missing
+
+    def simulate_action(self, char_idx, field_id, n=1000, seed=None):
+        """n rolagens da ação de uma vez (ver DiceEngine.roll_many; usa NumPy se estiver instalado)."""
+        field = self.get_field(field_id)
+        return self.engine.roll_many(field["value"], self.get_context(char_idx),
+                                     self.get_rule_table(field.get("active_rules")), n=n, seed=seed)
+
+    def get_rules_by_ids(self, rule_ids):
+        """Retorna os objetos de regra completos baseados na lista de IDs salvos na ação"""
+        if not rule_ids: return []
+        index = self._rule_index
+        found = sorted(index[rid] for rid in set(rule_ids) if rid in index)  # mantém a ordem de global_rules
+        return [rule for _, rule in found]
+
+    def get_rule_table(self, rule_ids):
+        """RuleTable da ação, compilado uma vez e reaproveitado até as regras globais mudarem."""
+        key = tuple(rule_ids or ())
+        table = self._rule_tables.get(key)
+        if table is None:
+            table = RuleTable(self.get_rules_by_ids(rule_ids))
+            self._rule_tables[key] = table
+        return table
@@ -0,0 +1,448 @@
+"""
+Servidor local de rolagens para várias mesas ao mesmo tempo (asyncio, só biblioteca padrão, offline).
+
+HTTP (JSON):
+    GET  /health
+    GET  /characters                          -> [{"index", "id", "name"}]
+    GET  /characters/<nome>/actions           -> [{"id", "action", "formula"}]
+    POST /roll      {"character", "action", "table"?}      -> resultado (e envia para todos da mesa)
+    POST /simulate  {"character", "action", "n"?, "seed"?}  -> resumo (roda num processo à parte)
+    POST /fields/<id>  {"value"?, "name"?, "active_rules"?} -> campo atualizado
+    GET  /diagnostics                         -> tempos por etapa (p50/p90/p99) e contadores (--instrument)
+    GET  /diagnostics/trace                   -> os mesmos spans como trace do Chrome (JSON)
+
+WebSocket:
+    GET /tables/<mesa> (Upgrade) -> recebe as últimas rolagens da mesa e cada rolagem nova;
+    mensagens {"character", "action"} enviadas pelo cliente rolam na mesa.
+
+Uso: python server.py [--data rpg_data.json] [--host 127.0.0.1] [--port 8765] [--instrument]
+Teste de carga: loadtest.py
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+import signal
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote, urlsplit
+
+import instrument
+from dice_engine import DiceEngine
+from rpg_app import RPGApp, summarize_histogram
+from simulation import SHARD_SIZE, Histogram, shard_seed
+from storage import BatchedStorage
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+FLUSH_INTERVAL = 0.25  # segundos entre gravações em lote
+TABLE_HISTORY = 50  # rolagens guardadas por mesa (enviadas a quem entra)
+MAX_BODY = 1 << 20
+MAX_SEND_BUFFER = 4 << 20  # bytes pendentes num WebSocket; acima disso o cliente lento é desconectado
+MAX_TRIALS = 10_000_000
+HISTORY_BUFFER = 100_000  # rolagens do histórico em memória antes de gravar mesmo sem o _flush_loop
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _simulate_job(formula, context, rules, n, seed):
+    """
+    Roda num processo do executor; só o resumo volta (não a amostra inteira).
+    Rola em shards de SHARD_SIZE somados num histograma, então a memória não cresce com n; os seeds
+    são os de simulation.simulate (combinação 0), e o mesmo seed dá o mesmo resultado nos dois.
+    """
+    engine = DiceEngine()
+    hist = Histogram()
+    for s, start in enumerate(range(0, n, SHARD_SIZE)):
+        shard = None if seed is None else shard_seed(seed, 0, s)
+        totals = engine.roll_many(formula, context, rules, n=min(SHARD_SIZE, n - start), seed=shard)
+        hist.merge(Histogram.from_totals(totals))
+    return summarize_histogram(hist)
+
+
+def _ws_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    n = len(payload)
+    if n < 126:
+        head = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+
+class WebSocket:
+    """Conexão WebSocket (RFC 6455) do lado do servidor: texto, ping/pong e close."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    def send_frame(self, frame: bytes) -> bool:
+        """Enfileira um frame já codificado (o mesmo bytes serve para a mesa toda)."""
+        if self.closed:
+            return False
+        if self.writer.transport.get_write_buffer_size() > MAX_SEND_BUFFER:
+            self.close()
+            return False
+        self.writer.write(frame)
+        return True
+
+    def send(self, text: str) -> bool:
+        return self.send_frame(_ws_frame(text.encode("utf-8")))
+
+    async def receive(self):
+        """Próxima mensagem de texto, ou None quando o cliente fecha."""
+        message = b""
+        while True:
+            b1, b2 = await self.reader.readexactly(2)
+            opcode, n = b1 & 0x0F, b2 & 0x7F
+            if n == 126:
+                n, = struct.unpack("!H", await self.reader.readexactly(2))
+            elif n == 127:
+                n, = struct.unpack("!Q", await self.reader.readexactly(8))
+            if n + len(message) > MAX_BODY:
+                raise HTTPError(413, "mensagem grande demais")
+            mask = await self.reader.readexactly(4) if b2 & 0x80 else None
+            data = await self.reader.readexactly(n)
+            if mask and n:
+                key = (mask * (n // 4 + 1))[:n]
+                data = (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+
+            if opcode == 0x8:  # close
+                self.send_frame(_ws_frame(data[:2], 0x8))
+                return None
+            if opcode == 0x9:  # ping
+                self.send_frame(_ws_frame(data, 0xA))
+                continue
+            if opcode == 0xA:
+                continue
+            message += data
+            if b1 & 0x80:
+                return message.decode("utf-8")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class RollServer:
+    """
+    Serviço de rolagens sobre um RPGApp. Tudo que toca o app roda na thread do event loop
+    (sem locks); o que pode bloquear sai dela: gravações vão para um BatchedStorage aplicado
+    a cada FLUSH_INTERVAL numa thread própria, e simulações grandes rodam num ProcessPoolExecutor.
+    """
+
+    def __init__(self, app: RPGApp, flush_interval: float = FLUSH_INTERVAL, workers: int = None):
+        self.app = app
+        if not isinstance(app.storage, BatchedStorage):
+            app.storage = BatchedStorage(app.storage)
+        app.history.flush_rows = HISTORY_BUFFER  # quem grava o histórico é o _flush_loop, fora do loop de eventos
+        app.history.flush_interval = float("inf")
+        app.undo_history.enabled = False  # a API não tem desfazer: não guarda deltas das edições remotas
+        self.flush_interval = flush_interval
+        self.workers = workers
+        self.tables = {}  # mesa -> set de WebSocket
+        self.history = {}  # mesa -> deque de frames já codificados
+        self.stats = {"requests": 0, "rolls": 0, "writes": 0}
+        self.server = None
+        self._simulations = None  # ProcessPoolExecutor, criado na primeira simulação
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self._flusher = None
+
+    # --- Ciclo de vida ---
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        self._flusher = asyncio.create_task(self._flush_loop())
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        for members in self.tables.values():
+            for ws in members:
+                ws.close()
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await asyncio.get_running_loop().run_in_executor(self._io, self.app.storage.close)
+        await asyncio.get_running_loop().run_in_executor(self._io, self.app.history.close)
+        self._io.shutdown()
+        if self._simulations is not None:
+            self._simulations.shutdown(cancel_futures=True)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.app.storage.pending:
+                try:
+                    self.stats["writes"] += await loop.run_in_executor(self._io, self.app.storage.apply)
+                except Exception as e:
+                    print(f"Erro ao gravar: {e}")
+            if self.app.history.pending:
+                try:
+                    await loop.run_in_executor(self._io, self.app.history.flush)
+                except Exception as e:
+                    print(f"Erro ao gravar o histórico: {e}")
+
+    # --- HTTP ---
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                self.stats["requests"] += 1
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self._websocket(reader, writer, target, headers)
+                    return
+                try:
+                    status, payload = await self._dispatch(method, target, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": e.message}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._respond(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            self._respond(writer, e.status, {"error": e.message}, False)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "requisição inválida")
+        headers = {}
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPError(400, "Content-Length inválido")
+        if length > MAX_BODY:
+            raise HTTPError(413, "corpo grande demais")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target, headers, body
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+
+    async def _dispatch(self, method: str, target: str, body: bytes):
+        parts = [unquote(p) for p in urlsplit(target).path.split("/") if p]
+        data = None
+        if method == "POST":
+            try:
+                data = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "JSON inválido")
+            if not isinstance(data, dict):
+                raise HTTPError(400, "esperado um objeto JSON")
+
+        if method == "GET" and parts == ["health"]:
+            return 200, dict(self.stats, ok=True, tables=len(self.tables),
+                             clients=sum(len(m) for m in self.tables.values()))
+        if method == "GET" and parts == ["characters"]:
+            return 200, [{"index": i, "id": c["id"], "name": c["name"]}
+                         for i, c in enumerate(self.app.data["characters"])]
+        if method == "GET" and len(parts) == 3 and parts[0] == "characters" and parts[2] == "actions":
+            idx = self.app.find_character(parts[1])
+            if idx is None:
+                raise HTTPError(404, f"personagem '{parts[1]}' não encontrado")
+            return 200, [{"id": f["id"], "action": f["name"], "formula": f["value"]}
+                         for seg in self.app.character(idx)["segments"] for f in seg["fields"]
+                         if f["type"] == "Ação"]
+        if method == "GET" and parts == ["diagnostics"]:
+            return 200, instrument.snapshot()
+        if method == "GET" and parts == ["diagnostics", "trace"]:
+            return 200, instrument.trace()
+        if method == "POST" and parts == ["roll"]:
+            return 200, self.roll(data)
+        if method == "POST" and parts == ["simulate"]:
+            return 200, await self.simulate(data)
+        if method == "POST" and len(parts) == 2 and parts[0] == "fields":
+            return 200, self.update_field(parts[1], data)
+        raise HTTPError(404, "rota não encontrada")
+
+    # --- Operações ---
+
+    @staticmethod
+    def _required(data: dict, key: str) -> str:
+        value = data.get(key)
+        if not isinstance(value, str) or not value:
+            raise HTTPError(400, f"campo '{key}' obrigatório")
+        return value
+
+    def roll(self, data: dict) -> dict:
+        try:
+            result = self.app.roll_named(self._required(data, "character"), self._required(data, "action"))
+        except LookupError as e:
+            raise HTTPError(404, str(e))
+        self.stats["rolls"] += 1
+        table = data.get("table")
+        if table:
+            result["table"] = table
+            self.broadcast(table, result)
+        return result
+
+    def broadcast(self, table: str, message: dict):
+        """Envia para todos da mesa: o JSON e o frame são montados uma vez só."""
+        frame = _ws_frame(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+        self.history.setdefault(table, deque(maxlen=TABLE_HISTORY)).append(frame)
+        members = self.tables.get(table)
+        if members:
+            for ws in list(members):
+                if not ws.send_frame(frame):
+                    members.discard(ws)
+
+    async def simulate(self, data: dict) -> dict:
+        try:
+            idx, field = self.app.lookup_action(self._required(data, "character"), self._required(data, "action"))
+        except LookupError as e:
+            raise HTTPError(404, str(e))
+        n, seed = data.get("n", 10000), data.get("seed")
+        if not isinstance(n, int) or not 1 <= n <= MAX_TRIALS:
+            raise HTTPError(400, f"'n' deve estar entre 1 e {MAX_TRIALS}")
+        if seed is not None and not isinstance(seed, int):
+            raise HTTPError(400, "'seed' deve ser inteiro")
+        if not field["value"]:
+            raise HTTPError(400, f"ação '{field['name']}' sem fórmula")
+
+        if self._simulations is None:
+            # spawn: os processos não herdam as threads (storage, executor) do servidor
+            self._simulations = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        context = dict(self.app.get_context(idx))
+        rules = self.app.get_rules_by_ids(field.get("active_rules"))
+        try:
+            stats = await asyncio.get_running_loop().run_in_executor(
+                self._simulations, _simulate_job, field["value"], context, rules, n, seed)
+        except ValueError as e:
+            raise HTTPError(400, f"fórmula inválida: {e}")
+        return dict(stats, action=field["name"], formula=field["value"])
+
+    def update_field(self, field_id: str, data: dict) -> dict:
+        changes = {k: data[k] for k in ("name", "value", "active_rules") if k in data}
+        if not changes:
+            raise HTTPError(400, "nada para alterar")
+        for key in ("name", "value"):
+            if key in changes and not isinstance(changes[key], str):
+                raise HTTPError(400, f"'{key}' deve ser texto")
+        rules = changes.get("active_rules", [])
+        if not (isinstance(rules, list) and all(isinstance(r, str) for r in rules)):
+            raise HTTPError(400, "'active_rules' deve ser uma lista de ids")
+        try:
+            self.app.locate_field(field_id)
+        except KeyError:
+            raise HTTPError(404, "campo não encontrado")
+        return dict(self.app.update_field(field_id, **changes))
+
+    # --- WebSocket ---
+
+    async def _websocket(self, reader, writer, target: str, headers: dict):
+        parts = [unquote(p) for p in urlsplit(target).path.split("/") if p]
+        key = headers.get("sec-websocket-key")
+        if len(parts) != 2 or parts[0] != "tables" or not key:
+            self._respond(writer, 400, {"error": "use /tables/<mesa> com um handshake WebSocket"}, False)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode("latin-1"))
+
+        table = parts[1]
+        ws = WebSocket(reader, writer)
+        members = self.tables.setdefault(table, set())
+        members.add(ws)
+        for frame in self.history.get(table, ()):
+            ws.send_frame(frame)
+        try:
+            while not ws.closed:
+                text = await ws.receive()
+                if text is None:
+                    break
+                try:
+                    data = json.loads(text)
+                    if not isinstance(data, dict):
+                        raise HTTPError(400, "esperado um objeto JSON")
+                    self.roll(dict(data, table=table))
+                except ValueError:
+                    ws.send(json.dumps({"error": "JSON inválido"}, ensure_ascii=False))
+                except HTTPError as e:
+                    ws.send(json.dumps({"error": e.message}, ensure_ascii=False))
+        except (asyncio.IncompleteReadError, ConnectionError, HTTPError):
+            pass
+        finally:
+            members.discard(ws)
+            if not members and self.tables.get(table) is members:
+                del self.tables[table]
+            ws.close()
+
+
+async def serve(app: RPGApp, host: str, port: int):
+    if app.load_error:
+        print(f"Aviso: {app.load_error}", flush=True)
+    server = RollServer(app)
+    host, port = await server.start(host, port)
+    print(f"Servidor de rolagens em http://{host}:{port} (Ctrl+C para parar)", flush=True)
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except (NotImplementedError, AttributeError):  # Windows
+        pass
+    try:
+        await stop.wait()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local de rolagens (HTTP/WebSocket).")
+    parser.add_argument("--data", help="arquivo da campanha (.json ou .db)")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--instrument", action="store_true", help="mede as etapas (ver GET /diagnostics)")
+    args = parser.parse_args(argv)
+    if args.instrument:
+        instrument.enable()
+    try:
+        asyncio.run(serve(RPGApp(args.data), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
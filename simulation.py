@@ -0,0 +1,233 @@
+"""
+Simulação Monte Carlo em vários núcleos para testes de balanceamento.
+
+simulate(formulas, contexts, rule_sets, trials) roda `trials` rolagens de cada combinação
+(fórmula x contexto x conjunto de regras). O trabalho é dividido em shards de tamanho fixo, cada um
+com seu próprio seed derivado de (seed mestre, combinação, shard), e espalhado num ProcessPoolExecutor.
+Cada processo devolve só histogramas (contagem por total), que são somados à medida que chegam;
+como a soma de contagens não depende da ordem nem do número de processos, o mesmo seed mestre
+sempre dá o mesmo resultado.
+
+    python simulation.py "4d6dl1" --data rpg_data.json --rule-subsets --trials 200000
+"""
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+from dice_engine import DiceEngine
+
+SHARD_SIZE = 50_000  # rolagens por shard (fixo: define os seeds, então não depende do número de processos)
+TASKS_PER_WORKER = 4  # tarefas por processo, para equilibrar a carga sem muito overhead de IPC
+MAX_SUBSET_RULES = 8  # rule_subsets gera 2^n conjuntos: com 8 regras já são 256 simulações por fórmula
+
+
+class Histogram:
+    """Contagem de cada total: counts[i] = quantas rolagens deram offset + i."""
+
+    __slots__ = ("offset", "counts")
+
+    def __init__(self, offset: int = 0, counts: list = None):
+        self.offset = offset
+        self.counts = counts if counts is not None else []
+
+    @classmethod
+    def from_totals(cls, totals) -> "Histogram":
+        if not len(totals):
+            return cls()
+        if hasattr(totals, "min"):  # array NumPy
+            import numpy as np
+            low = int(totals.min())
+            return cls(low, np.bincount(totals - low).tolist())
+        low = min(totals)
+        counts = [0] * (max(totals) - low + 1)
+        for t in totals:
+            counts[t - low] += 1
+        return cls(low, counts)
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        """Soma as contagens de `other` neste histograma (in-place) e retorna self."""
+        if not other.counts:
+            return self
+        if not self.counts:
+            self.offset, self.counts = other.offset, list(other.counts)
+            return self
+        if other.offset < self.offset:
+            self.counts[:0] = [0] * (self.offset - other.offset)
+            self.offset = other.offset
+        start = other.offset - self.offset
+        missing = start + len(other.counts) - len(self.counts)
+        if missing > 0:
+            self.counts.extend([0] * missing)
+        for i, c in enumerate(other.counts, start):
+            self.counts[i] += c
+        return self
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def min(self) -> int:
+        return self.offset + next(i for i, c in enumerate(self.counts) if c)
+
+    @property
+    def max(self) -> int:
+        return self.offset + max(i for i, c in enumerate(self.counts) if c)
+
+    def mean(self) -> float:
+        return sum((self.offset + i) * c for i, c in enumerate(self.counts)) / self.total
+
+    def variance(self) -> float:
+        mu = self.mean()
+        return sum((self.offset + i - mu) ** 2 * c for i, c in enumerate(self.counts)) / self.total
+
+    def percentile(self, q: float) -> int:
+        """Menor total com pelo menos q da amostra abaixo ou igual (q entre 0 e 1)."""
+        target = q * self.total
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if c and acc >= target:
+                return self.offset + i
+        return self.max
+
+    def prob_at_least(self, value: int) -> float:
+        start = max(value - self.offset, 0)
+        return sum(self.counts[start:]) / self.total
+
+    def distribution(self):
+        """Frequências como probability.Distribution (para comparar com a distribuição exata)."""
+        from probability import Distribution
+        n = self.total
+        return Distribution(self.offset, [c / n for c in self.counts])
+
+
+@dataclass(slots=True)
+class SimulationResult:
+    formula: str
+    context: dict
+    rules: list
+    histogram: Histogram = field(default_factory=Histogram)
+
+
+def shard_seed(master_seed: int, combo: int, shard: int) -> int:
+    """Seed independente de cada shard (64 bits), derivado só de (seed mestre, combinação, shard)."""
+    digest = hashlib.blake2b(f"{master_seed}:{combo}:{shard}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+_engine = None  # um DiceEngine por processo (reaproveita o cache de planos entre tarefas)
+
+
+def _run_task(shards: list) -> list:
+    """Roda uma lista de shards (combo, fórmula, contexto, regras, n, seed) e devolve [(combo, Histogram)]."""
+    global _engine
+    if _engine is None:
+        _engine = DiceEngine()
+    return [(combo, Histogram.from_totals(_engine.roll_many(formula, context, rules, n=n, seed=seed)))
+            for combo, formula, context, rules, n, seed in shards]
+
+
+def _pack(shards: list, max_trials: int) -> list:
+    """Agrupa shards consecutivos em tarefas de até max_trials rolagens (cada tarefa tem ao menos um shard)."""
+    tasks, current, size = [], [], 0
+    for shard in shards:
+        if current and size + shard[4] > max_trials:
+            tasks.append(current)
+            current, size = [], 0
+        current.append(shard)
+        size += shard[4]
+    if current:
+        tasks.append(current)
+    return tasks
+
+
+def simulate(formulas, contexts, rule_sets, trials: int, seed: int = 0, workers: int = None,
+             shard_size: int = SHARD_SIZE, progress=None) -> list:
+    """
+    Simula cada combinação de fórmula x contexto x conjunto de regras com `trials` rolagens.
+    Retorna um SimulationResult por combinação, na ordem de itertools.product(formulas, contexts, rule_sets).
+    workers=1 roda no próprio processo. progress(feitas, total) é chamado a cada tarefa concluída.
+    Levanta ValueError se alguma fórmula for inválida.
+    """
+    combos = list(itertools.product(formulas, contexts, rule_sets))
+    results = [SimulationResult(formula, context, list(rules)) for formula, context, rules in combos]
+    if trials <= 0 or not combos:
+        return results
+
+    shards = []
+    for i, (formula, context, rules) in enumerate(combos):
+        for s, start in enumerate(range(0, trials, shard_size)):
+            shards.append((i, formula, context, list(rules), min(shard_size, trials - start), shard_seed(seed, i, s)))
+
+    workers = workers or os.cpu_count() or 1
+    total_trials = trials * len(combos)
+    tasks = _pack(shards, max(shard_size, total_trials // (workers * TASKS_PER_WORKER)))
+
+    def merge(done, partial):
+        for combo, hist in partial:
+            results[combo].histogram.merge(hist)
+        if progress:
+            progress(done, len(tasks))
+
+    if workers == 1 or len(tasks) == 1:
+        for done, task in enumerate(tasks, 1):
+            merge(done, _run_task(task))
+        return results
+
+    # spawn: funciona igual em todas as plataformas e não herda threads do processo pai
+    with ProcessPoolExecutor(min(workers, len(tasks)), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_run_task, task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), 1):
+            merge(done, future.result())
+    return results
+
+
+def rule_subsets(rules: list) -> list:
+    """Todos os subconjuntos das regras (do vazio ao completo), mantendo a ordem original."""
+    if len(rules) > MAX_SUBSET_RULES:
+        raise ValueError(f"{len(rules)} regras geram {2 ** len(rules)} subconjuntos; "
+                         f"o limite é {MAX_SUBSET_RULES} regras")
+    return [list(combo) for k in range(len(rules) + 1) for combo in itertools.combinations(rules, k)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara fórmulas e conjuntos de regras por Monte Carlo.")
+    parser.add_argument("formulas", nargs="+")
+    parser.add_argument("--data", help="campanha de onde vêm as regras globais (.json ou .db)")
+    parser.add_argument("--character", help="usa os atributos deste personagem como contexto")
+    parser.add_argument("--rule-subsets", action="store_true", help="testa todos os subconjuntos das regras globais")
+    parser.add_argument("--trials", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+
+    context, rule_sets = {}, [[]]
+    if args.data or args.character or args.rule_subsets:
+        from rpg_app import RPGApp
+        app = RPGApp(args.data)
+        if args.character:
+            idx = app.find_character(args.character)
+            if idx is None:
+                parser.error(f"personagem '{args.character}' não encontrado")
+            context = dict(app.get_context(idx))
+        if args.rule_subsets:
+            try:
+                rule_sets = rule_subsets(app.data["global_rules"])
+            except ValueError as e:
+                parser.error(str(e))
+
+    results = simulate(args.formulas, [context], rule_sets, args.trials, seed=args.seed, workers=args.workers)
+    for res in results:
+        hist = res.histogram
+        rules = ", ".join(r["name"] for r in res.rules) or "(sem regras)"
+        print(f"{res.formula:<16} {rules:<40} média {hist.mean():7.3f}  desvio {hist.variance() ** 0.5:6.3f}"
+              f"  p5 {hist.percentile(0.05):4d}  p95 {hist.percentile(0.95):4d}")
+
+
+if __name__ == "__main__":
+    main()
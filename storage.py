@@ -0,0 +1,457 @@
+import contextlib
+import copy
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import instrument
+from persistence import WriteBehindStore
+
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+
+class CampaignLoadError(Exception):
+    """
+    O arquivo da campanha existe mas não pôde ser lido. O original já foi preservado ao lado (ver a
+    mensagem) e `data` é a campanha vazia que o backend passou a usar.
+    """
+
+    def __init__(self, message: str, data: dict):
+        super().__init__(message)
+        self.data = data
+
+
+def new_id() -> str:
+    return str(uuid.uuid4())
+
+
+def ensure_ids(data: dict) -> dict:
+    """Garante que personagens, segmentos e campos tenham 'id' estável (arquivos antigos não têm)."""
+    for char in data["characters"]:
+        char.setdefault("id", new_id())
+        for seg in char.get("segments") or []:
+            seg.setdefault("id", new_id())
+            for field in seg["fields"]:
+                field.setdefault("id", new_id())
+    return data
+
+
+class Storage:
+    """
+    Interface de armazenamento da campanha.
+    load() devolve {"characters": [...], "global_rules": [...]}; um personagem pode vir com
+    "segments" = None (carregamento preguiçoso) e é completado por load_character().
+    Os demais métodos avisam o backend sobre uma alteração já feita nos dicionários em memória.
+    """
+
+    lazy = False  # True: personagens podem ficar fora da memória (segments = None) e voltar por load_character
+
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def load_character(self, char: dict):
+        pass
+
+    def field_owner(self, field_id: str):
+        """Id do personagem dono do campo já gravado, sem carregá-lo (None se o backend não sabe dizer)."""
+        return None
+
+    def save_all(self, data: dict):
+        raise NotImplementedError
+
+    def character_added(self, char: dict, position: int): raise NotImplementedError
+    def character_updated(self, char: dict): raise NotImplementedError
+    def character_deleted(self, char_id: str): raise NotImplementedError
+    def segment_added(self, char_id: str, seg: dict, position: int): raise NotImplementedError
+    def segment_updated(self, seg: dict): raise NotImplementedError
+    def segment_deleted(self, seg_id: str): raise NotImplementedError
+    def field_added(self, seg_id: str, field: dict, position: int): raise NotImplementedError
+    def field_updated(self, field: dict): raise NotImplementedError
+    def field_deleted(self, field_id: str): raise NotImplementedError
+    def rule_added(self, rule: dict, position: int): raise NotImplementedError
+    def rule_deleted(self, rule_id: str): raise NotImplementedError
+
+    def character_imported(self, char: dict, position: int):
+        """
+        Personagem completo (segmentos e campos) gravado de uma vez na posição; usado na importação
+        (no fim da lista) e ao desfazer a exclusão de um personagem (na posição que ele ocupava).
+        """
+        with self.batch():
+            self.character_added(char, position)
+            for s_pos, seg in enumerate(char["segments"]):
+                self.segment_added(char["id"], seg, s_pos)
+                for f_pos, field in enumerate(seg["fields"]):
+                    self.field_added(seg["id"], field, f_pos)
+
+    def batch(self):
+        """Contexto em que várias alterações seguidas são gravadas juntas (uma transação no SQLite)."""
+        return contextlib.nullcontext()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    """Backend original: o arquivo JSON inteiro, regravado em segundo plano a cada alteração."""
+
+    def __init__(self, path: str, compact: bool = False):
+        self.store = WriteBehindStore(path, compact=compact)
+        self.data = None
+
+    def load(self) -> dict:
+        try:
+            self.data = self.store.load({"characters": [], "global_rules": []})
+            # Garante que chaves novas existam em arquivos antigos
+            if "global_rules" not in self.data: self.data["global_rules"] = []
+            return ensure_ids(self.data)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # JSON quebrado ou sem a estrutura esperada: tira do caminho antes que a próxima gravação o sobrescreva
+            path = self.store.path
+            backup = f"{path}.corrompido-{time.strftime('%Y%m%d-%H%M%S')}"
+            os.replace(path, backup)
+            self.data = {"characters": [], "global_rules": []}
+            raise CampaignLoadError(f"não foi possível ler {path} ({e}); o arquivo foi guardado em {backup}",
+                                    self.data) from e
+
+    def save_all(self, data: dict):
+        self.data = data
+        self.store.save(data)
+
+    def _changed(self, *args):
+        self.store.save(self.data)
+
+    character_added = character_updated = character_deleted = character_imported = _changed
+    segment_added = segment_updated = segment_deleted = _changed
+    field_added = field_updated = field_deleted = _changed
+    rule_added = rule_deleted = _changed
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS characters (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    id TEXT PRIMARY KEY,
+    character_id TEXT NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_segments_character ON segments(character_id, position);
+CREATE TABLE IF NOT EXISTS fields (
+    id TEXT PRIMARY KEY,
+    segment_id TEXT NOT NULL REFERENCES segments(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    active_rules TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_fields_segment ON fields(segment_id, position);
+CREATE TABLE IF NOT EXISTS rules (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    trigger_val INTEGER NOT NULL,
+    scope TEXT NOT NULL,
+    effect TEXT NOT NULL,
+    effect_param INTEGER
+);
+"""
+
+
+class SqliteStorage(Storage):
+    """
+    Backend SQLite: personagens, segmentos, campos e regras em tabelas indexadas.
+    Cada alteração vira um único INSERT/UPDATE/DELETE; personagens são carregados só quando abertos.
+    """
+
+    lazy = True
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        self.path = path
+        # Os handlers do Flet rodam em threads diferentes; o lock serializa o acesso à conexão
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(_SCHEMA)
+
+    def _exec(self, sql: str, params=()):
+        with self.lock, instrument.span("persist.sqlite_write"):
+            self.conn.execute(sql, params)
+
+    def _insert_at(self, table: str, parent_col: str, parent_id, position: int, sql: str, params: tuple):
+        """Abre espaço na posição (desloca os irmãos seguintes) e insere, numa única transação."""
+        where = f"{parent_col} = ? AND " if parent_col else ""
+        parent = (parent_id,) if parent_col else ()
+        with self.batch():
+            self.conn.execute(f"UPDATE {table} SET position = position + 1 WHERE {where}position >= ?",
+                              parent + (position,))
+            self.conn.execute(sql, params)
+
+    def _delete_at(self, table: str, parent_col: str, row_id: str):
+        """Apaga a linha e fecha o buraco (os irmãos seguintes sobem), mantendo position = índice na lista."""
+        cols = f"{parent_col}, position" if parent_col else "position"
+        with self.batch():
+            row = self.conn.execute(f"SELECT {cols} FROM {table} WHERE id = ?", (row_id,)).fetchone()
+            if row is None:
+                return
+            self.conn.execute(f"DELETE FROM {table} WHERE id = ?", (row_id,))
+            where = f"{parent_col} = ? AND " if parent_col else ""
+            self.conn.execute(f"UPDATE {table} SET position = position - 1 WHERE {where}position > ?", row)
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            if self.conn.in_transaction:  # já dentro de outro batch(): a transação de fora decide
+                yield
+                return
+            with instrument.span("persist.sqlite_transaction"), self.conn:
+                self.conn.execute("BEGIN")
+                yield
+
+    # --- Leitura ---
+
+    def load(self) -> dict:
+        with self.lock:
+            chars = [{"id": cid, "name": name, "segments": None}
+                     for cid, name in self.conn.execute("SELECT id, name FROM characters ORDER BY position")]
+            rules = [{"id": rid, "name": name, "trigger_val": trigger, "scope": scope, "effect": effect,
+                      "effect_param": param}
+                     for rid, name, trigger, scope, effect, param in self.conn.execute(
+                        "SELECT id, name, trigger_val, scope, effect, effect_param FROM rules ORDER BY position")]
+        return {"characters": chars, "global_rules": rules}
+
+    def load_character(self, char: dict):
+        if char.get("segments") is not None:
+            return
+        with self.lock:
+            segments = []
+            by_id = {}
+            for sid, name in self.conn.execute(
+                    "SELECT id, name FROM segments WHERE character_id = ? ORDER BY position", (char["id"],)):
+                seg = {"id": sid, "name": name, "fields": []}
+                by_id[sid] = seg
+                segments.append(seg)
+            rows = self.conn.execute(
+                "SELECT f.id, f.segment_id, f.type, f.name, f.value, f.active_rules FROM fields f "
+                "JOIN segments s ON f.segment_id = s.id WHERE s.character_id = ? ORDER BY f.segment_id, f.position",
+                (char["id"],))
+            for fid, sid, ftype, name, value, active_rules in rows:
+                field = {"id": fid, "type": ftype, "name": name, "value": value}
+                if active_rules is not None:
+                    field["active_rules"] = json.loads(active_rules)
+                by_id[sid]["fields"].append(field)
+        char["segments"] = segments
+
+    def field_owner(self, field_id: str):
+        with self.lock:
+            row = self.conn.execute("SELECT s.character_id FROM fields f JOIN segments s ON f.segment_id = s.id "
+                                    "WHERE f.id = ?", (field_id,)).fetchone()
+        return row[0] if row else None
+
+    # --- Escrita ---
+
+    def save_all(self, data: dict):
+        """Regrava tudo (usado na migração/importação)."""
+        ensure_ids(data)
+        with self.batch():
+            # Personagens ainda não abertos só existem no banco: carrega antes de apagar as tabelas
+            for char in data["characters"]:
+                self.load_character(char)
+            for table in ("fields", "segments", "characters", "rules"):
+                self.conn.execute(f"DELETE FROM {table}")
+            for c_pos, char in enumerate(data["characters"]):
+                self._insert_character(char, c_pos)
+            self.conn.executemany(
+                "INSERT INTO rules (id, position, name, trigger_val, scope, effect, effect_param) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(r["id"], r_pos, r["name"], r["trigger_val"], r["scope"], r["effect"], r.get("effect_param"))
+                 for r_pos, r in enumerate(data["global_rules"])])
+
+    def _insert_character(self, char: dict, position: int):
+        self.conn.execute("INSERT INTO characters (id, position, name) VALUES (?, ?, ?)",
+                          (char["id"], position, char["name"]))
+        for s_pos, seg in enumerate(char.get("segments") or []):
+            self.conn.execute("INSERT INTO segments (id, character_id, position, name) VALUES (?, ?, ?, ?)",
+                              (seg["id"], char["id"], s_pos, seg["name"]))
+            self.conn.executemany(
+                "INSERT INTO fields (id, segment_id, position, type, name, value, active_rules) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(f["id"], seg["id"], f_pos, f["type"], f["name"], f["value"], self._rules_json(f))
+                 for f_pos, f in enumerate(seg["fields"])])
+
+    @staticmethod
+    def _rules_json(field: dict):
+        return json.dumps(field["active_rules"]) if "active_rules" in field else None
+
+    def character_added(self, char: dict, position: int):
+        self._insert_at("characters", None, None, position,
+                        "INSERT INTO characters (id, position, name) VALUES (?, ?, ?)",
+                        (char["id"], position, char["name"]))
+
+    def character_imported(self, char: dict, position: int):
+        with self.batch():
+            self.conn.execute("UPDATE characters SET position = position + 1 WHERE position >= ?", (position,))
+            self._insert_character(char, position)
+
+    def character_updated(self, char: dict):
+        self._exec("UPDATE characters SET name = ? WHERE id = ?", (char["name"], char["id"]))
+
+    def character_deleted(self, char_id: str):
+        self._delete_at("characters", None, char_id)
+
+    def segment_added(self, char_id: str, seg: dict, position: int):
+        self._insert_at("segments", "character_id", char_id, position,
+                        "INSERT INTO segments (id, character_id, position, name) VALUES (?, ?, ?, ?)",
+                        (seg["id"], char_id, position, seg["name"]))
+
+    def segment_updated(self, seg: dict):
+        self._exec("UPDATE segments SET name = ? WHERE id = ?", (seg["name"], seg["id"]))
+
+    def segment_deleted(self, seg_id: str):
+        self._delete_at("segments", "character_id", seg_id)
+
+    def field_added(self, seg_id: str, field: dict, position: int):
+        self._insert_at("fields", "segment_id", seg_id, position,
+                        "INSERT INTO fields (id, segment_id, position, type, name, value, active_rules) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (field["id"], seg_id, position, field["type"], field["name"], field["value"],
+                         self._rules_json(field)))
+
+    def field_updated(self, field: dict):
+        self._exec("UPDATE fields SET name = ?, value = ?, active_rules = ? WHERE id = ?",
+                   (field["name"], field["value"], self._rules_json(field), field["id"]))
+
+    def field_deleted(self, field_id: str):
+        self._delete_at("fields", "segment_id", field_id)
+
+    def rule_added(self, rule: dict, position: int):
+        self._insert_at("rules", None, None, position,
+                        "INSERT INTO rules (id, position, name, trigger_val, scope, effect, effect_param) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (rule["id"], position, rule["name"], rule["trigger_val"], rule["scope"], rule["effect"],
+                         rule.get("effect_param")))
+
+    def rule_deleted(self, rule_id: str):
+        self._delete_at("rules", None, rule_id)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class BatchedStorage(Storage):
+    """
+    Envolve outro backend e enfileira as alterações em vez de gravá-las na hora.
+    apply() aplica a fila inteira, em ordem, dentro de um único inner.batch(); é pensado para ser
+    chamado periodicamente fora da thread que edita (ex: no executor do servidor), então cada
+    rajada de edições custa uma transação só. Leituras passam direto.
+    """
+
+    def __init__(self, inner: Storage):
+        self.inner = inner
+        self.pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def load(self) -> dict:
+        return self.inner.load()
+
+    def load_character(self, char: dict):
+        self.inner.load_character(char)
+
+    def field_owner(self, field_id: str):
+        return self.inner.field_owner(field_id)
+
+    def _queue(name):
+        def method(self, *args):
+            with self._lock:
+                self.pending.append((name, args))
+        method.__name__ = name
+        return method
+
+    save_all = _queue("save_all")
+    character_added = _queue("character_added")
+    character_updated = _queue("character_updated")
+    character_deleted = _queue("character_deleted")
+    segment_added = _queue("segment_added")
+    segment_updated = _queue("segment_updated")
+    segment_deleted = _queue("segment_deleted")
+    field_added = _queue("field_added")
+    field_updated = _queue("field_updated")
+    field_deleted = _queue("field_deleted")
+    rule_added = _queue("rule_added")
+    rule_deleted = _queue("rule_deleted")
+    del _queue
+
+    def character_imported(self, char: dict, position: int):
+        # grava a árvore inteira só no apply(): copia agora, senão um segmento ou campo criado antes
+        # disso entraria duas vezes (com a árvore e com o próprio segment_added/field_added)
+        with self._lock:
+            self.pending.append(("character_imported", (copy.deepcopy(char), position)))
+
+    def apply(self) -> int:
+        """Repassa as alterações pendentes ao backend numa única transação; retorna quantas eram."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                instrument.count("persist.batched_changes", len(pending))
+                with instrument.span("persist.apply_batch"), self.inner.batch():
+                    for name, args in pending:
+                        getattr(self.inner, name)(*args)
+            return len(pending)
+
+    def flush(self):
+        self.apply()
+        self.inner.flush()
+
+    def close(self):
+        self.apply()
+        self.inner.close()
+
+
+def open_storage(path: str, compact_json: bool = False) -> Storage:
+    """Escolhe o backend pela extensão do arquivo (.db/.sqlite = SQLite, senão JSON)."""
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteStorage(path)
+    return JsonStorage(path, compact=compact_json)
+
+
+def migrate_json_to_sqlite(json_path: str, db_path: str) -> int:
+    """Migração única do rpg_data.json para o banco SQLite. Retorna o número de personagens migrados."""
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "global_rules" not in data: data["global_rules"] = []
+    db = SqliteStorage(db_path)
+    try:
+        db.save_all(data)
+    finally:
+        db.close()
+    return len(data["characters"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or not os.path.exists(sys.argv[1]):
+        print("Uso: python storage.py rpg_data.json rpg_data.db")
+        sys.exit(1)
+    total = migrate_json_to_sqlite(sys.argv[1], sys.argv[2])
+    print(f"{total} personagens migrados para {sys.argv[2]}")
@@ -0,0 +1,127 @@
+"""
+Histórico de desfazer/refazer das edições da ficha (usado pelo RPGApp).
+
+Cada edição vira um delta pequeno, nunca uma cópia da campanha:
+    ("insert", tipo, pai, posição, item)  - item (personagem, segmento, campo, regra) entrou na posição
+    ("remove", tipo, pai, posição, item)  - item saiu da posição
+    ("set", tipo, item, antes, depois)    - só as chaves alteradas, com os valores antigos e os novos
+`pai` é o dict que contém a lista (personagem para segmentos, segmento para campos, None no topo).
+O inverso de um delta é outro delta (insert <-> remove, antes <-> depois), então desfazer custa o
+mesmo que a edição original, sem depender do tamanho do histórico nem da campanha.
+
+Os deltas apontam para os próprios dicts da campanha (compartilhamento estrutural): apagar um
+personagem guarda o dict que saiu da lista, sem copiar. Por isso quem edita não deve alterar listas
+do campo no lugar (ex: active_rules) e sim passar uma lista nova para update_field.
+O histórico respeita um orçamento de memória (estimado); passando dele, as edições mais antigas saem.
+"""
+import time
+from collections import deque
+
+MEMORY_BUDGET = 8 << 20  # bytes (estimados) entre desfazer e refazer
+COALESCE_SECONDS = 1.5  # edições seguidas do mesmo campo dentro desse intervalo viram um passo só
+_ENTRY_OVERHEAD = 200  # bytes por passo (tupla do delta, rótulo, entrada da fila)
+
+
+def invert(delta: tuple) -> tuple:
+    if delta[0] == "set":
+        op, kind, item, before, after = delta
+        return op, kind, item, after, before
+    return ("remove" if delta[0] == "insert" else "insert",) + delta[1:]
+
+
+def estimate_size(obj) -> int:
+    """Bytes aproximados de um valor JSON (sem sys.getsizeof, que custaria mais que a própria edição)."""
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, dict):
+        total = 64 + 24 * len(obj)
+        for value in obj.values():
+            total += estimate_size(value)
+        return total
+    if isinstance(obj, list):
+        total = 56 + 8 * len(obj)
+        for value in obj:
+            total += estimate_size(value)
+        return total
+    return 28  # int, None, bool
+
+
+def _cost(delta: tuple) -> int:
+    """Memória que só o histórico segura: o que foi removido e os valores antigos/novos de um set."""
+    if delta[0] == "set":
+        return _ENTRY_OVERHEAD + estimate_size(delta[3]) + estimate_size(delta[4])
+    if delta[0] == "remove":
+        return _ENTRY_OVERHEAD + estimate_size(delta[4])
+    return _ENTRY_OVERHEAD  # o item inserido está na campanha
+
+
+class UndoHistory:
+    """
+    Pilhas de desfazer/refazer com orçamento de memória. Só guarda e inverte deltas; quem os
+    aplica é o RPGApp (undo()/redo() retornam o delta já pronto para aplicar).
+    """
+
+    def __init__(self, budget: int = MEMORY_BUDGET):
+        self.budget = budget
+        self.enabled = True
+        self.size = 0  # bytes estimados nas duas pilhas
+        self._undo = deque()  # [rótulo, delta, custo, instante]; a mais antiga à esquerda
+        self._redo = []
+        self._sealed = False  # depois de desfazer/refazer, a próxima edição não se junta à anterior
+
+    def __len__(self):
+        return len(self._undo)
+
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    def record(self, label: str, delta: tuple):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if self._redo:
+            self.size -= sum(entry[2] for entry in self._redo)
+            self._redo.clear()
+        if delta[0] == "set" and self._undo and not self._sealed:
+            last = self._undo[-1]
+            prev = last[1]
+            if (prev[0] == "set" and prev[2] is delta[2] and prev[4].keys() == delta[4].keys()
+                    and now - last[3] < COALESCE_SECONDS):
+                # digitação: mantém o "antes" da primeira tecla e o "depois" da última
+                merged = ("set", delta[1], delta[2], prev[3], delta[4])
+                cost = _cost(merged)
+                self.size += cost - last[2]
+                last[1:] = [merged, cost, now]
+                return
+        self._sealed = False
+        cost = _cost(delta)
+        self._undo.append([label, delta, cost, now])
+        self.size += cost
+        while self.size > self.budget and len(self._undo) > 1:  # o último passo sempre fica
+            self.size -= self._undo.popleft()[2]
+
+    def undo(self):
+        """(rótulo, delta inverso) da última edição, que passa para a pilha de refazer; None se vazia."""
+        if not self._undo:
+            return None
+        entry = self._undo.pop()
+        self._redo.append(entry)
+        self._sealed = True
+        return entry[0], invert(entry[1])
+
+    def redo(self):
+        """(rótulo, delta) da última edição desfeita, que volta para a pilha de desfazer; None se vazia."""
+        if not self._redo:
+            return None
+        entry = self._redo.pop()
+        self._undo.append(entry)
+        self._sealed = True
+        return entry[0], entry[1]
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self.size = 0
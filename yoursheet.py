@@ -0,0 +1,294 @@
+"""
+yoursheet: rolagens da ficha pela linha de comando (sem abrir a interface).
+
+    python yoursheet.py list [PERSONAGEM]
+    python yoursheet.py roll PERSONAGEM AÇÃO [--seed N]
+    python yoursheet.py batch < rolagens.txt        (uma linha "PERSONAGEM<TAB>AÇÃO" por rolagem)
+    python yoursheet.py simulate PERSONAGEM AÇÃO -n 100000 [--seed N]
+    python yoursheet.py party AÇÃO [PERSONAGEM ...] [--copies N]   (grupo todo, ou N cópias de cada)
+    python yoursheet.py history [PERSONAGEM [AÇÃO]]   (rolagens registradas e honestidade dos dados)
+    python yoursheet.py export campanha.ysc          (formato compacto, ver archive.py)
+    python yoursheet.py import campanha.ysc          (mescla regras e acrescenta os personagens)
+    python yoursheet.py --trace trace.json batch < rolagens.txt   (tempos por etapa, ver instrument.py)
+    python yoursheet.py --profile 100 batch < rolagens.txt        (cProfile das primeiras 100 ações)
+
+Só importa o modelo (rpg_app); NumPy é carregado apenas pelo simulate, e flet nunca.
+"""
+import argparse
+import json
+import sys
+import time
+
+import instrument
+from rng import SOURCES, make_source
+from rpg_app import RPGApp, summarize_totals
+
+
+class CLIError(Exception):
+    pass
+
+
+def _lookup(app, char_name, action_name):
+    try:
+        return app.lookup_action(char_name, action_name)
+    except LookupError as e:
+        raise CLIError(str(e))
+
+
+def _roll(app, char_name, action_name) -> dict:
+    try:
+        return app.roll_named(char_name, action_name)
+    except LookupError as e:
+        raise CLIError(str(e))
+
+
+def _print_roll(result: dict, as_json: bool):
+    if as_json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(f"{result['character']} | {result['action']} ({result['formula']}): {result['total']}  {result['detail']}")
+
+
+def cmd_list(app, args):
+    chars = app.data["characters"]
+    if args.character is None:
+        names = [c["name"] for c in chars]
+        print(json.dumps(names, ensure_ascii=False) if args.json else "\n".join(names))
+        return 0
+    idx = app.find_character(args.character)
+    if idx is None:
+        raise CLIError(f"personagem '{args.character}' não encontrado")
+    actions = [{"action": f["name"], "formula": f["value"]}
+               for seg in app.character(idx)["segments"] for f in seg["fields"] if f["type"] == "Ação"]
+    if args.json:
+        print(json.dumps(actions, ensure_ascii=False))
+    else:
+        for a in actions:
+            print(f"{a['action']}: {a['formula']}")
+    return 0
+
+
+def cmd_roll(app, args):
+    _print_roll(_roll(app, args.character, args.action), args.json)
+    return 0
+
+
+def cmd_batch(app, args):
+    """Lê 'PERSONAGEM<TAB>AÇÃO' (ou 'PERSONAGEM;AÇÃO') por linha; erros vão para stderr e não param o lote."""
+    status = 0
+    for lineno, line in enumerate(sys.stdin, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        sep = "\t" if "\t" in line else ";"
+        if sep not in line:
+            print(f"linha {lineno}: esperado 'PERSONAGEM<TAB>AÇÃO'", file=sys.stderr)
+            status = 1
+            continue
+        char_name, action_name = (part.strip() for part in line.split(sep, 1))
+        try:
+            _print_roll(_roll(app, char_name, action_name), args.json)
+        except CLIError as e:
+            print(f"linha {lineno}: {e}", file=sys.stderr)
+            status = 1
+    return status
+
+
+def cmd_simulate(app, args):
+    idx, field = _lookup(app, args.character, args.action)
+    if not field["value"]:
+        raise CLIError(f"ação '{field['name']}' sem fórmula")
+    try:
+        totals = app.simulate_action(idx, field["id"], n=args.n, seed=args.seed)
+    except ValueError as e:
+        raise CLIError(f"fórmula inválida: {e}")
+    stats = summarize_totals(totals)
+    if args.json:
+        print(json.dumps(dict(stats, action=field["name"], formula=field["value"]), ensure_ascii=False))
+    else:
+        print(f"{field['name']} ({field['value']}) em {stats['trials']} rolagens:")
+        print(f"  média {stats['mean']:.3f}  desvio {stats['stdev']:.3f}")
+        print(f"  min {stats['min']}  p5 {stats['p5']}  mediana {stats['median']}  p95 {stats['p95']}  max {stats['max']}")
+    return 0
+
+
+def cmd_party(app, args):
+    indices = None
+    if args.characters:
+        indices = []
+        for name in args.characters:
+            idx = app.find_character(name)
+            if idx is None:
+                raise CLIError(f"personagem '{name}' não encontrado")
+            indices.append(idx)
+    rows, missing = app.roll_party(args.action, indices, args.copies)
+    if args.json:
+        print(json.dumps({"rolls": [{"label": label, "total": result.total, "detail": result.text}
+                                    for label, _, result in rows], "missing": missing}, ensure_ascii=False))
+    else:
+        for pos, (label, _, result) in enumerate(rows, 1):
+            print(f"{pos:>4}. {label}: {result.total}  {result.text}")
+        if missing:
+            print(f"sem a ação '{args.action}': {', '.join(missing)}", file=sys.stderr)
+    return 0 if rows else 1
+
+
+def cmd_history(app, args):
+    """Resumo do histórico; com personagem e ação, compara os totais com a distribuição exata da fórmula atual."""
+    stats = app.history.stats(args.character, args.action)
+    if not stats.rolls:
+        raise CLIError("nenhuma rolagem registrada" + (" para essa seleção" if args.character else ""))
+    hist = stats.totals
+    report = {"rolls": stats.rolls, "first": stats.first_time, "last": stats.last_time,
+              "mean": hist.mean(), "stdev": hist.variance() ** 0.5, "min": hist.min, "max": hist.max,
+              "dice": [stats.die_fairness(sides) for sides in sorted(stats.faces)]}
+    if args.character and args.action:
+        idx, field = _lookup(app, args.character, args.action)
+        if field["value"]:
+            # só as rolagens feitas com a fórmula atual, comparadas usando os atributos e regras de agora
+            current = app.history.stats(args.character, args.action, field["value"])
+            try:
+                dist = app.engine.distribution(field["value"], app.get_context(idx),
+                                               app.get_rule_table(field.get("active_rules")))
+            except ValueError as e:
+                raise CLIError(f"fórmula inválida: {e}")
+            report["expected"] = dict(current.compare(dist), formula=field["value"])
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return 0
+    first, last = (time.strftime("%Y-%m-%d %H:%M", time.localtime(t)) for t in (stats.first_time, stats.last_time))
+    print(f"{report['rolls']} rolagens de {first} a {last}")
+    print(f"  total: média {report['mean']:.3f}  desvio {report['stdev']:.3f}  min {report['min']}  max {report['max']}")
+    for die in report["dice"]:
+        if not die["dice"]:
+            continue
+        print(f"  d{die['sides']}: {die['dice']} dados, face máxima em {die['max_face_rate']:.2%} (esperado "
+              f"{1 / die['sides']:.2%}), qui² {die['chi2']:.1f} com {die['dof']} g.l., p = {die['p_value']:.3f}")
+    expected = report.get("expected")
+    if expected and expected["rolls"]:
+        print(f"  {expected['formula']} contra a distribuição exata ({expected['rolls']} rolagens): média "
+              f"{expected['mean']:.3f} vs {expected['expected_mean']:.3f} (z = {expected['z']:+.2f}), "
+              f"p = {expected['p_value']:.3f}, distância {expected['tv_distance']:.3f}")
+    return 0
+
+
+def cmd_export(app, args):
+    from archive import export_campaign
+    counts = export_campaign(app, args.file)
+    if args.json:
+        print(json.dumps(dict(counts, file=args.file), ensure_ascii=False))
+    else:
+        print(f"{counts['characters']} personagens e {counts['rules']} regras exportados para {args.file}")
+    return 0
+
+
+def cmd_import(app, args):
+    from archive import ArchiveError, import_campaign
+    try:
+        report = import_campaign(app, args.file)
+    except (OSError, ArchiveError) as e:
+        raise CLIError(f"não foi possível importar {args.file}: {e}")
+    app.storage.flush()
+    if args.json:
+        print(json.dumps(vars(report), ensure_ascii=False))
+    else:
+        print(f"{report.characters} personagens importados; regras: {report.rules_added} novas, "
+              f"{report.rules_merged} já existentes, {report.rules_renamed} com id trocado")
+        if report.dropped_rule_refs:
+            print(f"{report.dropped_rule_refs} referências a regras desconhecidas removidas", file=sys.stderr)
+        for message in report.skipped:
+            print(f"pulado: {message}", file=sys.stderr)
+        if not report.complete:
+            print("aviso: o arquivo terminou antes do registro final (cortado?)", file=sys.stderr)
+    return 0 if report.complete and not report.skipped else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="yoursheet", description="Rolagens da ficha sem interface.")
+    parser.add_argument("--data", help="arquivo da campanha (.json ou .db); padrão: rpg_data.db se existir, senão rpg_data.json")
+    parser.add_argument("--json", action="store_true", help="saída em JSON (uma linha por resultado)")
+    parser.add_argument("--trace", metavar="FILE", help="mede as etapas e grava um trace do Chrome em FILE "
+                                                        "(resumo dos tempos na saída de erro)")
+    parser.add_argument("--profile", metavar="N", type=int, help="cProfile das primeiras N ações (resumo na saída de erro)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="lista personagens, ou as ações de um personagem")
+    p.add_argument("character", nargs="?")
+    p.set_defaults(func=cmd_list)
+
+    for name, func, help_text in (("roll", cmd_roll, "rola uma ação"),
+                                  ("simulate", cmd_simulate, "rola uma ação N vezes e resume os totais")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("character")
+        p.add_argument("action")
+        p.add_argument("--seed", type=int, help="torna o resultado reproduzível")
+        p.set_defaults(func=func)
+        if name == "roll":
+            p.add_argument("--rng", choices=sorted(SOURCES), default="buffered", help="fonte de números")
+        else:
+            p.add_argument("-n", type=int, default=10000, help="número de rolagens (padrão 10000)")
+
+    p = sub.add_parser("party", help="rola uma ação para o grupo todo (ou os personagens dados), do maior ao menor")
+    p.add_argument("action")
+    p.add_argument("characters", nargs="*")
+    p.add_argument("--copies", type=int, default=1, help="cópias de cada personagem (hordas)")
+    p.add_argument("--seed", type=int)
+    p.add_argument("--rng", choices=sorted(SOURCES), default="buffered")
+    p.set_defaults(func=cmd_party)
+
+    p = sub.add_parser("history", help="resume as rolagens registradas e testa a honestidade dos dados")
+    p.add_argument("character", nargs="?")
+    p.add_argument("action", nargs="?")
+    p.set_defaults(func=cmd_history)
+
+    p = sub.add_parser("export", help="exporta a campanha no formato compacto (um registro por personagem)")
+    p.add_argument("file")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("import", help="importa personagens e regras de um arquivo exportado (ou .json)")
+    p.add_argument("file")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("batch", help="rola as linhas 'PERSONAGEM<TAB>AÇÃO' lidas da entrada padrão")
+    p.add_argument("--seed", type=int)
+    p.add_argument("--rng", choices=sorted(SOURCES), default="buffered")
+    p.set_defaults(func=cmd_batch)
+    return parser
+
+
+def _report_instrumentation(app, args):
+    if args.trace:
+        app.storage.flush()
+        app.history.flush()
+        n = instrument.export_trace(args.trace)
+        print(f"{'etapa':<28}{'n':>8}{'p50 ms':>10}{'p99 ms':>10}{'máx ms':>10}", file=sys.stderr)
+        for name, s in instrument.snapshot()["spans"].items():
+            print(f"{name:<28}{s['count']:>8}{s['p50_ms']:>10.3f}{s['p99_ms']:>10.3f}{s['max_ms']:>10.3f}", file=sys.stderr)
+        print(f"{n} eventos em {args.trace}", file=sys.stderr)
+    if args.profile:
+        print(instrument.finish_profile(), file=sys.stderr)  # menos ações que N: resume as que houve
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        instrument.enable()
+    if args.profile:
+        instrument.profile_next(args.profile)
+    app = RPGApp(args.data)
+    if app.load_error:
+        print(f"yoursheet: {app.load_error}", file=sys.stderr)
+    if getattr(args, "rng", None) is not None and (args.seed is not None or args.rng != "buffered"):
+        app.engine.rng = make_source(args.rng, args.seed)
+    try:
+        return args.func(app, args)
+    except CLIError as e:
+        print(f"yoursheet: {e}", file=sys.stderr)
+        return 1
+    finally:
+        _report_instrumentation(app, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())